@@ -11,9 +11,10 @@ if telemetry_socket:
     instrument_imports(telemetry_socket)
 
 import asyncio
+import collections
 import concurrent.futures
+import dataclasses
 import inspect
-import queue
 import signal
 import sys
 import threading
@@ -41,6 +42,7 @@ from modal.partial_function import (
 from modal.running_app import RunningApp, running_app_from_layout
 from modal_proto import api_pb2
 
+from ._runtime import telemetry
 from ._runtime.container_io_manager import (
     ContainerIOManager,
     IOContext,
@@ -54,50 +56,161 @@ if TYPE_CHECKING:
     import modal._runtime.container_io_manager
 
 
-class DaemonizedThreadPool:
-    # Used instead of ThreadPoolExecutor, since the latter won't allow
-    # the interpreter to shut down before the currently running tasks
-    # have finished
+@dataclasses.dataclass
+class WorkerStats:
+    name: str
+    n_inputs: int = 0
+    busy: float = 0.0  # seconds spent running inputs
+    idle: float = 0.0  # seconds spent waiting for inputs
+
+
+class _Worker:
+    def __init__(self, pool: "InputThreadPool", index: int):
+        self.stats = WorkerStats(f"modal-input-worker-{index}")
+        self.wakeup = threading.Condition(pool._lock)
+        self.task: Optional[tuple[Callable[..., Any], tuple]] = None
+        self.retired = False
+        self.idle_since: Optional[float] = time.monotonic()
+
+
+class InputThreadPool:
+    """Runs sync inputs on up to `max_threads` daemon threads.
+
+    Used instead of ThreadPoolExecutor, since the latter won't allow the interpreter to shut down before
+    the currently running tasks have finished. Inputs are handed straight to the most recently idle
+    thread, which keeps thread-local caches warm, and threads beyond `max_threads` retire once they're
+    idle, so the pool can follow the container's input concurrency.
+    """
+
     def __init__(self, max_threads: int):
-        self.max_threads = max_threads
+        self.max_threads = max(1, max_threads)
 
     def __enter__(self):
-        self.spawned_workers = 0
-        self.inputs: queue.Queue[Any] = queue.Queue()
-        self.finished = threading.Event()
+        self._lock = threading.Lock()
+        self._all_done = threading.Condition(self._lock)
+        self._workers: list[_Worker] = []
+        self._idle: list[_Worker] = []  # the most recently idle worker is last
+        self._queued: collections.deque[tuple[Callable[..., Any], tuple]] = collections.deque()
+        self._n_workers = 0
+        self._n_unfinished = 0
+        self._finished = False
+        self._remove_listener: Optional[Callable[[], None]] = None
         return self
 
     def __exit__(self, exc_type, exc_value, traceback):
-        self.finished.set()
-
-        if exc_type is None:
-            self.inputs.join()
-        else:
-            # special case - allows us to exit the
-            if self.inputs.unfinished_tasks:
+        if self._remove_listener is not None:
+            self._remove_listener()
+        with self._lock:
+            self._finished = True
+            while self._idle:
+                self._retire(self._idle.pop())
+
+            if exc_type is None:
+                while self._n_unfinished:
+                    self._all_done.wait()
+            elif self._n_unfinished:
+                # special case - allows us to exit the container without waiting for running inputs
                 logger.info(
-                    f"Exiting DaemonizedThreadPool with {self.inputs.unfinished_tasks} active "
-                    f"inputs due to exception: {repr(exc_type)}"
+                    f"Exiting InputThreadPool with {self._n_unfinished} active inputs due to exception: "
+                    f"{repr(exc_type)}"
                 )
+            stats = self.worker_stats()
+
+        for worker_stats in stats:
+            logger.debug(f"Input thread stats: {worker_stats}")
+            telemetry.emit_event(telemetry.INPUT_WORKER_STATS, dataclasses.asdict(worker_stats))
+
+    def worker_stats(self) -> list[WorkerStats]:
+        """Busy and idle time of every thread the pool has started, including those that retired."""
+        now = time.monotonic()
+        stats = []
+        for worker in self._workers:
+            worker_stats = dataclasses.replace(worker.stats)
+            if worker.idle_since is not None:
+                worker_stats.idle += now - worker.idle_since
+            stats.append(worker_stats)
+        return stats
+
+    def follow_input_concurrency(self, container_io_manager: "ContainerIOManager") -> None:
+        """Starts and retires threads as the container's number of input slots changes, until the pool exits."""
+        container_io_manager.add_input_concurrency_listener(self.set_max_threads)
+        self._remove_listener = lambda: container_io_manager.remove_input_concurrency_listener(self.set_max_threads)
+
+    def set_max_threads(self, max_threads: int) -> None:
+        with self._lock:
+            self.max_threads = max(1, max_threads)
+            # Retire the idle threads that have been idle the longest first
+            while self._n_workers > self.max_threads and self._idle:
+                self._retire(self._idle.pop(0))
+            while self._queued and self._n_workers < self.max_threads:
+                self._spawn(self._queued.popleft())
+
+    def submit(self, func: Callable[..., Any], *args) -> None:
+        with self._lock:
+            self._n_unfinished += 1
+            if self._idle:
+                worker = self._idle.pop()
+                worker.task = (func, args)
+                worker.wakeup.notify()
+            elif self._n_workers < self.max_threads:
+                self._spawn((func, args))
+            else:
+                self._queued.append((func, args))
+
+    def _spawn(self, task: tuple[Callable[..., Any], tuple]) -> None:
+        worker = _Worker(self, len(self._workers))
+        worker.task = task
+        self._workers.append(worker)
+        self._n_workers += 1
+        threading.Thread(target=self._work, args=(worker,), name=worker.stats.name, daemon=True).start()
+
+    def _retire(self, worker: _Worker) -> None:
+        worker.retired = True
+        self._n_workers -= 1
+        worker.wakeup.notify()
+
+    def _next_task(self, worker: _Worker) -> Optional[tuple[Callable[..., Any], tuple]]:
+        # Called with the lock held, returns None once the worker should exit
+        while True:
+            if worker.task is not None:
+                task, worker.task = worker.task, None
+                return task
+            if worker.retired:
+                return None
+            if self._queued:
+                return self._queued.popleft()
+            if self._finished or self._n_workers > self.max_threads:
+                worker.retired = True
+                self._n_workers -= 1
+                return None
+            self._idle.append(worker)
+            while worker.task is None and not worker.retired:
+                worker.wakeup.wait()
+
+    def _work(self, worker: _Worker) -> None:
+        while True:
+            with self._lock:
+                task = self._next_task(worker)
+                now = time.monotonic()
+                assert worker.idle_since is not None
+                worker.stats.idle += now - worker.idle_since
+                worker.idle_since = None
+                if task is None:
+                    return
+
+            func, args = task
+            try:
+                func(*args)
+            except BaseException:
+                logger.exception(f"Exception raised by {func} in InputThreadPool worker!")
 
-    def submit(self, func, *args):
-        def worker_thread():
-            while not self.finished.is_set():
-                try:
-                    _func, _args = self.inputs.get(timeout=1)
-                except queue.Empty:
-                    continue
-                try:
-                    _func(*_args)
-                except BaseException:
-                    logger.exception(f"Exception raised by {_func} in DaemonizedThreadPool worker!")
-                self.inputs.task_done()
-
-        if self.spawned_workers < self.max_threads:
-            threading.Thread(target=worker_thread, daemon=True).start()
-            self.spawned_workers += 1
-
-        self.inputs.put((func, args))
+            with self._lock:
+                worker.idle_since = time.monotonic()
+                worker.stats.busy += worker.idle_since - now
+                worker.stats.n_inputs += 1
+                self._n_unfinished -= 1
+                if self._n_unfinished == 0:
+                    self._all_done.notify_all()
 
 
 class UserCodeEventLoop:
@@ -268,13 +381,17 @@ def call_function(
                         f"Sync (non-generator) function return value of type {type(res)}."
                         " You might need to use @app.function(..., is_generator=True)."
                     )
-                container_io_manager.push_outputs(
-                    io_context, started_at, res, io_context.finalized_function.data_format
+                # Outputs are serialized here, and compressed and sent in the background, so this thread can move on
+                data_format = io_context.finalized_function.data_format
+                serialized = container_io_manager.serialize_outputs(io_context, res, data_format, copy_buffers=True)
+                container_io_manager.push_serialized_outputs_in_background(
+                    io_context, started_at, data_format, serialized
                 )
         reset_context()
 
     if container_io_manager.target_concurrency > 1:
-        with DaemonizedThreadPool(max_threads=container_io_manager.max_concurrency) as thread_pool:
+        with InputThreadPool(max_threads=container_io_manager.input_concurrency()) as thread_pool:
+            thread_pool.follow_input_concurrency(container_io_manager)
 
             def make_async_cancel_callback(task):
                 def f():
@@ -25,7 +25,7 @@ from ._pty import get_pty_info
 from ._resolver import Resolver
 from ._resources import convert_fn_config_to_resources_config
 from ._runtime.execution_context import current_input_id, is_local
-from ._serialization import serialize, serialize_proto_params
+from ._serialization import SUPPORTED_INPUT_FORMATS, SUPPORTED_OUTPUT_FORMATS, serialize, serialize_proto_params
 from ._traceback import print_server_warnings
 from ._utils.async_utils import (
     TaskContext,
@@ -35,6 +35,7 @@ from ._utils.async_utils import (
     synchronizer,
     warn_if_generator_is_not_consumed,
 )
+from ._utils.compression_utils import CONTAINER_COMPRESSIONS, supported_compressions
 from ._utils.deprecation import deprecation_warning, renamed_parameter
 from ._utils.function_utils import (
     ATTEMPT_TIMEOUT_GRACE_PERIOD,
@@ -129,7 +130,21 @@ class _Invocation:
     ) -> "_Invocation":
         assert client.stub
         function_id = function.object_id
-        item = await _create_input(args, kwargs, client, method_name=function._use_method_name)
+        # Outputs of spawned calls may be fetched by other, older clients, so only pickle is safe for them
+        is_sync = function_call_invocation_type in (
+            api_pb2.FUNCTION_CALL_INVOCATION_TYPE_SYNC,
+            api_pb2.FUNCTION_CALL_INVOCATION_TYPE_SYNC_LEGACY,
+        )
+        item = await _create_input(
+            args,
+            kwargs,
+            client,
+            method_name=function._use_method_name,
+            data_format=function._get_input_data_format(),
+            compressions=function._supported_input_compressions,
+            output_formats=SUPPORTED_OUTPUT_FORMATS if is_sync else (),
+            output_compressions=supported_compressions() if is_sync else (),
+        )
 
         request = api_pb2.FunctionMapRequest(
             function_id=function_id,
@@ -400,6 +415,8 @@ class _Function(typing.Generic[P, ReturnType, OriginalReturnType], _Object, type
     _method_handle_metadata: Optional[
         dict[str, "api_pb2.FunctionHandleMetadata"]
     ] = None  # set for 0.67+ class service functions
+    _supported_input_formats: list["api_pb2.DataFormat.ValueType"]  # set on hydration, empty for older functions
+    _supported_input_compressions: list["api_pb2.PayloadCompression.ValueType"]  # likewise
 
     def _bind_method(
         self,
@@ -824,6 +841,9 @@ class _Function(typing.Generic[P, ReturnType, OriginalReturnType], _Object, type
                     _experimental_buffer_containers=_experimental_buffer_containers or 0,
                     _experimental_proxy_ip=_experimental_proxy_ip,
                     _experimental_custom_scaling=_experimental_custom_scaling_factor is not None,
+                    supported_input_formats=SUPPORTED_INPUT_FORMATS,
+                    # zstandard may be installed here, but not in the function's image
+                    supported_input_compressions=CONTAINER_COMPRESSIONS,
                 )
 
                 if isinstance(gpu, list):
@@ -854,6 +874,8 @@ class _Function(typing.Generic[P, ReturnType, OriginalReturnType], _Object, type
                         _experimental_proxy_ip=function_definition._experimental_proxy_ip,
                         snapshot_debug=function_definition.snapshot_debug,
                         runtime_perf_record=function_definition.runtime_perf_record,
+                        supported_input_formats=function_definition.supported_input_formats,
+                        supported_input_compressions=function_definition.supported_input_compressions,
                     )
 
                     ranked_functions = []
@@ -1177,6 +1199,8 @@ class _Function(typing.Generic[P, ReturnType, OriginalReturnType], _Object, type
         self._function_name = None
         self._info = None
         self._serve_mounts = frozenset()
+        self._supported_input_formats = []
+        self._supported_input_compressions = []
 
     def _hydrate_metadata(self, metadata: Optional[Message]):
         # Overridden concrete implementation of base class method
@@ -1189,6 +1213,8 @@ class _Function(typing.Generic[P, ReturnType, OriginalReturnType], _Object, type
         self._class_parameter_info = metadata.class_parameter_info
         self._method_handle_metadata = dict(metadata.method_handle_metadata)
         self._definition_id = metadata.definition_id
+        self._supported_input_formats = list(metadata.supported_input_formats)
+        self._supported_input_compressions = list(metadata.supported_input_compressions)
 
     def _get_metadata(self):
         # Overridden concrete implementation of base class method
@@ -1202,8 +1228,16 @@ class _Function(typing.Generic[P, ReturnType, OriginalReturnType], _Object, type
             class_parameter_info=self._class_parameter_info,
             definition_id=self._definition_id,
             method_handle_metadata=self._method_handle_metadata,
+            supported_input_formats=self._supported_input_formats,
+            supported_input_compressions=self._supported_input_compressions,
         )
 
+    def _get_input_data_format(self) -> "api_pb2.DataFormat.ValueType":
+        # Containers created by older clients only understand DATA_FORMAT_PICKLE
+        if api_pb2.DATA_FORMAT_PICKLE_OOB in self._supported_input_formats:
+            return api_pb2.DATA_FORMAT_PICKLE_OOB
+        return api_pb2.DATA_FORMAT_PICKLE
+
     def _check_no_web_url(self, fn_name: str):
         if self._web_url:
             raise InvalidError(
@@ -1245,7 +1279,7 @@ class _Function(typing.Generic[P, ReturnType, OriginalReturnType], _Object, type
 
     @live_method_gen
     async def _map(
-        self, input_queue: _SynchronizedQueue, order_outputs: bool, return_exceptions: bool
+        self, input_queue: _SynchronizedQueue, order_outputs: bool, return_exceptions: bool, raw: bool = False
     ) -> AsyncGenerator[Any, None]:
         """mdmd:hidden
 
@@ -1274,6 +1308,7 @@ class _Function(typing.Generic[P, ReturnType, OriginalReturnType], _Object, type
                 order_outputs,
                 return_exceptions,
                 count_update_callback,
+                raw=raw,
             )
         ) as stream:
             async for item in stream:
@@ -1,5 +1,6 @@
 # Copyright Modal Labs 2024
 import asyncio
+import concurrent.futures
 import importlib.metadata
 import inspect
 import json
@@ -9,8 +10,10 @@ import signal
 import sys
 import time
 import traceback
-from collections.abc import AsyncGenerator, AsyncIterator
+from collections import OrderedDict
+from collections.abc import AsyncGenerator, AsyncIterator, Sequence
 from contextlib import AsyncExitStack
+from dataclasses import dataclass
 from pathlib import Path
 from typing import (
     TYPE_CHECKING,
@@ -18,6 +21,7 @@ from typing import (
     Callable,
     ClassVar,
     Optional,
+    Union,
 )
 
 from google.protobuf.empty_pb2 import Empty
@@ -25,10 +29,18 @@ from grpclib import Status
 from synchronicity.async_wrap import asynccontextmanager
 
 import modal_proto.api_pb2
-from modal._serialization import deserialize, serialize, serialize_data_format
+from modal._serialization import (
+    PickleCache,
+    deserialize,
+    has_oob_buffers,
+    serialize,
+    serialize_data_format,
+    serialize_negotiated,
+)
 from modal._traceback import extract_traceback, print_exception
 from modal._utils.async_utils import TaskContext, asyncify, synchronize_api, synchronizer
-from modal._utils.blob_utils import MAX_OBJECT_SIZE_BYTES, blob_download, blob_upload
+from modal._utils.blob_utils import MAX_OBJECT_SIZE_BYTES, blob_download_view, blob_upload
+from modal._utils.compression_utils import compress, decompress
 from modal._utils.function_utils import _stream_function_call_data
 from modal._utils.grpc_utils import retry_transient_errors
 from modal._utils.package_utils import parse_major_minor_version
@@ -45,8 +57,12 @@ if TYPE_CHECKING:
 DYNAMIC_CONCURRENCY_INTERVAL_SECS = 3
 DYNAMIC_CONCURRENCY_TIMEOUT_SECS = 10
 MAX_OUTPUT_BATCH_SIZE: int = 49
+OUTPUT_BATCH_MAX_BYTES: int = 8 * 1024 * 1024
+OUTPUT_SERIALIZATION_THREADS: int = 4
 
 RTT_S: float = 0.5  # conservative estimate of RTT in seconds.
+# FunctionGetInputs calls that take longer than this waited for inputs to arrive, so they don't tell the RTT
+INPUT_RTT_SAMPLE_MAX_S: float = 2 * RTT_S
 
 
 class UserException(Exception):
@@ -57,6 +73,26 @@ class Sentinel:
     """Used to get type-stubs to work with this object."""
 
 
+class FunctionCallPickleCache:
+    """Decoded values shared between the inputs of a function call, such as the kwargs of a `Function.map`.
+
+    Only the most recent function calls are kept, to bound memory use.
+    """
+
+    def __init__(self, max_function_calls: int = 4):
+        self.max_function_calls = max_function_calls
+        self._caches: OrderedDict[str, PickleCache] = OrderedDict()
+
+    def get(self, function_call_id: str) -> PickleCache:
+        if function_call_id in self._caches:
+            self._caches.move_to_end(function_call_id)
+        else:
+            self._caches[function_call_id] = PickleCache()
+            if len(self._caches) > self.max_function_calls:
+                self._caches.popitem(last=False)
+        return self._caches[function_call_id]
+
+
 class IOContext:
     """Context object for managing input, function calls, and function executions
     in a batched or single input context.
@@ -68,6 +104,7 @@ class IOContext:
 
     _cancel_issued: bool = False
     _cancel_callback: Optional[Callable[[], None]] = None
+    _output_time: float = 0.0  # time spent waiting for outputs to be sent
 
     def __init__(
         self,
@@ -75,15 +112,19 @@ class IOContext:
         function_call_ids: list[str],
         finalized_function: "modal._runtime.user_code_imports.FinalizedFunction",
         function_inputs: list[api_pb2.FunctionInput],
+        args_data: list[Union[bytes, memoryview]],
         is_batched: bool,
         client: _Client,
+        pickle_cache: Optional[FunctionCallPickleCache] = None,
     ):
         self.input_ids = input_ids
         self.function_call_ids = function_call_ids
         self.finalized_function = finalized_function
         self._function_inputs = function_inputs
+        self._args_data = args_data  # serialized arguments of each input, downloaded if they were in a blob
         self._is_batched = is_batched
         self._client = client
+        self._pickle_cache = pickle_cache
 
     @classmethod
     async def create(
@@ -92,26 +133,35 @@ class IOContext:
         finalized_functions: dict[str, "modal._runtime.user_code_imports.FinalizedFunction"],
         inputs: list[tuple[str, str, api_pb2.FunctionInput]],
         is_batched: bool,
+        pickle_cache: Optional[FunctionCallPickleCache] = None,
     ) -> "IOContext":
         assert len(inputs) >= 1 if is_batched else len(inputs) == 1
         input_ids, function_call_ids, function_inputs = zip(*inputs)
 
-        async def _populate_input_blobs(client: _Client, input: api_pb2.FunctionInput) -> api_pb2.FunctionInput:
-            # If we got a pointer to a blob, download it from S3.
+        async def _get_args_data(client: _Client, input: api_pb2.FunctionInput) -> Union[bytes, memoryview]:
+            # If we got a pointer to a blob, download it from S3. It's kept out of the proto message,
+            # which would have to copy it, and deserialized in place.
             if input.WhichOneof("args_oneof") == "args_blob_id":
-                args = await blob_download(input.args_blob_id, client.stub)
-                # Mutating
-                input.ClearField("args_blob_id")
-                input.args = args
-
-            return input
+                args = await blob_download_view(input.args_blob_id, client.stub)
+            else:
+                args = input.args
+            return decompress(args, input.args_compression)
 
-        function_inputs = await asyncio.gather(*[_populate_input_blobs(client, input) for input in function_inputs])
+        args_data = await asyncio.gather(*[_get_args_data(client, input) for input in function_inputs])
         # check every input in batch executes the same function
         method_name = function_inputs[0].method_name
         assert all(method_name == input.method_name for input in function_inputs)
         finalized_function = finalized_functions[method_name]
-        return cls(input_ids, function_call_ids, finalized_function, function_inputs, is_batched, client)
+        return cls(
+            input_ids,
+            function_call_ids,
+            finalized_function,
+            function_inputs,
+            args_data,
+            is_batched,
+            client,
+            pickle_cache,
+        )
 
     def set_cancel_callback(self, cb: Callable[[], None]):
         self._cancel_callback = cb
@@ -130,12 +180,26 @@ class IOContext:
             #  between creating a new task for an input and attaching the cancellation callback
             logger.warning("Unexpected: Could not cancel input")
 
+    def _get_pickle_cache(self, function_call_id: str) -> Optional[PickleCache]:
+        if self._pickle_cache is None or not function_call_id:
+            return None
+        return self._pickle_cache.get(function_call_id)
+
+    def supported_output_formats(self) -> list[Sequence["modal_proto.api_pb2.DataFormat.ValueType"]]:
+        return [input.supported_output_formats for input in self._function_inputs]
+
+    def supported_output_compressions(self) -> list[Sequence["modal_proto.api_pb2.PayloadCompression.ValueType"]]:
+        return [input.supported_output_compressions for input in self._function_inputs]
+
     def _args_and_kwargs(self) -> tuple[tuple[Any, ...], dict[str, list[Any]]]:
         # deserializing here instead of the constructor
         # to make sure we handle user exceptions properly
         # and don't retry
         deserialized_args = [
-            deserialize(input.args, self._client) if input.args else ((), {}) for input in self._function_inputs
+            deserialize(data, self._client, self._get_pickle_cache(function_call_id), input.data_format)
+            if data
+            else ((), {})
+            for function_call_id, input, data in zip(self.function_call_ids, self._function_inputs, self._args_data)
         ]
         if not self._is_batched:
             return deserialized_args[0]
@@ -202,12 +266,14 @@ class InputSlots:
     value: int
     waiter: Optional[asyncio.Future]
     closed: bool
+    listeners: list[Callable[[int], None]]
 
     def __init__(self, value: int) -> None:
         self.active = 0
         self.value = value
         self.waiter = None
         self.closed = False
+        self.listeners = []
 
     async def acquire(self) -> None:
         if self.active < self.value:
@@ -233,6 +299,8 @@ class InputSlots:
         if self.closed:
             return
         self.value = value
+        for listener in list(self.listeners):  # listeners can be removed from other threads
+            listener(value)
         self._wake_waiter()
 
     async def close(self) -> None:
@@ -241,6 +309,132 @@ class InputSlots:
             await self.acquire()
 
 
+@dataclass
+class InputStageTimings:
+    """Total time that inputs spent in each stage of the container, in seconds."""
+
+    fetch: float = 0.0  # waiting for FunctionGetInputs
+    download: float = 0.0  # downloading and decompressing arguments
+    buffered: float = 0.0  # waiting for an input slot, after being fetched ahead
+    execute: float = 0.0  # running user code and serializing outputs
+    output: float = 0.0  # waiting for outputs to be sent
+
+
+@dataclass
+class OutputBatchStats:
+    n_batches: int = 0
+    n_outputs: int = 0
+    max_batch_size: int = 0
+    total_flush_latency: float = 0.0  # from the first output of each batch being queued until it's acknowledged
+
+    @property
+    def mean_batch_size(self) -> float:
+        return self.n_outputs / self.n_batches if self.n_batches else 0.0
+
+    @property
+    def mean_flush_latency(self) -> float:
+        return self.total_flush_latency / self.n_batches if self.n_batches else 0.0
+
+
+class OutputBatcher:
+    """Coalesces the outputs of concurrently finishing inputs into shared `FunctionPutOutputs` requests.
+
+    Outputs are queued for up to `linger_time`, or until the batch is full, and `put` returns once the
+    request that sent them has been acknowledged.
+    """
+
+    def __init__(
+        self,
+        client: _Client,
+        linger_time: float,
+        max_batch_size: int = MAX_OUTPUT_BATCH_SIZE,
+        max_batch_bytes: int = OUTPUT_BATCH_MAX_BYTES,
+    ):
+        self._client = client
+        self._linger_time = linger_time
+        self._max_batch_size = max_batch_size
+        self._max_batch_bytes = max_batch_bytes
+        self._pending: list[api_pb2.FunctionPutOutputsItem] = []
+        self._pending_bytes = 0
+        self._pending_since = 0.0
+        self._pending_future: Optional[asyncio.Future[None]] = None
+        self._flush_handle: Optional[asyncio.TimerHandle] = None
+        self._tasks: set[asyncio.Task] = set()
+        self.n_unacknowledged = 0  # outputs that are queued or being sent
+        self.stats = OutputBatchStats()
+
+    async def put(self, outputs: list[api_pb2.FunctionPutOutputsItem], flush: bool = False) -> None:
+        """Queues outputs, and waits until they've been sent. With `flush`, they're sent without lingering."""
+        self.n_unacknowledged += len(outputs)
+        try:
+            await self._put(outputs, flush)
+        finally:
+            self.n_unacknowledged -= len(outputs)
+
+    async def _put(self, outputs: list[api_pb2.FunctionPutOutputsItem], flush: bool) -> None:
+        n_bytes = sum(output.ByteSize() for output in outputs)
+        if self._pending and (
+            len(self._pending) + len(outputs) > self._max_batch_size
+            or self._pending_bytes + n_bytes > self._max_batch_bytes
+        ):
+            self.flush()  # they don't fit in the current batch
+
+        loop = asyncio.get_running_loop()
+        if self._pending_future is None:
+            self._pending_future = loop.create_future()
+            self._pending_since = time.monotonic()
+        future = self._pending_future
+        self._pending += outputs
+        self._pending_bytes += n_bytes
+        if (
+            flush
+            or self._linger_time <= 0
+            or len(self._pending) >= self._max_batch_size
+            or self._pending_bytes >= self._max_batch_bytes
+        ):
+            self.flush()
+        elif self._flush_handle is None:
+            self._flush_handle = loop.call_later(self._linger_time, self.flush)
+        # Shielded, since the request is shared with other inputs
+        await asyncio.shield(future)
+
+    def flush(self) -> None:
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        if self._pending_future is None:
+            return
+        batch, future, queued_at = self._pending, self._pending_future, self._pending_since
+        self._pending, self._pending_bytes, self._pending_future = [], 0, None
+        task = asyncio.create_task(self._send(batch, future, queued_at))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _send(
+        self, batch: list[api_pb2.FunctionPutOutputsItem], future: "asyncio.Future[None]", queued_at: float
+    ) -> None:
+        try:
+            await retry_transient_errors(
+                self._client.stub.FunctionPutOutputs,
+                api_pb2.FunctionPutOutputsRequest(outputs=batch),
+                additional_status_codes=[Status.RESOURCE_EXHAUSTED],
+                max_retries=None,  # Retry indefinitely, trying every 1s.
+            )
+        except BaseException as exc:
+            if not future.done():
+                future.set_exception(exc)
+                future.exception()  # mark as retrieved in case all callers were cancelled
+            if not isinstance(exc, Exception):
+                raise
+            return
+        self.stats.n_batches += 1
+        self.stats.n_outputs += len(batch)
+        self.stats.max_batch_size = max(self.stats.max_batch_size, len(batch))
+        self.stats.total_flush_latency += time.monotonic() - queued_at
+        if not future.done():
+            future.set_result(None)
+
+
 class _ContainerIOManager:
     """Synchronizes all RPC calls and network operations for a running container.
 
@@ -272,8 +466,17 @@ class _ContainerIOManager:
 
     _is_interactivity_enabled: bool
     _fetching_inputs: bool
+    _input_prefetch: int
+    # input_id -> task downloading the arguments, of inputs fetched ahead that haven't started
+    _prefetched_inputs: dict[str, asyncio.Task]
+    _get_inputs_rtt: float
+    _background_tasks: set[asyncio.Task]
 
     _client: _Client
+    _pickle_cache: FunctionCallPickleCache
+    _output_batcher: OutputBatcher
+    _output_serializer: concurrent.futures.ThreadPoolExecutor
+    stage_timings: InputStageTimings
 
     _GENERATOR_STOP_SENTINEL: ClassVar[Sentinel] = Sentinel()
     _singleton: ClassVar[Optional["_ContainerIOManager"]] = None
@@ -311,9 +514,19 @@ class _ContainerIOManager:
 
         self._is_interactivity_enabled = False
         self._fetching_inputs = True
+        self._input_prefetch = config["input_prefetch"]
+        self._prefetched_inputs = {}
+        self._get_inputs_rtt = RTT_S
+        self._background_tasks = set()
 
         self._client = client
         assert isinstance(self._client, _Client)
+        self._pickle_cache = FunctionCallPickleCache()
+        self._output_batcher = OutputBatcher(client, config["output_batch_linger_ms"] / 1000)
+        self._output_serializer = concurrent.futures.ThreadPoolExecutor(
+            OUTPUT_SERIALIZATION_THREADS, thread_name_prefix="modal-output-serializer"
+        )
+        self.stage_timings = InputStageTimings()
 
     @property
     def heartbeat_condition(self) -> asyncio.Condition:
@@ -381,6 +594,12 @@ class _ContainerIOManager:
             # response.cancel_input_event.terminate_containers is never set, the server gets the worker to handle it.
             input_ids_to_cancel = response.cancel_input_event.input_ids
             if input_ids_to_cancel:
+                for input_id in input_ids_to_cancel:
+                    if input_id in self._prefetched_inputs:
+                        # Inputs that were fetched ahead haven't started yet, so they're terminated right away
+                        self._prefetched_inputs.pop(input_id).cancel()
+                        self._terminate_prefetched_input(input_id)
+
                 if self._max_concurrency > 1:
                     for input_id in input_ids_to_cancel:
                         if input_id in self.current_inputs:
@@ -474,12 +693,12 @@ class _ContainerIOManager:
     def serialize_data_format(self, obj: Any, data_format: int) -> bytes:
         return serialize_data_format(obj, data_format)
 
-    async def format_blob_data(self, data: bytes) -> dict[str, Any]:
-        return (
-            {"data_blob_id": await blob_upload(data, self._client.stub)}
-            if len(data) > MAX_OBJECT_SIZE_BYTES
-            else {"data": data}
-        )
+    async def format_blob_data(self, data: Union[bytes, list[Union[bytes, memoryview]]]) -> dict[str, Any]:
+        # A payload made up of several buffers is only joined if it's small enough to be sent inline
+        size = len(data) if isinstance(data, bytes) else sum(len(part) for part in data)
+        if size > MAX_OBJECT_SIZE_BYTES:
+            return {"data_blob_id": await blob_upload(data, self._client.stub)}
+        return {"data": data if isinstance(data, bytes) else b"".join(data)}
 
     async def get_data_in(self, function_call_id: str) -> AsyncIterator[Any]:
         """Read from the `data_in` stream of a function call."""
@@ -559,6 +778,144 @@ class _ContainerIOManager:
 
         return math.ceil(RTT_S / max(self.get_average_call_time(), 1e-6))
 
+    def get_input_prefetch_size(self) -> int:
+        """Number of inputs to fetch ahead, enough to keep all input slots busy for a round trip to the server."""
+        if self.calls_completed == 0:
+            return 1
+        calls_per_rtt = self._get_inputs_rtt * self.get_input_concurrency() / max(self.get_average_call_time(), 1e-6)
+        return max(1, min(self._input_prefetch, math.ceil(calls_per_rtt)))
+
+    def _terminate_prefetched_input(self, input_id: str) -> None:
+        logger.warning(f"Received a cancellation signal for input {input_id} before it started")
+        now = time.time()
+        output = api_pb2.FunctionPutOutputsItem(
+            input_id=input_id,
+            input_started_at=now,
+            output_created_at=now,
+            result=api_pb2.GenericResult(status=api_pb2.GenericResult.GENERIC_STATUS_TERMINATED),
+            data_format=api_pb2.DATA_FORMAT_PICKLE,
+        )
+        task = asyncio.create_task(self._output_batcher.put([output], flush=True))
+        self._background_tasks.add(task)
+        task.add_done_callback(self._background_tasks.discard)
+
+    async def _create_io_context(
+        self,
+        finalized_functions: dict[str, "modal._runtime.user_code_imports.FinalizedFunction"],
+        inputs: list[tuple[str, str, api_pb2.FunctionInput]],
+        is_batched: bool,
+    ) -> IOContext:
+        t0 = time.monotonic()
+        io_context = await IOContext.create(self._client, finalized_functions, inputs, is_batched, self._pickle_cache)
+        self.stage_timings.download += time.monotonic() - t0
+        return io_context
+
+    @synchronizer.no_io_translation
+    async def _prefetch_inputs(
+        self,
+        finalized_functions: dict[str, "modal._runtime.user_code_imports.FinalizedFunction"],
+    ) -> AsyncIterator[IOContext]:
+        """Like `_generate_inputs`, but keeps up to `input_prefetch` inputs fetched ahead.
+
+        This runs the input side of the container as a pipeline: inputs are fetched one after another,
+        their arguments are downloaded concurrently, and they're handed out in order as input slots free up,
+        so downloads overlap with running earlier inputs. Buffered inputs don't hold input slots until they
+        start. They were assigned to this container by the server, so they still run after fetching stops.
+        """
+        # Holds the download task of each input, in the order they were fetched
+        buffer: asyncio.Queue[Union[tuple[str, asyncio.Task], BaseException, None]] = asyncio.Queue()
+        buffer_has_room = asyncio.Event()
+
+        async def download(inputs: list[tuple[str, str, api_pb2.FunctionInput]]) -> tuple[IOContext, float]:
+            io_context = await self._create_io_context(finalized_functions, inputs, False)
+            return io_context, time.monotonic()
+
+        async def fetch_inputs():
+            request = api_pb2.FunctionGetInputsRequest(function_id=self.function_id)
+            try:
+                while self._fetching_inputs:
+                    if len(self._prefetched_inputs) >= self.get_input_prefetch_size():
+                        buffer_has_room.clear()
+                        await buffer_has_room.wait()
+                        continue
+
+                    request.average_call_time = self.get_average_call_time()
+                    request.max_values = self.get_max_inputs_to_fetch()  # Deprecated; remove.
+                    request.input_concurrency = self.get_input_concurrency()
+
+                    t0 = time.monotonic()
+                    response: api_pb2.FunctionGetInputsResponse = await retry_transient_errors(
+                        self._client.stub.FunctionGetInputs, request
+                    )
+                    self.stage_timings.fetch += time.monotonic() - t0
+                    if response.rate_limit_sleep_duration:
+                        logger.info(
+                            "Task exceeded rate limit, sleeping for %.2fs before trying again."
+                            % response.rate_limit_sleep_duration
+                        )
+                        await asyncio.sleep(response.rate_limit_sleep_duration)
+                    elif response.inputs:
+                        rtt = time.monotonic() - t0
+                        if rtt < INPUT_RTT_SAMPLE_MAX_S:
+                            # Long polls of an idle container would otherwise grow the prefetch buffer
+                            self._get_inputs_rtt = 0.8 * self._get_inputs_rtt + 0.2 * rtt
+                        assert len(response.inputs) == 1
+                        item = response.inputs[0]
+                        if item.kill_switch:
+                            logger.debug(f"Task {self.task_id} input kill signal input.")
+                            return
+
+                        task = asyncio.create_task(download([(item.input_id, item.function_call_id, item.input)]))
+                        self._prefetched_inputs[item.input_id] = task
+                        buffer.put_nowait((item.input_id, task))
+                        if item.input.final_input:
+                            return
+            except BaseException as exc:
+                buffer.put_nowait(exc)
+            finally:
+                buffer.put_nowait(None)
+
+        fetch_task = asyncio.create_task(fetch_inputs())
+        try:
+            while True:
+                await self._input_slots.acquire()
+                yielded = False
+                try:
+                    while True:
+                        item = await buffer.get()
+                        if isinstance(item, BaseException):
+                            raise item
+                        elif item is None:
+                            return
+                        input_id, task = item
+                        # Inputs that were cancelled while they were buffered are skipped
+                        if self._prefetched_inputs.get(input_id) is None:
+                            buffer_has_room.set()
+                            continue
+                        try:
+                            io_context, ready_at = await task
+                        except asyncio.CancelledError:
+                            if input_id in self._prefetched_inputs:
+                                raise
+                            buffer_has_room.set()
+                            continue  # cancelled while its arguments were being downloaded
+                        del self._prefetched_inputs[input_id]
+                        buffer_has_room.set()
+                        self.stage_timings.buffered += time.monotonic() - ready_at
+                        break
+
+                    # If yielded, allow input slots to be released via exit_context
+                    yield io_context
+                    yielded = True
+                finally:
+                    if not yielded:
+                        self._input_slots.release()
+        finally:
+            fetch_task.cancel()
+            for task in self._prefetched_inputs.values():
+                task.cancel()
+            self._prefetched_inputs.clear()
+
     @synchronizer.no_io_translation
     async def _generate_inputs(
         self,
@@ -579,9 +936,11 @@ class _ContainerIOManager:
             try:
                 # If number of active inputs is at max queue size, this will block.
                 iteration += 1
+                t0 = time.monotonic()
                 response: api_pb2.FunctionGetInputsResponse = await retry_transient_errors(
                     self._client.stub.FunctionGetInputs, request
                 )
+                self.stage_timings.fetch += time.monotonic() - t0
 
                 if response.rate_limit_sleep_duration:
                     logger.info(
@@ -632,9 +991,16 @@ class _ContainerIOManager:
         dynamic_concurrency_manager = (
             self.dynamic_concurrency_manager() if self._max_concurrency > self._target_concurrency else AsyncExitStack()
         )
+        io_contexts: AsyncIterator[IOContext]
+        if self._input_prefetch > 0 and batch_max_size == 0 and self.function_def.max_inputs != 1:
+            io_contexts = self._prefetch_inputs(finalized_functions)
+        else:
+            io_contexts = (
+                await self._create_io_context(finalized_functions, inputs, batch_max_size > 0)
+                async for inputs in self._generate_inputs(batch_max_size, batch_wait_ms)
+            )
         async with dynamic_concurrency_manager:
-            async for inputs in self._generate_inputs(batch_max_size, batch_wait_ms):
-                io_context = await IOContext.create(self._client, finalized_functions, inputs, batch_max_size > 0)
+            async for io_context in io_contexts:
                 for input_id in io_context.input_ids:
                     self.current_inputs[input_id] = io_context
 
@@ -645,6 +1011,14 @@ class _ContainerIOManager:
             # collect all active input slots, meaning all inputs have wrapped up.
             await self._input_slots.close()
 
+            stats = self._output_batcher.stats
+            logger.debug(
+                f"Sent {stats.n_outputs} outputs in {stats.n_batches} batches (max size {stats.max_batch_size}, "
+                f"mean flush latency {stats.mean_flush_latency * 1000:.1f}ms)"
+            )
+            logger.debug(f"Time spent in each stage by {self.calls_completed} inputs: {self.stage_timings}")
+            self._output_serializer.shutdown(wait=False)
+
     @synchronizer.no_io_translation
     async def _push_outputs(
         self,
@@ -652,6 +1026,7 @@ class _ContainerIOManager:
         started_at: float,
         data_format: "modal_proto.api_pb2.DataFormat.ValueType",
         results: list[api_pb2.GenericResult],
+        result_data_formats: Optional[list["modal_proto.api_pb2.DataFormat.ValueType"]] = None,
     ) -> None:
         output_created_at = time.time()
         outputs = [
@@ -660,16 +1035,21 @@ class _ContainerIOManager:
                 input_started_at=started_at,
                 output_created_at=output_created_at,
                 result=result,
-                data_format=data_format,
+                data_format=result_data_format,
+            )
+            for input_id, result, result_data_format in zip(
+                io_context.input_ids, results, result_data_formats or [data_format] * len(results)
             )
-            for input_id, result in zip(io_context.input_ids, results)
         ]
-        await retry_transient_errors(
-            self._client.stub.FunctionPutOutputs,
-            api_pb2.FunctionPutOutputsRequest(outputs=outputs),
-            additional_status_codes=[Status.RESOURCE_EXHAUSTED],
-            max_retries=None,  # Retry indefinitely, trying every 1s.
-        )
+        # Outputs are sent together with those of other inputs that finish soon after. Input slots are only
+        # released (in exit_context) once they have been acknowledged. When no other inputs are still running,
+        # there's nothing to wait for.
+        n_running = len(self.current_inputs) - self._output_batcher.n_unacknowledged - len(outputs)
+        t0 = time.monotonic()
+        await self._output_batcher.put(outputs, flush=n_running <= 0)
+        output_time = time.monotonic() - t0
+        io_context._output_time += output_time
+        self.stage_timings.output += output_time
 
     def serialize_exception(self, exc: BaseException) -> bytes:
         try:
@@ -808,14 +1188,45 @@ class _ContainerIOManager:
             self.exit_context(started_at, io_context.input_ids)
 
     def exit_context(self, started_at, input_ids: list[str]):
-        self.total_user_time += time.time() - started_at
+        elapsed = time.time() - started_at
+        self.total_user_time += elapsed
         self.calls_completed += 1
+        self.stage_timings.execute += elapsed - self.current_inputs[input_ids[0]]._output_time
 
         for input_id in input_ids:
             self.current_inputs.pop(input_id)
 
         self._input_slots.release()
 
+    @synchronizer.no_io_translation
+    def serialize_outputs(
+        self,
+        io_context: IOContext,
+        data: Any,
+        data_format: "modal_proto.api_pb2.DataFormat.ValueType",
+        copy_buffers: bool = False,
+    ) -> list[tuple["api_pb2.DataFormat.ValueType", list[Union[bytes, memoryview]]]]:
+        """Serializes the outputs of an input, in a format that each of its callers can decode.
+
+        Out-of-band buffers point into `data`, unless `copy_buffers` is set, for outputs that are sent after
+        `data` could have changed.
+        """
+        data = io_context.validate_output_data(data)
+        if data_format == api_pb2.DATA_FORMAT_PICKLE:
+            # Each caller lists the formats it can decode, which may be cheaper than pickling
+            serialized = [
+                serialize_negotiated(d, output_formats)
+                for d, output_formats in zip(data, io_context.supported_output_formats())
+            ]
+        else:
+            serialized = [(data_format, [self.serialize_data_format(d, data_format)]) for d in data]
+        if copy_buffers:
+            serialized = [
+                (result_data_format, [part if isinstance(part, bytes) else bytes(part) for part in parts])
+                for result_data_format, parts in serialized
+            ]
+        return serialized
+
     @synchronizer.no_io_translation
     async def push_outputs(
         self,
@@ -824,25 +1235,69 @@ class _ContainerIOManager:
         data: Any,
         data_format: "modal_proto.api_pb2.DataFormat.ValueType",
     ) -> None:
-        data = io_context.validate_output_data(data)
-        formatted_data = await asyncio.gather(
-            *[self.format_blob_data(self.serialize_data_format(d, data_format)) for d in data]
-        )
+        serialized = self.serialize_outputs(io_context, data, data_format)
+        await self._push_serialized_outputs(io_context, started_at, data_format, serialized)
+
+    async def _push_serialized_outputs(
+        self,
+        io_context: IOContext,
+        started_at: float,
+        data_format: "modal_proto.api_pb2.DataFormat.ValueType",
+        serialized: list[tuple["api_pb2.DataFormat.ValueType", list[Union[bytes, memoryview]]]],
+    ) -> None:
+        def compress_outputs():
+            return [
+                # Compressing would join the out-of-band buffers into a copy
+                (api_pb2.PAYLOAD_COMPRESSION_UNSPECIFIED, parts)
+                if result_data_format == api_pb2.DATA_FORMAT_PICKLE_OOB and has_oob_buffers(parts)
+                else compress(parts, output_compressions)
+                for (result_data_format, parts), output_compressions in zip(
+                    serialized, io_context.supported_output_compressions()
+                )
+            ]
+
+        # Compressed on a worker thread, so large outputs don't hold up the event loop
+        compressed = await asyncio.get_running_loop().run_in_executor(self._output_serializer, compress_outputs)
+        formatted_data = await asyncio.gather(*[self.format_blob_data(payload) for _, payload in compressed])
         results = [
             api_pb2.GenericResult(
                 status=api_pb2.GenericResult.GENERIC_STATUS_SUCCESS,
+                data_compression=data_compression,
                 **d,
             )
-            for d in formatted_data
+            for (data_compression, _), d in zip(compressed, formatted_data)
         ]
         await self._push_outputs(
             io_context=io_context,
             started_at=started_at,
             data_format=data_format,
             results=results,
+            result_data_formats=[result_data_format for result_data_format, _ in serialized],
         )
         self.exit_context(started_at, io_context.input_ids)
 
+    @synchronizer.no_io_translation
+    async def push_serialized_outputs_in_background(
+        self,
+        io_context: IOContext,
+        started_at: float,
+        data_format: "modal_proto.api_pb2.DataFormat.ValueType",
+        serialized: list[tuple["api_pb2.DataFormat.ValueType", list[Union[bytes, memoryview]]]],
+    ) -> None:
+        """Compresses and sends outputs from `serialize_outputs` in the background, reporting errors as failures.
+
+        Used by sync functions, so the thread that ran the input doesn't wait for the upload. The outputs must be
+        serialized with `copy_buffers`. The input slot is still only released once the outputs have been sent.
+        """
+
+        async def push():
+            async with self.handle_input_exception(io_context, started_at):
+                await self._push_serialized_outputs(io_context, started_at, data_format, serialized)
+
+        task = asyncio.create_task(push())
+        self._background_tasks.add(task)
+        task.add_done_callback(self._background_tasks.discard)
+
     async def memory_restore(self) -> None:
         # Busy-wait for restore. `/__modal/restore-state.json` is created
         # by the worker process with updates to the container config.
@@ -973,7 +1428,22 @@ class _ContainerIOManager:
 
         io_manager = cls._singleton
         assert io_manager
-        return max(io_manager._input_slots.active, io_manager._input_slots.value)
+        return io_manager.input_concurrency()
+
+    def input_concurrency(self) -> int:
+        """Returns the number of usable input slots of this IO manager, like `get_input_concurrency`."""
+        return max(self._input_slots.active, self._input_slots.value)
+
+    def add_input_concurrency_listener(self, callback: Callable[[int], None]) -> None:
+        """Calls `callback` with the new number of input slots whenever it changes.
+
+        The callback runs on the IO manager's event loop, so it must be quick and thread-safe.
+        """
+        self._input_slots.listeners.append(callback)
+
+    def remove_input_concurrency_listener(self, callback: Callable[[int], None]) -> None:
+        """Stops calling a `callback` added with `add_input_concurrency_listener`."""
+        self._input_slots.listeners.remove(callback)
 
     @classmethod
     def set_input_concurrency(cls, concurrency: int):
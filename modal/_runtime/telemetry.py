@@ -10,11 +10,13 @@ import time
 import uuid
 from importlib.util import find_spec, module_from_spec
 from struct import pack
+from typing import Any, Optional
 
 from modal.config import logger
 
 MODULE_LOAD_START = "module_load_start"
 MODULE_LOAD_END = "module_load_end"
+INPUT_WORKER_STATS = "input_worker_stats"
 
 MESSAGE_HEADER_FORMAT = "<I"
 MESSAGE_HEADER_LEN = 4
@@ -150,12 +152,17 @@ class ImportInterceptor(importlib.abc.MetaPathFinder):
         self.remove()
 
 
+_interceptor: Optional[ImportInterceptor] = None
+
+
 def _instrument_imports(socket_filename: str):
+    global _interceptor
     if not supported_platform():
         logger.debug("unsupported platform, not instrumenting imports")
         return
     interceptor = ImportInterceptor.connect(socket_filename)
     interceptor.install()
+    _interceptor = interceptor
 
 
 def instrument_imports(socket_filename: str):
@@ -165,5 +172,13 @@ def instrument_imports(socket_filename: str):
         logger.warning(f"failed to instrument imports: {e}")
 
 
+def emit_event(event: str, attributes: dict[str, Any]):
+    """Sends an event on the telemetry socket, if the container was started with one."""
+    if _interceptor is not None:
+        _interceptor.emit(
+            {"span_id": str(uuid.uuid4()), "timestamp": time.time(), "event": event, "attributes": attributes}
+        )
+
+
 def supported_platform():
     return sys.platform in ("linux", "darwin")
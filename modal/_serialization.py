@@ -1,11 +1,14 @@
 # Copyright Modal Labs 2022
 import io
 import pickle
+import struct
 import typing
+from collections.abc import Sequence
 from dataclasses import dataclass
-from typing import Any
+from typing import Any, BinaryIO, Callable, Optional, Union
 
 from modal._utils.async_utils import synchronizer
+from modal._utils.blob_utils import BufferListReader
 from modal_proto import api_pb2
 
 from ._object import _Object
@@ -16,10 +19,58 @@ from .object import Object
 
 PICKLE_PROTOCOL = 4  # Support older Python versions.
 
+# Used for DATA_FORMAT_PICKLE_OOB, which only containers that advertise support for it receive
+OOB_PICKLE_PROTOCOL = 5
+# Buffers smaller than this are cheaper to keep inside the pickle stream
+OOB_BUFFER_MIN_SIZE = 64 * 1024
+# Out-of-band buffers start at aligned offsets in the payload, so arrays can be used in place
+OOB_BUFFER_ALIGNMENT = 64
+
+# Input data formats that functions defined by this client can decode, advertised in their definition
+SUPPORTED_INPUT_FORMATS = [api_pb2.DATA_FORMAT_PICKLE, api_pb2.DATA_FORMAT_PICKLE_OOB]
+# Output data formats this client can decode, most preferred first, advertised with each synchronous input
+SUPPORTED_OUTPUT_FORMATS = [api_pb2.DATA_FORMAT_RAW_BYTES, api_pb2.DATA_FORMAT_PICKLE_OOB, api_pb2.DATA_FORMAT_PICKLE]
+
+# Pickles embedded with `pre_serialize` are cached, once decoded, up to this many bytes of them per function call
+PICKLE_CACHE_MAX_BYTES = 64 * 1024 * 1024
+
+_PLAIN_SCALAR_TYPES = frozenset({type(None), bool, int, float, complex, str, bytes})
+_PLAIN_CONTAINER_TYPES = frozenset({list, tuple, set, frozenset})
+
+
+def _is_plain_data(obj: Any) -> bool:
+    """Whether obj only consists of builtin scalars and containers, and numpy arrays without Python objects.
+
+    Such objects pickle the same with the standard C pickler, which is many times faster than cloudpickle
+    because it doesn't call back into Python for every object.
+    """
+    stack = [obj]
+    seen: set[int] = set()
+    while stack:
+        o = stack.pop()
+        t = type(o)
+        if t in _PLAIN_SCALAR_TYPES:
+            continue
+        if t is dict or t in _PLAIN_CONTAINER_TYPES:
+            if id(o) in seen:
+                continue
+            seen.add(id(o))
+            if t is dict:
+                stack.extend(o.keys())
+                stack.extend(o.values())
+            else:
+                stack.extend(o)
+        elif t.__module__ == "numpy" and not getattr(getattr(o, "dtype", None), "hasobject", True):
+            continue
+        else:
+            return False
+    return True
+
 
 class Pickler(cloudpickle.Pickler):
-    def __init__(self, buf):
-        super().__init__(buf, protocol=PICKLE_PROTOCOL)
+    def __init__(self, buf, protocol: int = PICKLE_PROTOCOL, buffer_callback=None):
+        super().__init__(buf, protocol=protocol, buffer_callback=buffer_callback)
+        self.has_persistent_ids = False
 
     def persistent_id(self, obj):
         from modal.partial_function import PartialFunction
@@ -51,13 +102,50 @@ class Pickler(cloudpickle.Pickler):
             return
         if not obj.is_hydrated:
             raise InvalidError(f"Can't serialize object {obj} which hasn't been hydrated.")
+        self.has_persistent_ids = True
         return (obj.object_id, flag, obj._get_metadata())
 
 
+class PickleCache:
+    """Objects embedded with `pre_serialize`, decoded once and shared by every payload that embeds them.
+
+    Objects are only kept while their pickles add up to at most `max_bytes`, and decoded anew after that.
+    """
+
+    def __init__(self, max_bytes: int = PICKLE_CACHE_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self.n_bytes = 0
+        self._objects: dict[bytes, Any] = {}
+
+    def __len__(self) -> int:
+        return len(self._objects)
+
+    def load(self, data: bytes) -> Any:
+        if data in self._objects:
+            return self._objects[data]
+        obj = pickle.loads(data)
+        if self.n_bytes + len(data) <= self.max_bytes:
+            self._objects[data] = obj
+            self.n_bytes += len(data)
+        return obj
+
+
 class Unpickler(pickle.Unpickler):
-    def __init__(self, client, buf):
+    def __init__(
+        self,
+        client,
+        buf,
+        pickle_cache: Optional[PickleCache] = None,
+        buffers: Optional[Sequence[memoryview]] = None,
+    ):
         self.client = client
-        super().__init__(buf)
+        self.pickle_cache = pickle_cache
+        super().__init__(buf, buffers=buffers)
+
+    def find_class(self, module, name):
+        if self.pickle_cache is not None and module == __name__ and name == _load_pre_serialized.__name__:
+            return self.pickle_cache.load
+        return super().find_class(module, name)
 
     def persistent_load(self, pid):
         if len(pid) == 2:
@@ -84,18 +172,134 @@ class Unpickler(pickle.Unpickler):
 
 def serialize(obj: Any) -> bytes:
     """Serializes object and replaces all references to the client class by a placeholder."""
+    if _is_plain_data(obj):
+        return pickle.dumps(obj, protocol=PICKLE_PROTOCOL)
     buf = io.BytesIO()
     Pickler(buf).dump(obj)
     return buf.getvalue()
 
 
-def deserialize(s: bytes, client) -> Any:
-    """Deserializes object and replaces all client placeholders by self."""
+def serialize_oob(obj: Any) -> list[Union[bytes, memoryview]]:
+    """Serializes object with pickle protocol 5, keeping large buffers (e.g. numpy arrays) out of the pickle stream.
+
+    Returns the parts of a DATA_FORMAT_PICKLE_OOB payload: a header with the part sizes, the pickle stream and
+    the out-of-band buffers, which still point into the memory of the original objects. Callers join the parts
+    or stream them, and must do so before the objects are modified: `_create_input` only returns once they've
+    been uploaded, so `.remote()` and `.spawn()` don't hold on to their arguments.
+    """
+    buffers: list[memoryview] = []
+
+    def buffer_callback(buffer: pickle.PickleBuffer) -> bool:
+        try:
+            raw = buffer.raw()
+        except BufferError:  # not contiguous
+            return True
+        if raw.nbytes < OOB_BUFFER_MIN_SIZE:
+            return True
+        buffers.append(raw)
+        return False
+
+    if _is_plain_data(obj):
+        data = pickle.dumps(obj, protocol=OOB_PICKLE_PROTOCOL, buffer_callback=buffer_callback)
+    else:
+        buf = io.BytesIO()
+        Pickler(buf, protocol=OOB_PICKLE_PROTOCOL, buffer_callback=buffer_callback).dump(obj)
+        data = buf.getvalue()
+
+    sizes = [len(data)] + [b.nbytes for b in buffers]
+    header = struct.pack(f"<I{len(sizes)}Q", len(buffers), *sizes)
+    parts: list[Union[bytes, memoryview]] = [header, data]
+    offset = len(header) + len(data)
+    for b in buffers:
+        if padding := -offset % OOB_BUFFER_ALIGNMENT:
+            parts.append(bytes(padding))
+        parts.append(b)
+        offset += padding + b.nbytes
+    return parts
+
+
+def has_oob_buffers(parts: Sequence[Union[bytes, memoryview]]) -> bool:
+    """Whether a payload from `serialize_oob` keeps any buffers out of the pickle stream."""
+    return len(parts) > 2  # more than the header and the pickle stream
+
+
+def _split_oob(s: Union[bytes, bytearray, memoryview]) -> tuple[memoryview, list[memoryview]]:
+    view = memoryview(s)
+    (n_buffers,) = struct.unpack_from("<I", view)
+    sizes = struct.unpack_from(f"<{n_buffers + 1}Q", view, 4)
+    offset = 4 + 8 * len(sizes)
+    data = view[offset : offset + sizes[0]]
+    offset += sizes[0]
+    buffers = []
+    for size in sizes[1:]:
+        offset += -offset % OOB_BUFFER_ALIGNMENT
+        buffer = view[offset : offset + size]
+        # In-band pickles restore writable arrays, so a copy is made if the payload itself isn't writable
+        buffers.append(buffer if not buffer.readonly else memoryview(bytearray(buffer)))
+        offset += size
+    return data, buffers
+
+
+def _load_pre_serialized(data: bytes) -> Any:
+    return pickle.loads(data)
+
+
+class _PreSerialized:
+    """An object that has already been pickled, which is embedded as-is when pickled again.
+
+    It unpickles through `_load_pre_serialized`, which Modal's Unpickler can swap for a `PickleCache`.
+    """
+
+    def __init__(self, data: bytes):
+        self.data = data
+
+    def __reduce__(self):
+        return (_load_pre_serialized, (self.data,))
+
+
+def pre_serialize(obj: Any) -> Optional[_PreSerialized]:
+    """Pickles an object once, so it can be embedded into many payloads without being pickled again.
+
+    Returns None if the object references Modal objects, since those can only be restored by our Unpickler.
+    Payloads that embed the result can only be read by clients that have `_load_pre_serialized`.
+    """
+    buf = io.BytesIO()
+    pickler = Pickler(buf)
+    pickler.dump(obj)
+    if pickler.has_persistent_ids:
+        return None
+    return _PreSerialized(buf.getvalue())
+
+
+def _reader(s: Union[bytes, bytearray, memoryview]) -> BinaryIO:
+    if isinstance(s, bytes):
+        return io.BytesIO(s)  # shares the bytes object without copying it
+    # Reads from the buffer in place, where a BytesIO would start with a copy of all of it
+    return typing.cast(BinaryIO, io.BufferedReader(BufferListReader([s])))
+
+
+def deserialize(
+    s: Union[bytes, bytearray, memoryview],
+    client,
+    pickle_cache: Optional[PickleCache] = None,
+    data_format: int = api_pb2.DATA_FORMAT_PICKLE,
+) -> Any:
+    """Deserializes object and replaces all client placeholders by self.
+
+    If a `pickle_cache` is passed, objects embedded with `pre_serialize` are decoded once and the same
+    instance is returned for every payload that embeds them, so mutating it affects the other payloads.
+
+    Payloads in `DATA_FORMAT_PICKLE_OOB` are reassembled with their out-of-band buffers as views into `s`.
+    Any buffer can be passed, such as one a blob was downloaded into, and is read without being copied.
+    """
     from ._runtime.execution_context import is_local  # Avoid circular import
 
     env = "local" if is_local() else "remote"
     try:
-        return Unpickler(client, io.BytesIO(s)).load()
+        if data_format == api_pb2.DATA_FORMAT_PICKLE_OOB:
+            data, buffers = _split_oob(s)
+            return Unpickler(client, _reader(data), pickle_cache, buffers).load()
+        return Unpickler(client, _reader(s), pickle_cache).load()
     except AttributeError as exc:
         # We use a different cloudpickle version pre- and post-3.11. Unfortunately cloudpickle
         # doesn't expose some kind of serialization version number, so we have to guess based
@@ -339,28 +543,90 @@ def _deserialize_asgi(asgi: api_pb2.Asgi) -> Any:
         return None
 
 
-def serialize_data_format(obj: Any, data_format: int) -> bytes:
-    """Similar to serialize(), but supports other data formats."""
-    if data_format == api_pb2.DATA_FORMAT_PICKLE:
-        return serialize(obj)
-    elif data_format == api_pb2.DATA_FORMAT_ASGI:
-        return _serialize_asgi(obj).SerializeToString(deterministic=True)
-    elif data_format == api_pb2.DATA_FORMAT_GENERATOR_DONE:
-        assert isinstance(obj, api_pb2.GeneratorDone)
-        return obj.SerializeToString(deterministic=True)
-    else:
-        raise InvalidError(f"Unknown data format {data_format!r}")
+class _Codec(typing.NamedTuple):
+    # Returns the payload as a list of buffers, or None if the format can't represent the object
+    encode: Callable[[Any], Optional[list[Union[bytes, memoryview]]]]
+    decode: Callable[[bytes, Any], Any]  # (payload, client) -> object
 
 
-def deserialize_data_format(s: bytes, data_format: int, client) -> Any:
-    if data_format == api_pb2.DATA_FORMAT_PICKLE:
-        return deserialize(s, client)
-    elif data_format == api_pb2.DATA_FORMAT_ASGI:
-        return _deserialize_asgi(api_pb2.Asgi.FromString(s))
-    elif data_format == api_pb2.DATA_FORMAT_GENERATOR_DONE:
-        return api_pb2.GeneratorDone.FromString(s)
-    else:
-        raise InvalidError(f"Unknown data format {data_format!r}")
+_CODECS: dict[int, _Codec] = {}
+
+
+def register_codec(
+    data_format: int,
+    encode: Callable[[Any], Optional[list[Union[bytes, memoryview]]]],
+    decode: Callable[[bytes, Any], Any],
+) -> None:
+    """Registers how objects are encoded and decoded for a data format."""
+    _CODECS[data_format] = _Codec(encode, decode)
+
+
+def _encode_raw_bytes(obj: Any) -> Optional[list[Union[bytes, memoryview]]]:
+    # Subclasses of bytes are pickled instead, so they keep their type
+    return [obj] if type(obj) is bytes else None  # noqa: E721
+
+
+def _encode_generator_done(obj: Any) -> list[Union[bytes, memoryview]]:
+    assert isinstance(obj, api_pb2.GeneratorDone)
+    return [obj.SerializeToString(deterministic=True)]
+
+
+register_codec(
+    api_pb2.DATA_FORMAT_PICKLE,
+    lambda obj: [serialize(obj)],
+    lambda s, client: deserialize(s, client),
+)
+register_codec(
+    api_pb2.DATA_FORMAT_PICKLE_OOB,
+    serialize_oob,
+    lambda s, client: deserialize(s, client, data_format=api_pb2.DATA_FORMAT_PICKLE_OOB),
+)
+register_codec(
+    api_pb2.DATA_FORMAT_ASGI,
+    lambda obj: [_serialize_asgi(obj).SerializeToString(deterministic=True)],
+    lambda s, client: _deserialize_asgi(api_pb2.Asgi.FromString(s)),
+)
+register_codec(
+    api_pb2.DATA_FORMAT_GENERATOR_DONE,
+    _encode_generator_done,
+    lambda s, client: api_pb2.GeneratorDone.FromString(s),
+)
+register_codec(api_pb2.DATA_FORMAT_RAW_BYTES, _encode_raw_bytes, lambda s, client: bytes(s))
+
+
+def _get_codec(data_format: int) -> _Codec:
+    try:
+        return _CODECS[data_format]
+    except KeyError:
+        raise InvalidError(f"Unknown data format {data_format!r}") from None
+
+
+def serialize_data_format(obj: Any, data_format: int) -> bytes:
+    """Similar to serialize(), but supports other data formats."""
+    parts = _get_codec(data_format).encode(obj)
+    if parts is None:
+        raise InvalidError(f"Can't serialize object of type {type(obj)} with data format {data_format!r}")
+    return parts[0] if len(parts) == 1 else b"".join(parts)
+
+
+def serialize_negotiated(
+    obj: Any, accepted_formats: Sequence[int]
+) -> tuple["api_pb2.DataFormat.ValueType", list[Union[bytes, memoryview]]]:
+    """Serializes object with the first of `accepted_formats` that can represent it.
+
+    Falls back to DATA_FORMAT_PICKLE, which every client can decode. Returns the chosen format
+    and the payload as a list of buffers.
+    """
+    for data_format in accepted_formats:
+        if data_format not in SUPPORTED_OUTPUT_FORMATS:
+            continue  # e.g. formats added by newer clients
+        if (parts := _CODECS[data_format].encode(obj)) is not None:
+            return data_format, parts
+    return api_pb2.DATA_FORMAT_PICKLE, [serialize(obj)]
+
+
+def deserialize_data_format(s: Union[bytes, bytearray, memoryview], data_format: int, client) -> Any:
+    return _get_codec(data_format).decode(s, client)
 
 
 class ClsConstructorPickler(pickle.Pickler):
@@ -1,23 +1,34 @@
 # Copyright Modal Labs 2022
 import asyncio
+import bisect
+import contextlib
 import dataclasses
 import hashlib
 import io
+import itertools
+import mmap
 import os
 import platform
+import tempfile
 import time
-from collections.abc import AsyncIterator
-from contextlib import AbstractContextManager, contextmanager
+import weakref
+from collections import OrderedDict, deque
+from collections.abc import AsyncIterator, Awaitable, Sequence
+from contextlib import AbstractContextManager, asynccontextmanager, contextmanager
 from pathlib import Path, PurePosixPath
 from typing import TYPE_CHECKING, Any, BinaryIO, Callable, Optional, Union
 from urllib.parse import urlparse
 
+from grpclib import GRPCError, Status
+
 from modal_proto import api_pb2
 from modal_proto.modal_api_grpc import ModalClientModal
 
+from ..config import config
 from ..exception import ExecutionError
 from .async_utils import TaskContext, retry
 from .grpc_utils import retry_transient_errors
+from .hash_cache import get_hash_cache
 from .hash_utils import UploadHashes, get_upload_hashes
 from .http_utils import ClientSessionRegistry
 from .logger import logger
@@ -38,11 +49,36 @@ BLOB_MAX_PARALLELISM = 10
 # read ~16MiB chunks by default
 DEFAULT_SEGMENT_CHUNK_SIZE = 2**24
 
+# Blobs are downloaded in ranges of this size, with up to DOWNLOAD_MAX_PARALLELISM at a time
+DOWNLOAD_RANGE_SIZE = 8 * 1024 * 1024  # 8 MiB
+DOWNLOAD_MAX_PARALLELISM = 8
+
+# Downloads larger than this are written to a memory-mapped temporary file instead of memory, so
+# the kernel can page them out
+BLOB_DOWNLOAD_MMAP_THRESHOLD = 1024**3
+
 # Files larger than this will be multipart uploaded. The server might request multipart upload for smaller files as
 # well, but the limit will never be raised.
 # TODO(dano): remove this once we stop requiring md5 for blobs
 MULTIPART_UPLOAD_THRESHOLD = 1024**3
 
+# Blobs that are uploaded in parts ask for parts of at least this length, and at most this many parts
+MULTIPART_PART_LENGTH = 64 * 1024 * 1024  # 64 MiB
+MAX_MULTIPART_PARTS = 10_000
+
+# Max number of files whose existence is checked in a single MountFilesExist call
+MOUNT_FILES_EXIST_BATCH_SIZE = 1000
+
+# Small files are uploaded in packs of up to this many bytes and files
+MOUNT_PACK_MAX_BYTES = 16 * 1024 * 1024  # 16 MiB
+MOUNT_PACK_MAX_FILES = 10_000
+# Max bytes of file contents held in memory by packs that are pending or being uploaded
+MOUNT_PACK_MAX_INFLIGHT_BYTES = 64 * 1024 * 1024  # 64 MiB
+
+# Blob ids of uploaded content are reused for at most this long, so that they aren't referenced after the
+# server may have expired the blob
+UPLOADED_BLOB_MAX_AGE = 30 * 60  # 30 minutes
+
 
 @retry(n_attempts=5, base_delay=0.5, timeout=None)
 async def _upload_to_s3_url(
@@ -86,13 +122,120 @@ async def _upload_to_s3_url(
                 etag = etag[1:-1]
             remote_md5 = etag
 
-            local_md5_hex = payload.md5_checksum().hexdigest()
+            local_md5_hex = payload.md5_hex()
             if local_md5_hex != remote_md5:
                 raise ExecutionError(f"Local data and remote data checksum mismatch ({local_md5_hex} vs {remote_md5})")
 
             return remote_md5
 
 
+class _PartScheduler:
+    """Limits the part uploads that run at once, and the memory they buffer, across all blob uploads.
+
+    Parts that have to wait are queued per blob, and blobs take turns as slots free up, so that a
+    large upload can't hold up the others.
+    """
+
+    def __init__(self, max_parallelism: int, max_inflight_bytes: int):
+        self.max_parallelism = max_parallelism
+        self.max_inflight_bytes = max_inflight_bytes
+        self.inflight = 0
+        self.inflight_bytes = 0
+        self.peak_inflight_bytes = 0
+        self._waiters: OrderedDict[object, deque[tuple[int, asyncio.Future[None]]]] = OrderedDict()
+
+    def _has_room(self, n_bytes: int) -> bool:
+        # A part that's larger than the whole budget still runs on its own
+        return self.inflight == 0 or (
+            self.inflight < self.max_parallelism and self.inflight_bytes + n_bytes <= self.max_inflight_bytes
+        )
+
+    def _take(self, n_bytes: int):
+        self.inflight += 1
+        self.inflight_bytes += n_bytes
+        self.peak_inflight_bytes = max(self.peak_inflight_bytes, self.inflight_bytes)
+
+    def _release(self, n_bytes: int):
+        self.inflight -= 1
+        self.inflight_bytes -= n_bytes
+        self._grant()
+
+    def _grant(self):
+        while self._waiters:
+            blob_key, queue = next(iter(self._waiters.items()))
+            n_bytes, fut = queue[0]
+            if fut.done():
+                # Cancelled while waiting, but its task hasn't run yet to remove it
+                queue.popleft()
+                if not queue:
+                    del self._waiters[blob_key]
+                continue
+            if not self._has_room(n_bytes):
+                return
+            queue.popleft()
+            if queue:
+                self._waiters.move_to_end(blob_key)
+            else:
+                del self._waiters[blob_key]
+            self._take(n_bytes)
+            fut.set_result(None)
+
+    @asynccontextmanager
+    async def slot(self, blob_key: object, n_bytes: int) -> AsyncIterator[None]:
+        """Waits for a turn to upload a part of the blob identified by `blob_key`, buffering `n_bytes`."""
+        if not self._waiters and self._has_room(n_bytes):
+            self._take(n_bytes)
+        else:
+            fut: asyncio.Future[None] = asyncio.get_running_loop().create_future()
+            self._waiters.setdefault(blob_key, deque()).append((n_bytes, fut))
+            try:
+                await fut
+            except asyncio.CancelledError:
+                if fut.cancelled():
+                    # `_grant` may have dropped it already
+                    queue = self._waiters.get(blob_key)
+                    if queue is not None and (n_bytes, fut) in queue:
+                        queue.remove((n_bytes, fut))
+                        if not queue:
+                            del self._waiters[blob_key]
+                    # Others may have been waiting behind it
+                    self._grant()
+                else:
+                    self._release(n_bytes)  # the slot was granted just as we got cancelled
+                raise
+        try:
+            yield
+        finally:
+            self._release(n_bytes)
+
+
+_part_schedulers: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, _PartScheduler]" = weakref.WeakKeyDictionary()
+
+
+def get_part_scheduler() -> _PartScheduler:
+    """Returns the part scheduler shared by all uploads on the running event loop."""
+    loop = asyncio.get_running_loop()
+    if loop not in _part_schedulers:
+        _part_schedulers[loop] = _PartScheduler(
+            max_parallelism=config["blob_upload_parallelism"],
+            max_inflight_bytes=config["blob_upload_max_inflight_bytes"],
+        )
+    return _part_schedulers[loop]
+
+
+def _part_reader_factory(data_file: BinaryIO) -> Callable[[], AbstractContextManager[BinaryIO]]:
+    # Each part gets its own reader, to avoid needing to lock access to the reader's position pointer.
+    if isinstance(data_file, io.BytesIO):
+        view = data_file.getbuffer()  # does not copy data
+        return lambda: contextlib.nullcontext(io.BytesIO(view))
+    elif isinstance(data_file, BufferListReader):
+        buffers = data_file._buffers
+        return lambda: contextlib.nullcontext(BufferListReader(buffers))
+    else:
+        filename = data_file.name
+        return lambda: open(filename, "rb")
+
+
 async def perform_multipart_upload(
     data_file: Union[BinaryIO, io.BytesIO, io.FileIO],
     *,
@@ -102,33 +245,40 @@ async def perform_multipart_upload(
     completion_url: str,
     upload_chunk_size: int = DEFAULT_SEGMENT_CHUNK_SIZE,
     progress_report_cb: Optional[Callable] = None,
+    part_md5s_hex: Optional[Sequence[str]] = None,
 ) -> None:
+    """Uploads the parts of a blob, scheduled with the parts of all other uploads in the process.
+
+    A part only opens its reader once it gets a slot, so the number of open files and the memory used
+    for buffers stay bounded no matter how many parts and blobs are being uploaded.
+    If the md5 of each part is passed in `part_md5s_hex`, they aren't computed again while uploading.
+    """
     from .bytes_io_segment_payload import BytesIOSegmentPayload
 
+    scheduler = get_part_scheduler()
+    blob_key = object()
+    open_reader = _part_reader_factory(data_file)
+
+    async def upload_part(part_url: str, part_start: int, part_length: int, md5_hex: Optional[str]) -> str:
+        async with scheduler.slot(blob_key, min(part_length, upload_chunk_size)):
+            with open_reader() as data_file_rdr:
+                part_payload = BytesIOSegmentPayload(
+                    data_file_rdr,
+                    segment_start=part_start,
+                    segment_length=part_length,
+                    chunk_size=upload_chunk_size,
+                    progress_report_cb=progress_report_cb,
+                    md5_hex=md5_hex,
+                )
+                return await _upload_to_s3_url(part_url, payload=part_payload, content_type=None)
+
     upload_coros = []
     file_offset = 0
     num_bytes_left = content_length
-
-    # Give each part its own IO reader object to avoid needing to
-    # lock access to the reader's position pointer.
-    data_file_readers: list[BinaryIO]
-    if isinstance(data_file, io.BytesIO):
-        view = data_file.getbuffer()  # does not copy data
-        data_file_readers = [io.BytesIO(view) for _ in range(len(part_urls))]
-    else:
-        filename = data_file.name
-        data_file_readers = [open(filename, "rb") for _ in range(len(part_urls))]
-
-    for part_number, (data_file_rdr, part_url) in enumerate(zip(data_file_readers, part_urls), start=1):
+    for part_number, part_url in enumerate(part_urls):
         part_length_bytes = min(num_bytes_left, max_part_size)
-        part_payload = BytesIOSegmentPayload(
-            data_file_rdr,
-            segment_start=file_offset,
-            segment_length=part_length_bytes,
-            chunk_size=upload_chunk_size,
-            progress_report_cb=progress_report_cb,
-        )
-        upload_coros.append(_upload_to_s3_url(part_url, payload=part_payload, content_type=None))
+        md5_hex = part_md5s_hex[part_number] if part_md5s_hex else None
+        upload_coros.append(upload_part(part_url, file_offset, part_length_bytes, md5_hex))
         num_bytes_left -= part_length_bytes
         file_offset += part_length_bytes
 
@@ -161,6 +311,10 @@ async def perform_multipart_upload(
             )
 
 
+def get_multipart_part_length(content_length: int) -> int:
+    return max(MULTIPART_PART_LENGTH, -(-content_length // MAX_MULTIPART_PARTS))
+
+
 def get_content_length(data: BinaryIO) -> int:
     # *Remaining* length of file from current seek position
     pos = data.tell()
@@ -182,12 +336,18 @@ async def _blob_upload(
         content_md5=upload_hashes.md5_base64,
         content_sha256_base64=upload_hashes.sha256_base64,
         content_length=content_length,
+        part_length=upload_hashes.part_length,
     )
     resp = await retry_transient_errors(stub.BlobCreate, req)
 
     blob_id = resp.blob_id
 
     if resp.WhichOneof("upload_type_oneof") == "multipart":
+        # Part md5s from hashing can only be used if the server split the blob the way we asked
+        part_md5s_hex = upload_hashes.part_md5s_hex
+        n_parts = len(resp.multipart.upload_urls)
+        if resp.multipart.part_length != upload_hashes.part_length or len(part_md5s_hex) != n_parts:
+            part_md5s_hex = []
         await perform_multipart_upload(
             data,
             content_length=content_length,
@@ -196,6 +356,7 @@ async def _blob_upload(
             completion_url=resp.multipart.completion_url,
             upload_chunk_size=DEFAULT_SEGMENT_CHUNK_SIZE,
             progress_report_cb=progress_report_cb,
+            part_md5s_hex=part_md5s_hex,
         )
     else:
         from .bytes_io_segment_payload import BytesIOSegmentPayload
@@ -216,15 +377,335 @@ async def _blob_upload(
     return blob_id
 
 
-async def blob_upload(payload: bytes, stub: ModalClientModal) -> str:
-    size_mib = len(payload) / 1024 / 1024
-    logger.debug(f"Uploading large blob of size {size_mib:.2f} MiB")
-    t0 = time.time()
+class UploadedBlobCache:
+    """Content-addressed cache of blobs uploaded during a client session.
+
+    Maps the sha256 of uploaded content to its blob id, so that identical payloads (e.g. the same large
+    argument passed to every input of a map) are only uploaded once. Concurrent uploads of the same
+    content share a single upload. If that upload is cancelled along with its caller, one of the callers
+    waiting for it uploads the content instead. Blob ids are reused for at most `max_age` seconds.
+    """
+
+    def __init__(self, max_entries: int = 10_000, max_age: float = UPLOADED_BLOB_MAX_AGE):
+        self.max_entries = max_entries
+        self.max_age = max_age
+        self.hits = 0
+        self.misses = 0
+        self.bytes_saved = 0
+        self._blob_ids: OrderedDict[str, tuple[str, float]] = OrderedDict()  # sha256 -> (blob id, upload time)
+        self._pending: dict[str, asyncio.Future[str]] = {}
+
+    def __len__(self) -> int:
+        return len(self._blob_ids)
+
+    async def get_or_upload(self, sha256_hex: str, size: int, upload: Callable[[], Awaitable[str]]) -> str:
+        while sha256_hex in self._pending:
+            fut = self._pending[sha256_hex]
+            try:
+                blob_id = await asyncio.shield(fut)
+            except asyncio.CancelledError:
+                if not fut.cancelled():
+                    raise  # this caller was cancelled
+                continue  # the upload was cancelled with the caller that started it, so retry it
+            self._record_hit(size)
+            return blob_id
+
+        if sha256_hex in self._blob_ids:
+            blob_id, uploaded_at = self._blob_ids[sha256_hex]
+            if time.monotonic() - uploaded_at < self.max_age:
+                self._blob_ids.move_to_end(sha256_hex)
+                self._record_hit(size)
+                return blob_id
+            del self._blob_ids[sha256_hex]
+
+        self.misses += 1
+        fut = asyncio.get_running_loop().create_future()
+        self._pending[sha256_hex] = fut
+        try:
+            blob_id = await upload()
+        except asyncio.CancelledError:
+            fut.cancel()
+            raise
+        except BaseException as exc:
+            fut.set_exception(exc)
+            fut.exception()  # mark as retrieved in case nobody else is waiting
+            raise
+        else:
+            fut.set_result(blob_id)
+            self._blob_ids[sha256_hex] = (blob_id, time.monotonic())
+            if len(self._blob_ids) > self.max_entries:
+                self._blob_ids.popitem(last=False)
+            return blob_id
+        finally:
+            del self._pending[sha256_hex]
+
+    def _record_hit(self, size: int):
+        self.hits += 1
+        self.bytes_saved += size
+
+
+class MountFileExistenceChecker:
+    """Checks whether the contents of mount files already exist on the server, in batches.
+
+    Concurrent checks are collected for a short while (or until a batch is full) and sent as a single
+    MountFilesExist call, instead of one MountPutFile call per file. Servers that don't support batched
+    checks get a MountPutFile call per file instead.
+
+    Batches are checked by tasks in `task_context`, so they're cancelled along with the upload.
+    """
+
+    def __init__(
+        self,
+        stub: ModalClientModal,
+        task_context: TaskContext,
+        max_batch_size: int = MOUNT_FILES_EXIST_BATCH_SIZE,
+        debounce_time: float = 0.015,
+    ):
+        self._stub = stub
+        self._task_context = task_context
+        self._max_batch_size = max_batch_size
+        self._debounce_time = debounce_time
+        self._batched = True
+        self._pending: dict[str, asyncio.Future[bool]] = {}
+        self._flush_handle: Optional[asyncio.TimerHandle] = None
+
+    async def exists(self, sha256_hex: str) -> bool:
+        if not self._batched:
+            return await self._exists_single(sha256_hex)
+        fut = self._pending.get(sha256_hex)
+        if fut is None:
+            loop = asyncio.get_running_loop()
+            fut = self._pending[sha256_hex] = loop.create_future()
+            if len(self._pending) >= self._max_batch_size:
+                self._flush()
+            elif self._flush_handle is None:
+                self._flush_handle = loop.call_later(self._debounce_time, self._flush)
+        # Shielded, since the result can be shared with other callers
+        return await asyncio.shield(fut)
+
+    def _flush(self):
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        batch, self._pending = self._pending, {}
+        self._task_context.create_task(self._check_batch(batch))
+
+    async def _check_batch(self, batch: dict[str, "asyncio.Future[bool]"]):
+        try:
+            request = api_pb2.MountFilesExistRequest(sha256_hexes=list(batch))
+            try:
+                response = await retry_transient_errors(self._stub.MountFilesExist, request, base_delay=1)
+                results = list(response.exists)
+            except GRPCError as exc:
+                if exc.status != Status.UNIMPLEMENTED:
+                    raise
+                logger.debug("Server doesn't support batched file existence checks, checking files one by one")
+                self._batched = False
+                results = await asyncio.gather(*(self._exists_single(sha256_hex) for sha256_hex in batch))
+            if len(results) != len(batch):
+                raise ExecutionError(f"Expected {len(batch)} file existence results, got {len(results)}")
+        except BaseException as exc:
+            for fut in batch.values():
+                if not fut.done():
+                    fut.set_exception(exc)
+                    fut.exception()  # mark as retrieved in case the caller was cancelled
+            if not isinstance(exc, Exception):
+                raise
+        else:
+            for fut, exists in zip(batch.values(), results):
+                if not fut.done():
+                    fut.set_result(exists)
+
+    async def _exists_single(self, sha256_hex: str) -> bool:
+        request = api_pb2.MountPutFileRequest(sha256_hex=sha256_hex)
+        response = await retry_transient_errors(self._stub.MountPutFile, request, base_delay=1)
+        return response.exists
+
+
+class MountFilePacker:
+    """Uploads the contents of small mount files packed together, instead of with a MountPutFile call each.
+
+    Files are collected for a short while (or until a pack is full) and uploaded as a single pack, along
+    with the offset and sha256 of each file in it, so files are still stored by their content. Packs that
+    are too large to send inline are uploaded as a blob. Each distinct content is only packed once.
+
+    Packs are uploaded by tasks in `task_context`, so they're cancelled along with the upload. Contents are
+    only read once the packs that are pending or being uploaded hold less than `max_inflight_bytes`.
+    """
+
+    def __init__(
+        self,
+        stub: ModalClientModal,
+        task_context: TaskContext,
+        max_pack_bytes: int = MOUNT_PACK_MAX_BYTES,
+        max_pack_files: int = MOUNT_PACK_MAX_FILES,
+        debounce_time: float = 0.015,
+        max_inflight_bytes: int = MOUNT_PACK_MAX_INFLIGHT_BYTES,
+    ):
+        self.n_packs = 0
+        self.peak_inflight_bytes = 0
+        self._stub = stub
+        self._task_context = task_context
+        self._max_pack_bytes = max_pack_bytes
+        self._max_pack_files = max_pack_files
+        self._debounce_time = debounce_time
+        self._max_inflight_bytes = max_inflight_bytes
+        self._packed = True
+        self._results: dict[str, asyncio.Future[bool]] = {}  # files in pending, uploading and uploaded packs
+        self._pending: dict[str, tuple[bytes, asyncio.Future[bool]]] = {}
+        self._pending_bytes = 0
+        self._inflight_bytes = 0  # in pending and uploading packs
+        self._inflight_changed = asyncio.Condition()
+        self._flush_handle: Optional[asyncio.TimerHandle] = None
+
+    async def put(self, sha256_hex: str, size: int, read_content: Callable[[], bytes]) -> bool:
+        """Uploads a file's content in a pack, reading it with `read_content` once there's room for `size` bytes.
+
+        Returns False if the server doesn't support packs, in which case the caller should upload it.
+        """
+        if sha256_hex not in self._results:
+            async with self._inflight_changed:
+                await self._inflight_changed.wait_for(
+                    lambda: sha256_hex in self._results
+                    or not self._packed
+                    or self._inflight_bytes == 0
+                    or self._inflight_bytes + size <= self._max_inflight_bytes
+                )
+        if not self._packed:
+            return False
+        if sha256_hex in self._results:
+            fut = self._results[sha256_hex]
+        else:
+            content = read_content()
+            loop = asyncio.get_running_loop()
+            fut = loop.create_future()
+            self._results[sha256_hex] = fut
+            self._pending[sha256_hex] = (content, fut)
+            self._pending_bytes += len(content)
+            self._inflight_bytes += len(content)
+            self.peak_inflight_bytes = max(self.peak_inflight_bytes, self._inflight_bytes)
+            if len(self._pending) >= self._max_pack_files or self._pending_bytes >= self._max_pack_bytes:
+                self._flush()
+            elif self._flush_handle is None:
+                self._flush_handle = loop.call_later(self._debounce_time, self._flush)
+        # Shielded, since the result is shared by all files in the pack
+        return await asyncio.shield(fut)
+
+    def _flush(self):
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        pack, self._pending, self._pending_bytes = self._pending, {}, 0
+        self._task_context.create_task(self._upload_pack(pack))
+
+    async def _upload_pack(self, pack: dict[str, tuple[bytes, "asyncio.Future[bool]"]]):
+        contents = [content for content, _ in pack.values()]
+        files = []
+        offset = 0
+        for sha256_hex, content in zip(pack, contents):
+            files.append(api_pb2.MountPackedFile(sha256_hex=sha256_hex, offset=offset, length=len(content)))
+            offset += len(content)
+
+        try:
+            if offset >= LARGE_FILE_LIMIT:
+                blob_id = await blob_upload(contents, self._stub)
+                request = api_pb2.MountPutPackedFilesRequest(data_blob_id=blob_id, files=files)
+            else:
+                request = api_pb2.MountPutPackedFilesRequest(data=b"".join(contents), files=files)
+            try:
+                await retry_transient_errors(self._stub.MountPutPackedFiles, request, base_delay=1)
+                packed = True
+                self.n_packs += 1
+                logger.debug(f"Uploaded {len(files)} files in a pack of {offset} bytes")
+            except GRPCError as exc:
+                if exc.status != Status.UNIMPLEMENTED:
+                    raise
+                logger.debug("Server doesn't support packed files, uploading files one by one")
+                self._packed = packed = False
+        except BaseException as exc:
+            for _, fut in pack.values():
+                if not fut.done():
+                    fut.set_exception(exc)
+                    fut.exception()  # mark as retrieved in case the caller was cancelled
+            if not isinstance(exc, Exception):
+                raise
+        else:
+            for _, fut in pack.values():
+                if not fut.done():
+                    fut.set_result(packed)
+        finally:
+            self._inflight_bytes -= offset
+            async with self._inflight_changed:
+                self._inflight_changed.notify_all()
+
+
+class BufferListReader(io.RawIOBase):
+    """Seekable read-only file over a sequence of buffers.
+
+    Lets payloads that are made up of several buffers (e.g. out-of-band pickle buffers) be hashed and
+    uploaded without first concatenating them into a single bytes object.
+    """
+
+    def __init__(self, buffers: Sequence[Union[bytes, memoryview]]):
+        self._buffers = [memoryview(b).cast("B") for b in buffers]
+        self._offsets = list(itertools.accumulate((len(b) for b in self._buffers), initial=0))
+        self._pos = 0
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def tell(self) -> int:
+        return self._pos
+
+    def seek(self, offset: int, whence: int = os.SEEK_SET) -> int:
+        if whence == os.SEEK_CUR:
+            offset += self._pos
+        elif whence == os.SEEK_END:
+            offset += self._offsets[-1]
+        self._pos = max(offset, 0)
+        return self._pos
+
+    def readinto(self, b) -> int:
+        out = memoryview(b).cast("B")
+        n = 0
+        i = bisect.bisect_right(self._offsets, self._pos) - 1
+        while n < len(out) and i < len(self._buffers):
+            start = self._pos - self._offsets[i]
+            chunk = self._buffers[i][start : start + len(out) - n]
+            out[n : n + len(chunk)] = chunk
+            n += len(chunk)
+            self._pos += len(chunk)
+            i += 1
+        return n
+
+
+async def blob_upload(
+    payload: Union[bytes, Sequence[Union[bytes, memoryview]]],
+    stub: ModalClientModal,
+    cache: Optional[UploadedBlobCache] = None,
+) -> str:
+    """Uploads a payload to blob storage and returns its blob id.
+
+    The payload can also be a sequence of buffers, which are uploaded as if they were concatenated.
+    """
     if isinstance(payload, str):
         logger.warning("Blob uploading string, not bytes - auto-encoding as utf8")
         payload = payload.encode("utf8")
-    upload_hashes = get_upload_hashes(payload)
-    blob_id = await _blob_upload(upload_hashes, payload, stub)
+    data: Union[bytes, BinaryIO] = payload if isinstance(payload, bytes) else BufferListReader(payload)
+    size = len(data) if isinstance(data, bytes) else get_content_length(data)
+    size_mib = size / 1024 / 1024
+    logger.debug(f"Uploading large blob of size {size_mib:.2f} MiB")
+    t0 = time.time()
+    upload_hashes = get_upload_hashes(data)
+    if cache is not None:
+        blob_id = await cache.get_or_upload(
+            upload_hashes.sha256_hex(), size, lambda: _blob_upload(upload_hashes, data, stub)
+        )
+    else:
+        blob_id = await _blob_upload(upload_hashes, data, stub)
     dur_s = max(time.time() - t0, 0.001)  # avoid division by zero
     throughput_mib_s = (size_mib) / dur_s
     logger.debug(f"Uploaded large blob of size {size_mib:.2f} MiB ({throughput_mib_s:.2f} MiB/s)." f" {blob_id}")
@@ -237,55 +718,166 @@ async def blob_upload_file(
     progress_report_cb: Optional[Callable] = None,
     sha256_hex: Optional[str] = None,
     md5_hex: Optional[str] = None,
+    part_md5s_hex: Sequence[str] = (),
 ) -> str:
+    """Uploads a file to blob storage and returns its blob id.
+
+    Hashes that are already known aren't computed again. `part_md5s_hex` are the md5s of the parts of
+    length `get_multipart_part_length(size)`, as computed by `get_upload_hashes`.
+    """
     upload_hashes = get_upload_hashes(file_obj, sha256_hex=sha256_hex, md5_hex=md5_hex)
+    if part_md5s_hex:
+        upload_hashes.part_length = get_multipart_part_length(get_content_length(file_obj))
+        upload_hashes.part_md5s_hex = list(part_md5s_hex)
     return await _blob_upload(upload_hashes, file_obj, stub, progress_report_cb)
 
 
+async def _check_download_response(s3_resp) -> None:
+    # S3 signal to slow down request rate.
+    if s3_resp.status == 503:
+        logger.warning("Received SlowDown signal from S3, sleeping for 1 second before retrying.")
+        await asyncio.sleep(1)
+
+    if s3_resp.status not in (200, 206):
+        text = await s3_resp.text()
+        raise ExecutionError(f"Get from url failed with status {s3_resp.status}: {text}")
+
+
+async def _read_into(s3_resp, view: memoryview) -> None:
+    """Streams a response body into a view of exactly its size."""
+    offset = 0
+    async for chunk in s3_resp.content.iter_any():
+        if offset + len(chunk) > len(view):
+            raise ExecutionError(f"Download is larger than the expected {len(view)} bytes")
+        view[offset : offset + len(chunk)] = chunk
+        offset += len(chunk)
+    if offset != len(view):
+        raise ExecutionError(f"Download ended after {offset} of {len(view)} bytes")
+
+
+def _parse_content_range(content_range: str) -> int:
+    # e.g. "bytes 0-1023/4096"
+    total = content_range.rpartition("/")[2]
+    if not total.isdigit():
+        raise ExecutionError(f"Can't get the blob size from Content-Range {content_range!r}")
+    return int(total)
+
+
 @retry(n_attempts=5, base_delay=0.1, timeout=None)
-async def _download_from_url(download_url: str) -> bytes:
-    async with ClientSessionRegistry.get_session().get(download_url) as s3_resp:
-        # S3 signal to slow down request rate.
-        if s3_resp.status == 503:
-            logger.warning("Received SlowDown signal from S3, sleeping for 1 second before retrying.")
-            await asyncio.sleep(1)
+async def _download_first_range(download_url: str) -> tuple[int, bytearray]:
+    """Downloads the first range of a blob, which also tells its size.
 
-        if s3_resp.status != 200:
-            text = await s3_resp.text()
-            raise ExecutionError(f"Get from url failed with status {s3_resp.status}: {text}")
-        return await s3_resp.read()
+    Returns the size of the blob and the downloaded data, which is all of it if the blob fits in a
+    single range or the server doesn't support range requests.
+    """
+    headers = {"Range": f"bytes=0-{DOWNLOAD_RANGE_SIZE - 1}"}
+    async with ClientSessionRegistry.get_session().get(download_url, headers=headers) as s3_resp:
+        if s3_resp.status == 416:  # Range Not Satisfiable, which is what empty blobs respond with
+            return 0, bytearray()
+        await _check_download_response(s3_resp)
+        if s3_resp.content_length is None or "Content-Encoding" in s3_resp.headers:
+            # The decoded size isn't known up front
+            data = bytearray(await s3_resp.read())
+            return len(data), data
+        data = bytearray(s3_resp.content_length)
+        await _read_into(s3_resp, memoryview(data))
+        if s3_resp.status == 206:
+            return _parse_content_range(s3_resp.headers["Content-Range"]), data
+        return len(data), data
 
 
-async def blob_download(blob_id: str, stub: ModalClientModal) -> bytes:
-    """Convenience function for reading all of the downloaded file into memory."""
+@retry(n_attempts=5, base_delay=0.1, timeout=None)
+async def _download_range(download_url: str, view: memoryview, start: int) -> None:
+    """Downloads the range of a blob that starts at `start` into `view`, retrying just this range on failure."""
+    headers = {"Range": f"bytes={start}-{start + len(view) - 1}"}
+    async with ClientSessionRegistry.get_session().get(download_url, headers=headers) as s3_resp:
+        await _check_download_response(s3_resp)
+        if s3_resp.status != 206:
+            raise ExecutionError(f"Expected a partial response to a range request, got status {s3_resp.status}")
+        await _read_into(s3_resp, view)
+
+
+def _allocate_download_buffer(size: int) -> Union[bytearray, mmap.mmap]:
+    if size < BLOB_DOWNLOAD_MMAP_THRESHOLD:
+        return bytearray(size)
+    with tempfile.TemporaryFile() as f:
+        f.truncate(size)
+        # The mapping stays valid after the file is closed, and the file is removed once it's unmapped
+        return mmap.mmap(f.fileno(), size)
+
+
+async def _download_into_buffer(download_url: str) -> memoryview:
+    size, first_range = await _download_first_range(download_url)
+    if len(first_range) == size and size < BLOB_DOWNLOAD_MMAP_THRESHOLD:
+        return memoryview(first_range)
+
+    view = memoryview(_allocate_download_buffer(size))
+    view[: len(first_range)] = first_range
+
+    # The remaining ranges are downloaded concurrently, straight to their place in the buffer
+    semaphore = asyncio.Semaphore(DOWNLOAD_MAX_PARALLELISM)
+
+    async def download_range(start: int):
+        async with semaphore:
+            await _download_range(download_url, view[start : start + DOWNLOAD_RANGE_SIZE], start)
+
+    starts = range(len(first_range), size, DOWNLOAD_RANGE_SIZE)
+    await TaskContext.gather(*(download_range(start) for start in starts))
+    return view
+
+
+async def blob_download_view(blob_id: str, stub: ModalClientModal) -> memoryview:
+    """Downloads a blob into a buffer that's allocated up front from its size, and returns a view of it.
+
+    Large blobs are downloaded in ranges, several at a time, and a failed range is retried on its own.
+    The data is never held in memory twice, and blobs above `BLOB_DOWNLOAD_MMAP_THRESHOLD` are backed
+    by a memory-mapped temporary file rather than memory.
+    """
     logger.debug(f"Downloading large blob {blob_id}")
     t0 = time.time()
     req = api_pb2.BlobGetRequest(blob_id=blob_id)
     resp = await retry_transient_errors(stub.BlobGet, req)
-    data = await _download_from_url(resp.download_url)
-    size_mib = len(data) / 1024 / 1024
+    view = await _download_into_buffer(resp.download_url)
+    size_mib = len(view) / 1024 / 1024
     dur_s = max(time.time() - t0, 0.001)  # avoid division by zero
     throughput_mib_s = size_mib / dur_s
     logger.debug(f"Downloaded large blob {blob_id} of size {size_mib:.2f} MiB ({throughput_mib_s:.2f} MiB/s)")
-    return data
+    return view
 
 
-async def blob_iter(blob_id: str, stub: ModalClientModal) -> AsyncIterator[bytes]:
+async def blob_download(blob_id: str, stub: ModalClientModal) -> bytes:
+    """Convenience function for reading all of the downloaded file into memory.
+
+    This copies the data into a `bytes` object; callers that accept a buffer should use `blob_download_view`.
+    """
+    return bytes(await blob_download_view(blob_id, stub))
+
+
+async def blob_iter(blob_id: str, stub: ModalClientModal) -> AsyncIterator[bytearray]:
+    """Yields the data of a blob in order, downloading up to `DOWNLOAD_MAX_PARALLELISM` ranges ahead.
+
+    Each range is yielded as the buffer it was downloaded into, without being copied.
+    """
     req = api_pb2.BlobGetRequest(blob_id=blob_id)
     resp = await retry_transient_errors(stub.BlobGet, req)
     download_url = resp.download_url
-    async with ClientSessionRegistry.get_session().get(download_url) as s3_resp:
-        # S3 signal to slow down request rate.
-        if s3_resp.status == 503:
-            logger.warning("Received SlowDown signal from S3, sleeping for 1 second before retrying.")
-            await asyncio.sleep(1)
+    size, first_range = await _download_first_range(download_url)
+    if first_range:
+        yield first_range
 
-        if s3_resp.status != 200:
-            text = await s3_resp.text()
-            raise ExecutionError(f"Get from url failed with status {s3_resp.status}: {text}")
+    async def download_range(start: int) -> bytearray:
+        data = bytearray(min(DOWNLOAD_RANGE_SIZE, size - start))
+        await _download_range(download_url, memoryview(data), start)
+        return data
 
-        async for chunk in s3_resp.content.iter_any():
-            yield chunk
+    async with TaskContext() as tc:
+        pending: deque[asyncio.Task[bytearray]] = deque()
+        for start in range(len(first_range), size, DOWNLOAD_RANGE_SIZE):
+            pending.append(tc.create_task(download_range(start)))
+            if len(pending) >= DOWNLOAD_MAX_PARALLELISM:
+                yield await pending.popleft()
+        while pending:
+            yield await pending.popleft()
 
 
 @dataclasses.dataclass
@@ -300,6 +892,18 @@ class FileUploadSpec:
     md5_hex: str
     mode: int  # file permission bits (last 12 bits of st_mode)
     size: int
+    part_md5s_hex: list[str] = dataclasses.field(default_factory=list)  # for multipart uploads, see UploadHashes
+
+    def read_content(self) -> bytes:
+        """Returns the content of a file that isn't uploaded as a blob, reading it if it wasn't read up front."""
+        if self.content is not None:
+            return self.content
+        with self.source() as fp:
+            fp.seek(0)
+            content = fp.read()
+        if hashlib.sha256(content).hexdigest() != self.sha256_hex:
+            raise ExecutionError(f"{self.source_description} was modified during upload")
+        return content
 
 
 def _get_file_upload_spec(
@@ -307,7 +911,26 @@ def _get_file_upload_spec(
     source_description: Any,
     mount_filename: PurePosixPath,
     mode: int,
+    stat: Optional[os.stat_result] = None,
 ) -> FileUploadSpec:
+    # Files on disk can have their hashes in the hash cache, keyed by their stat() result
+    hash_cache = get_hash_cache() if stat is not None else None
+    hashes = hash_cache.get(str(source_description), stat) if hash_cache is not None else None
+    if hashes is not None:
+        assert stat is not None
+        return FileUploadSpec(
+            source=source,
+            source_description=source_description,
+            mount_filename=mount_filename.as_posix(),
+            use_blob=stat.st_size >= LARGE_FILE_LIMIT,
+            content=None,  # read only if the file needs to be uploaded
+            sha256_hex=hashes.sha256_hex(),
+            md5_hex=hashes.md5_hex(),
+            mode=mode & 0o7777,
+            size=stat.st_size,
+            part_md5s_hex=hashes.part_md5s_hex,
+        )
+
     with source() as fp:
         # Current position is ignored - we always upload from position 0
         fp.seek(0, os.SEEK_END)
@@ -317,14 +940,19 @@ def _get_file_upload_spec(
         if size >= LARGE_FILE_LIMIT:
             # TODO(dano): remove the placeholder md5 once we stop requiring md5 for blobs
             md5_hex = "baadbaadbaadbaadbaadbaadbaadbaad" if size > MULTIPART_UPLOAD_THRESHOLD else None
+            # Files that are certainly uploaded in parts get their part md5s in the same pass over the file
+            part_length = get_multipart_part_length(size) if size > MULTIPART_UPLOAD_THRESHOLD else 0
             use_blob = True
             content = None
-            hashes = get_upload_hashes(fp, md5_hex=md5_hex)
+            hashes = get_upload_hashes(fp, md5_hex=md5_hex, part_length=part_length)
         else:
             use_blob = False
             content = fp.read()
             hashes = get_upload_hashes(content)
 
+    if hash_cache is not None and stat is not None and size == stat.st_size:
+        hash_cache.put(str(source_description), stat, hashes)
+
     return FileUploadSpec(
         source=source,
         source_description=source_description,
@@ -335,6 +963,7 @@ def _get_file_upload_spec(
         md5_hex=hashes.md5_hex(),
         mode=mode & 0o7777,
         size=size,
+        part_md5s_hex=hashes.part_md5s_hex,
     )
 
 
@@ -343,12 +972,14 @@ def get_file_upload_spec_from_path(
 ) -> FileUploadSpec:
     # Python appears to give files 0o666 bits on Windows (equal for user, group, and global),
     # so we mask those out to 0o755 for compatibility with POSIX-based permissions.
-    mode = mode or os.stat(filename).st_mode & (0o7777 if platform.system() != "Windows" else 0o7755)
+    stat = os.stat(filename)
+    mode = mode or stat.st_mode & (0o7777 if platform.system() != "Windows" else 0o7755)
     return _get_file_upload_spec(
         lambda: open(filename, "rb"),
         filename,
         mount_filename,
         mode,
+        stat,
     )
 
 
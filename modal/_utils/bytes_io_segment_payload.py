@@ -21,7 +21,7 @@ class BytesIOSegmentPayload(BytesIOPayload):
     Adds:
     * read limit using remaining_bytes, in order to split files across streams
     * larger read chunk (to prevent excessive read contention between parts)
-    * calculates an md5 for the segment
+    * calculates an md5 for the segment, unless it's already known
 
     Feels like this should be in some standard lib...
     """
@@ -33,6 +33,7 @@ class BytesIOSegmentPayload(BytesIOPayload):
         segment_length: int,
         chunk_size: int = DEFAULT_SEGMENT_CHUNK_SIZE,
         progress_report_cb: Optional[Callable] = None,
+        md5_hex: Optional[str] = None,  # if the md5 of the segment is known, it isn't computed again
     ):
         # not thread safe constructor!
         super().__init__(bytes_io)
@@ -44,6 +45,7 @@ class BytesIOSegmentPayload(BytesIOPayload):
         assert self.segment_length <= super().size
         self.chunk_size = chunk_size
         self.progress_report_cb = progress_report_cb or (lambda *_, **__: None)
+        self._known_md5_hex = md5_hex
         self.reset_state()
 
     def reset_state(self):
@@ -71,18 +73,23 @@ class BytesIOSegmentPayload(BytesIOPayload):
     def md5_checksum(self):
         return self._md5_checksum
 
+    def md5_hex(self) -> str:
+        return self._known_md5_hex or self._md5_checksum.hexdigest()
+
+    def _read_chunk(self) -> bytes:
+        # Reads and hashes the next chunk in a single trip to the executor
+        self._value.seek(self.initial_seek_pos + self.segment_start + self.num_bytes_read)
+        chunk = self._value.read(min(self.chunk_size, self.remaining_bytes()))
+        if self._known_md5_hex is None:
+            self._md5_checksum.update(chunk)
+        self.num_bytes_read += len(chunk)
+        return chunk
+
     async def write(self, writer: "AbstractStreamWriter"):
         loop = asyncio.get_event_loop()
 
         async def safe_read():
-            read_start = self.initial_seek_pos + self.segment_start + self.num_bytes_read
-            self._value.seek(read_start)
-            num_bytes = min(self.chunk_size, self.remaining_bytes())
-            chunk = await loop.run_in_executor(None, self._value.read, num_bytes)
-
-            await loop.run_in_executor(None, self._md5_checksum.update, chunk)
-            self.num_bytes_read += len(chunk)
-            return chunk
+            return await loop.run_in_executor(None, self._read_chunk)
 
         chunk = await safe_read()
         while chunk and self.remaining_bytes() > 0:
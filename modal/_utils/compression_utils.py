@@ -0,0 +1,120 @@
+# Copyright Modal Labs 2024
+import dataclasses
+import zlib
+from collections.abc import Sequence
+from typing import Union
+
+from modal_proto import api_pb2
+
+from ..config import logger
+from ..exception import InvalidError
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Payloads smaller than this are sent as-is
+COMPRESSION_MIN_SIZE = 64 * 1024
+# A sample of this size is compressed first, to skip payloads that don't compress well
+COMPRESSION_SAMPLE_SIZE = 64 * 1024
+# Payloads are only compressed if the sample shrinks to at most this fraction of its size
+COMPRESSION_MAX_RATIO = 0.9
+
+ZLIB_LEVEL = 1
+ZSTD_LEVEL = 3
+
+
+@dataclasses.dataclass
+class CompressionStats:
+    n_compressed: int = 0
+    n_skipped: int = 0  # large enough, but didn't compress well
+    bytes_in: int = 0
+    bytes_out: int = 0
+
+    @property
+    def bytes_saved(self) -> int:
+        return self.bytes_in - self.bytes_out
+
+
+compression_stats = CompressionStats()
+
+
+# Compressions that every container can decode, whatever its image has installed
+CONTAINER_COMPRESSIONS = [api_pb2.PAYLOAD_COMPRESSION_ZLIB]
+
+
+def supported_compressions() -> list["api_pb2.PayloadCompression.ValueType"]:
+    """Compressions this client can decode, most preferred first."""
+    if zstandard is not None:
+        return [api_pb2.PAYLOAD_COMPRESSION_ZSTD, api_pb2.PAYLOAD_COMPRESSION_ZLIB]
+    return [api_pb2.PAYLOAD_COMPRESSION_ZLIB]
+
+
+def _compress_chunks(chunks: Sequence[Union[bytes, memoryview]], compression: int) -> bytes:
+    if compression == api_pb2.PAYLOAD_COMPRESSION_ZSTD:
+        assert zstandard is not None
+        compressor = zstandard.ZstdCompressor(level=ZSTD_LEVEL).compressobj()
+    else:
+        compressor = zlib.compressobj(ZLIB_LEVEL)
+    return b"".join([*(compressor.compress(chunk) for chunk in chunks), compressor.flush()])
+
+
+def _sample(parts: Sequence[Union[bytes, memoryview]]) -> list[memoryview]:
+    sample, size = [], 0
+    for part in parts:
+        if size >= COMPRESSION_SAMPLE_SIZE:
+            break
+        chunk = memoryview(part)[: COMPRESSION_SAMPLE_SIZE - size]
+        sample.append(chunk)
+        size += len(chunk)
+    return sample
+
+
+def compress(
+    data: Union[bytes, Sequence[Union[bytes, memoryview]]],
+    accepted: Sequence["api_pb2.PayloadCompression.ValueType"],
+) -> tuple["api_pb2.PayloadCompression.ValueType", Union[bytes, Sequence[Union[bytes, memoryview]]]]:
+    """Compresses a payload, if the receiver accepts a codec we have.
+
+    Payloads can be bytes or a sequence of buffers, which are compressed as if they were concatenated.
+    Returns the codec used, or PAYLOAD_COMPRESSION_UNSPECIFIED and the unchanged payload if it's small,
+    or doesn't compress well.
+    """
+    parts = [data] if isinstance(data, bytes) else data
+    size = sum(len(part) for part in parts)
+    if size < COMPRESSION_MIN_SIZE:
+        return api_pb2.PAYLOAD_COMPRESSION_UNSPECIFIED, data
+    ours = supported_compressions()
+    compression = next((c for c in accepted if c in ours), None)
+    if compression is None:
+        return api_pb2.PAYLOAD_COMPRESSION_UNSPECIFIED, data
+
+    sample = _sample(parts)
+    sample_size = sum(len(chunk) for chunk in sample)
+    if len(_compress_chunks(sample, compression)) > sample_size * COMPRESSION_MAX_RATIO:
+        compression_stats.n_skipped += 1
+        return api_pb2.PAYLOAD_COMPRESSION_UNSPECIFIED, data
+
+    compressed = _compress_chunks(parts, compression)
+    compression_stats.n_compressed += 1
+    compression_stats.bytes_in += size
+    compression_stats.bytes_out += len(compressed)
+    logger.debug(f"Compressed payload from {size} to {len(compressed)} bytes")
+    return compression, compressed
+
+
+def decompress(
+    data: Union[bytes, memoryview], compression: "api_pb2.PayloadCompression.ValueType"
+) -> Union[bytes, memoryview]:
+    if compression == api_pb2.PAYLOAD_COMPRESSION_UNSPECIFIED:
+        return data
+    elif compression == api_pb2.PAYLOAD_COMPRESSION_ZLIB:
+        return zlib.decompress(data)
+    elif compression == api_pb2.PAYLOAD_COMPRESSION_ZSTD:
+        if zstandard is None:
+            raise InvalidError("Decompressing this payload requires the `zstandard` package")
+        # Streaming, since frames written by a compressobj don't record the content size
+        return zstandard.ZstdDecompressor().decompressobj().decompress(data)
+    else:
+        raise InvalidError(f"Unknown payload compression {compression!r}")
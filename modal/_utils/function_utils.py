@@ -1,12 +1,13 @@
 # Copyright Modal Labs 2022
 import asyncio
+import concurrent.futures
 import enum
 import inspect
 import os
-from collections.abc import AsyncGenerator
+from collections.abc import AsyncGenerator, Sequence
 from enum import Enum
 from pathlib import Path, PurePosixPath
-from typing import Any, Callable, Literal, Optional
+from typing import Any, Callable, Literal, Optional, Union
 
 from grpclib import GRPCError
 from grpclib.exceptions import StreamTerminatedError
@@ -15,7 +16,7 @@ from synchronicity.exceptions import UserCodeException
 import modal_proto
 from modal_proto import api_pb2
 
-from .._serialization import deserialize, deserialize_data_format, serialize
+from .._serialization import deserialize, deserialize_data_format, has_oob_buffers, serialize, serialize_oob
 from .._traceback import append_modal_tb
 from ..config import config, logger
 from ..exception import (
@@ -27,7 +28,8 @@ from ..exception import (
     RemoteError,
 )
 from ..mount import ROOT_DIR, _is_modal_path, _Mount
-from .blob_utils import MAX_OBJECT_SIZE_BYTES, blob_download, blob_upload
+from .blob_utils import MAX_OBJECT_SIZE_BYTES, blob_download_view, blob_upload
+from .compression_utils import compress, decompress
 from .grpc_utils import RETRYABLE_GRPC_STATUS_CODES
 
 
@@ -408,8 +410,9 @@ async def _stream_function_call_data(
             async for chunk in stub_fn.unary_stream(req):
                 if chunk.index <= last_index:
                     continue
+                message_bytes: Union[bytes, memoryview]
                 if chunk.data_blob_id:
-                    message_bytes = await blob_download(chunk.data_blob_id, client.stub)
+                    message_bytes = await blob_download_view(chunk.data_blob_id, client.stub)
                 else:
                     message_bytes = chunk.data
                 message = deserialize_data_format(message_bytes, chunk.data_format, client)
@@ -461,11 +464,18 @@ manually, for example:
     return exc
 
 
-async def _process_result(result: api_pb2.GenericResult, data_format: int, stub, client=None):
+async def _process_result(result: api_pb2.GenericResult, data_format: int, stub, client=None, *, raw: bool = False):
+    """Download and deserialize a function result, raising any remote exception.
+
+    With `raw=True`, successful results are returned as serialized bytes without being decoded.
+    """
+    data: Union[bytes, memoryview]
     if result.WhichOneof("data_oneof") == "data_blob_id":
-        data = await blob_download(result.data_blob_id, stub)
+        # Large results are decoded straight from the buffer they were downloaded into
+        data = await blob_download_view(result.data_blob_id, stub)
     else:
         data = result.data
+    data = decompress(data, result.data_compression)
 
     if result.status == api_pb2.GenericResult.GENERIC_STATUS_TIMEOUT:
         raise FunctionTimeoutError(result.exception)
@@ -504,6 +514,9 @@ async def _process_result(result: api_pb2.GenericResult, data_format: int, stub,
             raise uc_exc
         raise RemoteError(result.exception)
 
+    if raw:
+        return bytes(data)
+
     try:
         return deserialize_data_format(data, data_format, client)
     except ModuleNotFoundError as deser_exc:
@@ -515,35 +528,75 @@ async def _process_result(result: api_pb2.GenericResult, data_format: int, stub,
 
 
 async def _create_input(
-    args, kwargs, client, *, idx: Optional[int] = None, method_name: Optional[str] = None
+    args,
+    kwargs,
+    client,
+    *,
+    idx: Optional[int] = None,
+    method_name: Optional[str] = None,
+    executor: Optional[concurrent.futures.Executor] = None,
+    data_format: "api_pb2.DataFormat.ValueType" = api_pb2.DATA_FORMAT_PICKLE,
+    output_formats: Sequence["api_pb2.DataFormat.ValueType"] = (),
+    compressions: Sequence["api_pb2.PayloadCompression.ValueType"] = (),
+    output_compressions: Sequence["api_pb2.PayloadCompression.ValueType"] = (),
 ) -> api_pb2.FunctionPutInputsItem:
     """Serialize function arguments and create a FunctionInput protobuf,
     uploading to blob storage if needed.
+
+    If an `executor` is passed, arguments are serialized there instead of on the event loop.
+    With `DATA_FORMAT_PICKLE_OOB`, large buffers in the arguments are uploaded straight from their memory,
+    before this returns. The arguments must not be modified until then.
+    `output_formats` are the formats, besides pickle, that the caller accepts the output in.
+    If `payload_compression` is enabled, large arguments are compressed with one of `compressions`,
+    the codecs the function accepts, and `output_compressions` are advertised for the output.
     """
     if idx is None:
         idx = 0
     if method_name is None:
         method_name = ""  # proto compatible
 
-    args_serialized = serialize((args, kwargs))
+    serializer = serialize_oob if data_format == api_pb2.DATA_FORMAT_PICKLE_OOB else serialize
+    if not config["payload_compression"]:
+        compressions = output_compressions = ()
+
+    def serialize_args():
+        payload = serializer((args, kwargs))
+        if not isinstance(payload, bytes) and has_oob_buffers(payload):
+            # Compressing would join the out-of-band buffers into a copy
+            return api_pb2.PAYLOAD_COMPRESSION_UNSPECIFIED, payload
+        return compress(payload, compressions)
+
+    if executor is not None:
+        args_compression, args_serialized = await asyncio.get_running_loop().run_in_executor(executor, serialize_args)
+    else:
+        args_compression, args_serialized = serialize_args()
+    args_size = len(args_serialized) if isinstance(args_serialized, bytes) else sum(map(len, args_serialized))
 
-    if len(args_serialized) > MAX_OBJECT_SIZE_BYTES:
-        args_blob_id = await blob_upload(args_serialized, client.stub)
+    if args_size > MAX_OBJECT_SIZE_BYTES:
+        args_blob_id = await blob_upload(args_serialized, client.stub, cache=client._blob_cache)
 
         return api_pb2.FunctionPutInputsItem(
             input=api_pb2.FunctionInput(
                 args_blob_id=args_blob_id,
-                data_format=api_pb2.DATA_FORMAT_PICKLE,
+                data_format=data_format,
                 method_name=method_name,
+                supported_output_formats=output_formats,
+                args_compression=args_compression,
+                supported_output_compressions=output_compressions,
             ),
             idx=idx,
         )
     else:
+        if not isinstance(args_serialized, bytes):
+            args_serialized = b"".join(args_serialized)
         return api_pb2.FunctionPutInputsItem(
             input=api_pb2.FunctionInput(
                 args=args_serialized,
-                data_format=api_pb2.DATA_FORMAT_PICKLE,
+                data_format=data_format,
                 method_name=method_name,
+                supported_output_formats=output_formats,
+                args_compression=args_compression,
+                supported_output_compressions=output_compressions,
             ),
             idx=idx,
         )
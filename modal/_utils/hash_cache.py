@@ -0,0 +1,197 @@
+# Copyright Modal Labs 2024
+import dataclasses
+import json
+import os
+import sqlite3
+import threading
+import time
+from typing import Optional
+
+from ..config import _is_remote, config, logger
+from .hash_utils import UploadHashes
+
+# Files modified this recently aren't cached, since a change within the resolution of the file system's
+# timestamps wouldn't be noticed (the same problem as "racy git").
+RACY_MTIME_WINDOW_NS = 2_000_000_000
+
+# The least recently used entries beyond the size limit are evicted once this many entries have been added
+EVICTION_BATCH_SIZE = 1000
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS file_hashes (
+    path TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    ctime_ns INTEGER NOT NULL,
+    inode INTEGER NOT NULL,
+    hashes TEXT NOT NULL,
+    last_used REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS mount_manifests (
+    key TEXT PRIMARY KEY,
+    fingerprint TEXT NOT NULL,
+    files TEXT NOT NULL,
+    last_used REAL NOT NULL
+);
+"""
+
+# Max number of mount manifests that are kept, least recently used first out
+MAX_MOUNT_MANIFESTS = 1000
+
+
+class FileHashCache:
+    """Persistent cache of the upload hashes of local files, so unchanged files aren't read and hashed again.
+
+    Entries are keyed by absolute path, and are only used if the file's size, mtime, ctime and inode
+    are all unchanged. The cache is shared by concurrent threads and processes, and any error it runs
+    into disables it rather than failing the upload.
+
+    It also keeps the file list of each mount along with a fingerprint of its files, so that mounts
+    whose files haven't changed can be created without hashing or uploading anything.
+    """
+
+    def __init__(self, path: str, max_entries: int):
+        self.path = path
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._n_added = 0
+        self._db: Optional[sqlite3.Connection] = None
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            self._db = sqlite3.connect(path, timeout=5, check_same_thread=False, isolation_level=None)
+            # The cache can always be rebuilt, so durability is traded for speed
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute("PRAGMA synchronous=OFF")
+            self._db.executescript(_SCHEMA)
+        except (OSError, sqlite3.Error) as exc:
+            self._disable(exc)
+
+    def _disable(self, exc: Exception):
+        logger.debug(f"Disabling the file hash cache at {self.path}: {exc}")
+        if self._db is not None:
+            self._db.close()
+        self._db = None
+
+    @staticmethod
+    def _key(path: str, stat: os.stat_result) -> tuple:
+        return (os.path.abspath(path), stat.st_size, stat.st_mtime_ns, stat.st_ctime_ns, stat.st_ino)
+
+    def get(self, path: str, stat: os.stat_result) -> Optional[UploadHashes]:
+        with self._lock:
+            if self._db is None:
+                return None
+            abspath, *key = self._key(path, stat)
+            try:
+                row = self._db.execute(
+                    "SELECT size, mtime_ns, ctime_ns, inode, hashes FROM file_hashes WHERE path = ?", (abspath,)
+                ).fetchone()
+                if row is None or list(row[:4]) != key:
+                    self.misses += 1
+                    return None
+                self._db.execute("UPDATE file_hashes SET last_used = ? WHERE path = ?", (time.time(), abspath))
+            except sqlite3.Error as exc:
+                self._disable(exc)
+                return None
+        self.hits += 1
+        return UploadHashes(**json.loads(row[4]))
+
+    def put(self, path: str, stat: os.stat_result, hashes: UploadHashes) -> None:
+        if time.time_ns() - stat.st_mtime_ns < RACY_MTIME_WINDOW_NS:
+            return
+        with self._lock:
+            if self._db is None:
+                return
+            abspath, *key = self._key(path, stat)
+            try:
+                self._db.execute(
+                    "INSERT OR REPLACE INTO file_hashes VALUES (?, ?, ?, ?, ?, ?, ?)",
+                    (abspath, *key, json.dumps(dataclasses.asdict(hashes)), time.time()),
+                )
+                self._n_added += 1
+                if self._n_added >= EVICTION_BATCH_SIZE:
+                    self._evict()
+            except sqlite3.Error as exc:
+                self._disable(exc)
+
+    def _evict(self) -> None:
+        self._n_added = 0
+        assert self._db is not None
+        (n_entries,) = self._db.execute("SELECT COUNT(*) FROM file_hashes").fetchone()
+        if n_entries > self.max_entries:
+            self._db.execute(
+                "DELETE FROM file_hashes WHERE path IN (SELECT path FROM file_hashes ORDER BY last_used LIMIT ?)",
+                (n_entries - self.max_entries,),
+            )
+
+    def get_mount_manifest(self, key: str, fingerprint: str) -> Optional[list]:
+        """Returns the files of the mount that was last created for `key`, if its fingerprint is unchanged."""
+        with self._lock:
+            if self._db is None:
+                return None
+            try:
+                row = self._db.execute(
+                    "SELECT fingerprint, files FROM mount_manifests WHERE key = ?", (key,)
+                ).fetchone()
+                if row is None or row[0] != fingerprint:
+                    return None
+                self._db.execute("UPDATE mount_manifests SET last_used = ? WHERE key = ?", (time.time(), key))
+            except sqlite3.Error as exc:
+                self._disable(exc)
+                return None
+        return json.loads(row[1])
+
+    def put_mount_manifest(self, key: str, fingerprint: str, files: list) -> None:
+        with self._lock:
+            if self._db is None:
+                return
+            try:
+                self._db.execute(
+                    "INSERT OR REPLACE INTO mount_manifests VALUES (?, ?, ?, ?)",
+                    (key, fingerprint, json.dumps(files), time.time()),
+                )
+                self._db.execute(
+                    "DELETE FROM mount_manifests WHERE key NOT IN "
+                    "(SELECT key FROM mount_manifests ORDER BY last_used DESC LIMIT ?)",
+                    (MAX_MOUNT_MANIFESTS,),
+                )
+            except sqlite3.Error as exc:
+                self._disable(exc)
+
+    def remove_mount_manifest(self, key: str) -> None:
+        with self._lock:
+            if self._db is None:
+                return
+            try:
+                self._db.execute("DELETE FROM mount_manifests WHERE key = ?", (key,))
+            except sqlite3.Error as exc:
+                self._disable(exc)
+
+    def __len__(self) -> int:
+        with self._lock:
+            if self._db is None:
+                return 0
+            return self._db.execute("SELECT COUNT(*) FROM file_hashes").fetchone()[0]
+
+    def close(self) -> None:
+        with self._lock:
+            if self._db is not None:
+                self._db.close()
+                self._db = None
+
+
+_hash_cache: Optional[FileHashCache] = None
+_hash_cache_lock = threading.Lock()
+
+
+def get_hash_cache() -> Optional[FileHashCache]:
+    """Returns the process-wide file hash cache, or None if it's disabled."""
+    global _hash_cache
+    if not config["hash_cache"] or _is_remote():
+        return None
+    path = os.path.expanduser(config["hash_cache_path"])
+    with _hash_cache_lock:
+        if _hash_cache is None or _hash_cache.path != path:
+            _hash_cache = FileHashCache(path, config["hash_cache_max_entries"])
+        return _hash_cache
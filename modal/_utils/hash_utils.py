@@ -3,7 +3,7 @@ import base64
 import dataclasses
 import hashlib
 import time
-from typing import BinaryIO, Callable, Optional, Sequence, Union
+from typing import Any, BinaryIO, Callable, Optional, Sequence, Union
 
 from modal.config import logger
 
@@ -52,10 +52,38 @@ def get_md5_base64(data: Union[bytes, BinaryIO]) -> str:
     return base64.b64encode(hasher.digest()).decode("utf-8")
 
 
+class _PartMD5Hasher:
+    """Computes the md5 of each consecutive part of a fixed length, from a single stream of data."""
+
+    def __init__(self, part_length: int):
+        self.part_length = part_length
+        self._md5s: list[str] = []
+        self._current = hashlib.md5()
+        self._current_length = 0
+
+    def update(self, data: bytes) -> None:
+        view = memoryview(data)
+        while view:
+            n = min(len(view), self.part_length - self._current_length)
+            self._current.update(view[:n])
+            self._current_length += n
+            view = view[n:]
+            if self._current_length == self.part_length:
+                self._md5s.append(self._current.hexdigest())
+                self._current = hashlib.md5()
+                self._current_length = 0
+
+    def hexdigests(self) -> list[str]:
+        return self._md5s + ([self._current.hexdigest()] if self._current_length else [])
+
+
 @dataclasses.dataclass
 class UploadHashes:
     md5_base64: str
     sha256_base64: str
+    # For multipart uploads, the md5 of each part of this length, so they aren't computed while uploading
+    part_length: int = 0
+    part_md5s_hex: list[str] = dataclasses.field(default_factory=list)
 
     def md5_hex(self) -> str:
         return base64.b64decode(self.md5_base64).hex()
@@ -65,10 +93,17 @@ class UploadHashes:
 
 
 def get_upload_hashes(
-    data: Union[bytes, BinaryIO], sha256_hex: Optional[str] = None, md5_hex: Optional[str] = None
+    data: Union[bytes, BinaryIO],
+    sha256_hex: Optional[str] = None,
+    md5_hex: Optional[str] = None,
+    part_length: int = 0,
 ) -> UploadHashes:
+    """Computes the hashes needed to upload data, in a single pass over it.
+
+    With a `part_length`, the md5 of each part of a multipart upload with parts of that length is computed too.
+    """
     t0 = time.monotonic()
-    hashers = {}
+    hashers: dict[str, Any] = {}
 
     if not sha256_hex:
         sha256 = hashlib.sha256()
@@ -76,6 +111,8 @@ def get_upload_hashes(
     if not md5_hex:
         md5 = hashlib.md5()
         hashers["md5"] = md5
+    if part_length:
+        hashers["parts"] = _PartMD5Hasher(part_length)
 
     if hashers:
         updaters = [h.update for h in hashers.values()]
@@ -95,6 +132,9 @@ def get_upload_hashes(
         md5_base64=md5_base64,
         sha256_base64=sha256_base64,
     )
+    if part_length:
+        hashes.part_length = part_length
+        hashes.part_md5s_hex = hashers["parts"].hexdigests()
 
     logger.debug("get_upload_hashes took %.3fs (%s)", time.monotonic() - t0, hashers.keys())
     return hashes
@@ -23,11 +23,12 @@ async def _volume_download(
     local_destination: Path,
     overwrite: bool,
     progress_cb: Callable,
+    concurrency: int = 10,
 ):
     is_pipe = local_destination == PIPE_PATH
 
     q: asyncio.Queue[tuple[Optional[Path], Optional[FileEntry]]] = asyncio.Queue()
-    num_consumers = 1 if is_pipe else 10  # concurrency limit for downloading files
+    num_consumers = 1 if is_pipe else concurrency  # concurrency limit for downloading files
 
     async def producer():
         iterator: AsyncIterator[FileEntry]
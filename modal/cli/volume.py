@@ -1,7 +1,7 @@
 # Copyright Modal Labs 2022
 import os
 import sys
-from pathlib import Path
+from pathlib import Path, PurePosixPath
 from typing import Optional
 
 import typer
@@ -15,7 +15,7 @@ import modal
 from modal._output import OutputManager, ProgressHandler
 from modal._utils.async_utils import synchronizer
 from modal._utils.grpc_utils import retry_transient_errors
-from modal.cli._download import _volume_download
+from modal.cli._download import PIPE_PATH, _volume_download
 from modal.cli.utils import ENV_OPTION, YES_OPTION, display_table, timestamp_to_local
 from modal.client import _Client
 from modal.environments import ensure_env
@@ -76,6 +76,8 @@ async def get(
     remote_path: str,
     local_destination: str = Argument("."),
     force: bool = False,
+    resume: bool = Option(False, help="Skip files that were already downloaded, and continue partial downloads."),
+    concurrency: int = Option(10, help="Number of files to download at once."),
     env: Optional[str] = ENV_OPTION,
 ):
     """Download files from a modal.Volume object.
@@ -88,6 +90,7 @@ async def get(
     ```
     modal volume get <volume_name> logs/april-12-1.txt
     modal volume get <volume_name> / volume_data_dump
+    modal volume get --resume <volume_name> checkpoints
     ```
 
     Use "-" as LOCAL_DESTINATION to write file contents to standard output.
@@ -97,8 +100,26 @@ async def get(
     volume = _Volume.from_name(volume_name, environment_name=env)
     console = Console()
     progress_handler = ProgressHandler(type="download", console=console)
+    if resume:
+        if destination == PIPE_PATH:
+            raise UsageError("--resume can't be used when writing to standard output")
+        if destination.is_dir():
+            destination = destination / PurePosixPath(remote_path.rstrip("/")).name
+        with progress_handler.live:
+            stats = await volume.download_dir(
+                remote_path, destination, concurrency=concurrency, progress_cb=progress_handler.progress
+            )
+        console.print(
+            OutputManager.step_completed(
+                f"Downloaded {stats.n_files} files ({stats.n_bytes / 1e6:.1f} MB at {stats.throughput / 1e6:.1f} MB/s)"
+                f" and skipped {stats.n_skipped} files that were already downloaded"
+            )
+        )
+        return
     with progress_handler.live:
-        await _volume_download(volume, remote_path, destination, force, progress_cb=progress_handler.progress)
+        await _volume_download(
+            volume, remote_path, destination, force, progress_cb=progress_handler.progress, concurrency=concurrency
+        )
     console.print(OutputManager.step_completed("Finished downloading files to local!"))
 
 
@@ -25,6 +25,7 @@ from modal_version import __version__
 from ._traceback import print_server_warnings
 from ._utils import async_utils
 from ._utils.async_utils import TaskContext, synchronize_api
+from ._utils.blob_utils import UploadedBlobCache
 from ._utils.grpc_utils import connect_channel, create_channel, retry_transient_errors
 from .config import _check_config, _is_remote, config, logger
 from .exception import AuthError, ClientClosed, ConnectionError
@@ -94,6 +95,7 @@ class _Client:
         self._stub: Optional[modal_api_grpc.ModalClientModal] = None
         self._snapshotted = False
         self._owner_pid = None
+        self._blob_cache = UploadedBlobCache()
 
     def is_closed(self) -> bool:
         return self._closed
@@ -63,6 +63,44 @@ Other possible configuration options are:
 * `traceback` (in the .toml file) / `MODAL_TRACEBACK` (as an env var).
   Defaults to False. Enables printing full tracebacks on unexpected CLI
   errors, which can be useful for debugging client issues.
+* `map_reorder_buffer_size` (in the .toml file) / `MODAL_MAP_REORDER_BUFFER_SIZE` (as an env var).
+  Defaults to 256 MiB. Number of bytes of out-of-order outputs an ordered `Function.map`
+  keeps in memory while waiting for earlier outputs. Outputs beyond this are spilled
+  to a temporary file.
+* `map_reorder_window` (in the .toml file) / `MODAL_MAP_REORDER_WINDOW` (as an env var).
+  Defaults to 1000000. Number of out-of-order outputs an ordered `Function.map` holds
+  on to before it pauses sending more inputs.
+* `map_serialization_threads` (in the .toml file) / `MODAL_MAP_SERIALIZATION_THREADS` (as an env var).
+  Defaults to 0. When set, `Function.map` pickles inputs on a pool of this many threads
+  instead of the event loop, which helps with large arguments (such as numpy arrays)
+  whose serialization releases the GIL.
+* `payload_compression` (in the .toml file) / `MODAL_PAYLOAD_COMPRESSION` (as an env var).
+  Defaults to False. When set, large function arguments that compress well are compressed
+  (with zstd if the `zstandard` package is installed, zlib otherwise) before they are sent,
+  and functions are asked to do the same for their results, if the other side supports it.
+* `blob_upload_parallelism` (in the .toml file) / `MODAL_BLOB_UPLOAD_PARALLELISM` (as an env var).
+  Defaults to 32. Maximum number of parts of large files and payloads that are uploaded at once,
+  shared between all uploads in the process.
+* `blob_upload_max_inflight_bytes` (in the .toml file) / `MODAL_BLOB_UPLOAD_MAX_INFLIGHT_BYTES` (as an env var).
+  Defaults to 512 MiB. Maximum number of bytes that parts being uploaded hold in memory at once.
+* `hash_cache` (in the .toml file) / `MODAL_HASH_CACHE` (as an env var).
+  Defaults to True. Caches the hashes of local files added to mounts and uploaded to volumes,
+  so files that haven't changed since they were last uploaded aren't read and hashed again,
+  and the file lists of mounts, so mounts whose files are all unchanged are created right away.
+* `hash_cache_path` (in the .toml file) / `MODAL_HASH_CACHE_PATH` (as an env var).
+  Location of the hash cache, by default `~/.cache/modal/hash-cache.sqlite3`.
+* `hash_cache_max_entries` (in the .toml file) / `MODAL_HASH_CACHE_MAX_ENTRIES` (as an env var).
+  Defaults to 200,000. The least recently used files are evicted from the hash cache beyond this.
+* `small_file_packing` (in the .toml file) / `MODAL_SMALL_FILE_PACKING` (as an env var).
+  Defaults to True. Small files added to mounts and uploaded to volumes are uploaded together in packs,
+  instead of with one request each, if the server supports it.
+* `output_batch_linger_ms` (in the .toml file) / `MODAL_OUTPUT_BATCH_LINGER_MS` (as an env var).
+  Defaults to 10. Containers running concurrent inputs wait this long for other inputs to finish,
+  so their outputs are sent together. Outputs are sent right away when no other inputs are running.
+* `input_prefetch` (in the .toml file) / `MODAL_INPUT_PREFETCH` (as an env var).
+  Defaults to 0. When set, containers fetch up to this many inputs ahead of time (fewer for functions
+  that take long compared to a round trip to the server), along with their arguments, so short functions
+  don't wait for the server between inputs.
 
 Meta-configuration
 ------------------
@@ -223,6 +261,18 @@ _SETTINGS = {
     "strict_parameters": _Setting(False, transform=_to_boolean),  # For internal/experimental use
     "snapshot_debug": _Setting(False, transform=_to_boolean),
     "client_retries": _Setting(False, transform=_to_boolean),  # For internal testing.
+    "map_reorder_buffer_size": _Setting(256 * 1024 * 1024, int),
+    "map_reorder_window": _Setting(1_000_000, int),
+    "map_serialization_threads": _Setting(0, int),
+    "payload_compression": _Setting(False, transform=_to_boolean),
+    "blob_upload_parallelism": _Setting(32, int),
+    "blob_upload_max_inflight_bytes": _Setting(512 * 1024 * 1024, int),
+    "hash_cache": _Setting(True, transform=_to_boolean),
+    "hash_cache_path": _Setting("~/.cache/modal/hash-cache.sqlite3"),
+    "hash_cache_max_entries": _Setting(200_000, int),
+    "small_file_packing": _Setting(True, transform=_to_boolean),
+    "output_batch_linger_ms": _Setting(10, float),
+    "input_prefetch": _Setting(0, int),
 }
 
 
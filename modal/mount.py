@@ -3,6 +3,8 @@ import abc
 import asyncio
 import concurrent.futures
 import dataclasses
+import hashlib
+import json
 import os
 import site
 import sys
@@ -14,6 +16,7 @@ from pathlib import Path, PurePosixPath
 from typing import Callable, Optional, Sequence, Union
 
 from google.protobuf.message import Message
+from grpclib import GRPCError, Status
 
 import modal.exception
 import modal.file_pattern_matcher
@@ -22,10 +25,17 @@ from modal_version import __version__
 
 from ._object import _get_environment_name, _Object
 from ._resolver import Resolver
-from ._utils.async_utils import aclosing, async_map, synchronize_api
-from ._utils.blob_utils import FileUploadSpec, blob_upload_file, get_file_upload_spec_from_path
+from ._utils.async_utils import TaskContext, aclosing, async_map, synchronize_api
+from ._utils.blob_utils import (
+    FileUploadSpec,
+    MountFileExistenceChecker,
+    MountFilePacker,
+    blob_upload_file,
+    get_file_upload_spec_from_path,
+)
 from ._utils.deprecation import deprecation_warning, renamed_parameter
 from ._utils.grpc_utils import retry_transient_errors
+from ._utils.hash_cache import RACY_MTIME_WINDOW_NS, get_hash_cache
 from ._utils.name_utils import check_object_name
 from ._utils.package_utils import get_module_mount_info
 from .client import _Client
@@ -102,6 +112,33 @@ def _select_files(entries: list[_MountEntry]) -> list[tuple[Path, PurePosixPath]
     return list(all_files)
 
 
+def _fingerprint_files(all_files: list[tuple[Path, PurePosixPath]]) -> Optional[str]:
+    """Fingerprints the metadata of the files of a mount, so changes to them can be detected without reading them.
+
+    Returns None if a file is missing, or was modified too recently for changes to it to be detected.
+    """
+    now = time.time_ns()
+    fingerprint = hashlib.sha256()
+    for local_filename, remote_filename in sorted(all_files):
+        try:
+            st = os.stat(local_filename)
+        except FileNotFoundError:
+            return None
+        if now - st.st_mtime_ns < RACY_MTIME_WINDOW_NS:
+            return None
+        metadata = [str(local_filename), remote_filename.as_posix(), st.st_size, st.st_mtime_ns, st.st_ctime_ns]
+        fingerprint.update(json.dumps([*metadata, st.st_ino, st.st_mode]).encode())
+    return fingerprint.hexdigest()
+
+
+def _mount_manifest_key(entries: list[_MountEntry], resolver: Resolver) -> str:
+    # File lists are only reused for the same workspace and environment, where their files were uploaded
+    credentials = resolver.client._credentials
+    token_id = credentials[0] if credentials else None
+    key = [resolver.client.server_url, token_id, resolver.environment_name, _Mount._description(entries)]
+    return hashlib.sha256(json.dumps(key).encode()).hexdigest()
+
+
 @dataclasses.dataclass
 class _MountFile(_MountEntry):
     local_file: Path
@@ -483,10 +520,13 @@ class _Mount(_Object, type_prefix="mo"):
         return ", ".join(local_contents)
 
     @staticmethod
-    async def _get_files(entries: list[_MountEntry]) -> AsyncGenerator[FileUploadSpec, None]:
+    async def _get_files(
+        entries: list[_MountEntry], all_files: Optional[list[tuple[Path, PurePosixPath]]] = None
+    ) -> AsyncGenerator[FileUploadSpec, None]:
         loop = asyncio.get_event_loop()
         with concurrent.futures.ThreadPoolExecutor() as exe:
-            all_files = await loop.run_in_executor(exe, _select_files, entries)
+            if all_files is None:
+                all_files = await loop.run_in_executor(exe, _select_files, entries)
 
             futs = []
             for local_filename, remote_filename in all_files:
@@ -507,14 +547,69 @@ class _Mount(_Object, type_prefix="mo"):
         existing_object_id: Optional[str],
     ):
         t0 = time.monotonic()
+        message_label = _Mount._description(self._entries)
+        status_row = resolver.add_status_row()
 
-        # Asynchronously list and checksum files with a thread pool, then upload them concurrently.
+        async def _get_or_create(files: list[api_pb2.MountFile]) -> api_pb2.MountGetOrCreateResponse:
+            status_row.message(f"Creating mount {message_label}: Finalizing index of {len(files)} files")
+            if self._deployment_name:
+                req = api_pb2.MountGetOrCreateRequest(
+                    deployment_name=self._deployment_name,
+                    namespace=self._namespace,
+                    environment_name=self._environment_name,
+                    object_creation_type=api_pb2.OBJECT_CREATION_TYPE_CREATE_FAIL_IF_EXISTS,
+                    files=files,
+                )
+            elif resolver.app_id is not None:
+                req = api_pb2.MountGetOrCreateRequest(
+                    object_creation_type=api_pb2.OBJECT_CREATION_TYPE_ANONYMOUS_OWNED_BY_APP,
+                    files=files,
+                    app_id=resolver.app_id,
+                )
+            else:
+                req = api_pb2.MountGetOrCreateRequest(
+                    object_creation_type=api_pb2.OBJECT_CREATION_TYPE_EPHEMERAL,
+                    files=files,
+                    environment_name=resolver.environment_name,
+                )
+            return await retry_transient_errors(resolver.client.stub.MountGetOrCreate, req, base_delay=1)
+
+        # If the files were all unchanged when this mount was last created, its file list is reused,
+        # without hashing or checking for any files.
+        loop = asyncio.get_running_loop()
+        all_files = await loop.run_in_executor(None, _select_files, self._entries)
+        hash_cache = get_hash_cache()
+        manifest_key = _mount_manifest_key(self._entries, resolver)
+        fingerprint: Optional[str] = None
+        manifest: Optional[list] = None
+        if hash_cache is not None:
+            fingerprint = await loop.run_in_executor(None, _fingerprint_files, all_files)
+            if fingerprint is not None:
+                manifest = hash_cache.get_mount_manifest(manifest_key, fingerprint)
+        if manifest is not None:
+            assert hash_cache is not None
+            cached_files = [api_pb2.MountFile(filename=f, sha256_hex=sha, mode=mode) for f, sha, mode in manifest]
+            try:
+                resp = await _get_or_create(cached_files)
+            except GRPCError as exc:
+                if exc.status == Status.ALREADY_EXISTS:
+                    raise
+                # E.g. the server no longer has some of the files, so they're checked and uploaded as usual
+                logger.debug(f"Couldn't create mount {message_label} from its cached file list: {exc}")
+                hash_cache.remove_mount_manifest(manifest_key)
+            else:
+                status_row.finish(f"Created mount {message_label}")
+                logger.debug(f"Created mount {message_label} from its cached file list in {time.monotonic() - t0}s")
+                self._hydrate(resp.mount_id, resolver.client, resp.handle_metadata)
+                return
+
+        # Asynchronously checksum files with a thread pool, then upload them concurrently.
         n_seen, n_finished = 0, 0
         total_uploads, total_bytes = 0, 0
         accounted_hashes: set[str] = set()
-        message_label = _Mount._description(self._entries)
         blob_upload_concurrency = asyncio.Semaphore(16)  # Limit uploads of large files.
-        status_row = resolver.add_status_row()
+        existence_checker: MountFileExistenceChecker  # created along with the packer, in the TaskContext below
+        packer: Optional[MountFilePacker] = None
 
         async def _put_file(file_spec: FileUploadSpec) -> api_pb2.MountFile:
             nonlocal n_seen, n_finished, total_uploads, total_bytes
@@ -532,11 +627,8 @@ class _Mount(_Object, type_prefix="mo"):
                 n_finished += 1
                 return mount_file
 
-            request = api_pb2.MountPutFileRequest(sha256_hex=file_spec.sha256_hex)
             accounted_hashes.add(file_spec.sha256_hex)
-            response = await retry_transient_errors(resolver.client.stub.MountPutFile, request, base_delay=1)
-
-            if response.exists:
+            if await existence_checker.exists(file_spec.sha256_hex):
                 n_finished += 1
                 return mount_file
 
@@ -548,7 +640,11 @@ class _Mount(_Object, type_prefix="mo"):
                 async with blob_upload_concurrency:
                     with file_spec.source() as fp:
                         blob_id = await blob_upload_file(
-                            fp, resolver.client.stub, sha256_hex=file_spec.sha256_hex, md5_hex=file_spec.md5_hex
+                            fp,
+                            resolver.client.stub,
+                            sha256_hex=file_spec.sha256_hex,
+                            md5_hex=file_spec.md5_hex,
+                            part_md5s_hex=file_spec.part_md5s_hex,
                         )
                 logger.debug(f"Uploading blob file {file_spec.source_description} as {remote_filename}")
                 request2 = api_pb2.MountPutFileRequest(data_blob_id=blob_id, sha256_hex=file_spec.sha256_hex)
@@ -556,7 +652,12 @@ class _Mount(_Object, type_prefix="mo"):
                 logger.debug(
                     f"Uploading file {file_spec.source_description} to {remote_filename} ({file_spec.size} bytes)"
                 )
-                request2 = api_pb2.MountPutFileRequest(data=file_spec.content, sha256_hex=file_spec.sha256_hex)
+                if packer is not None and await packer.put(
+                    file_spec.sha256_hex, file_spec.size, file_spec.read_content
+                ):
+                    n_finished += 1
+                    return mount_file
+                request2 = api_pb2.MountPutFileRequest(data=file_spec.read_content(), sha256_hex=file_spec.sha256_hex)
 
             start_time = time.monotonic()
             while time.monotonic() - start_time < MOUNT_PUT_FILE_CLIENT_TIMEOUT:
@@ -570,40 +671,25 @@ class _Mount(_Object, type_prefix="mo"):
         # Upload files, or check if they already exist.
         n_concurrent_uploads = 512
         files: list[api_pb2.MountFile] = []
-        async with aclosing(
-            async_map(_Mount._get_files(self._entries), _put_file, concurrency=n_concurrent_uploads)
-        ) as stream:
-            async for file in stream:
-                files.append(file)
+        async with TaskContext() as tc:
+            existence_checker = MountFileExistenceChecker(resolver.client.stub, tc)
+            if config["small_file_packing"]:
+                packer = MountFilePacker(resolver.client.stub, tc)
+            async with aclosing(
+                async_map(_Mount._get_files(self._entries, all_files), _put_file, concurrency=n_concurrent_uploads)
+            ) as stream:
+                async for file in stream:
+                    files.append(file)
 
         if not files:
             logger.warning(f"Mount of '{message_label}' is empty.")
 
         # Build the mount.
-        status_row.message(f"Creating mount {message_label}: Finalizing index of {len(files)} files")
-        if self._deployment_name:
-            req = api_pb2.MountGetOrCreateRequest(
-                deployment_name=self._deployment_name,
-                namespace=self._namespace,
-                environment_name=self._environment_name,
-                object_creation_type=api_pb2.OBJECT_CREATION_TYPE_CREATE_FAIL_IF_EXISTS,
-                files=files,
-            )
-        elif resolver.app_id is not None:
-            req = api_pb2.MountGetOrCreateRequest(
-                object_creation_type=api_pb2.OBJECT_CREATION_TYPE_ANONYMOUS_OWNED_BY_APP,
-                files=files,
-                app_id=resolver.app_id,
-            )
-        else:
-            req = api_pb2.MountGetOrCreateRequest(
-                object_creation_type=api_pb2.OBJECT_CREATION_TYPE_EPHEMERAL,
-                files=files,
-                environment_name=resolver.environment_name,
-            )
-
-        resp = await retry_transient_errors(resolver.client.stub.MountGetOrCreate, req, base_delay=1)
+        resp = await _get_or_create(files)
         status_row.finish(f"Created mount {message_label}")
+        if hash_cache is not None and fingerprint is not None:
+            manifest = [[f.filename, f.sha256_hex, f.mode] for f in files]
+            hash_cache.put_mount_manifest(manifest_key, fingerprint, manifest)
 
         logger.debug(f"Uploaded {total_uploads} new files and {total_bytes} bytes in {time.monotonic() - t0}s")
         self._hydrate(resp.mount_id, resolver.client, resp.handle_metadata)
@@ -21,10 +21,16 @@ from ._object import (
 )
 from ._resolver import Resolver
 from ._utils.async_utils import TaskContext, aclosing, async_map, sync_or_async_iter, synchronize_api
-from ._utils.blob_utils import LARGE_FILE_LIMIT, blob_iter, blob_upload_file
+from ._utils.blob_utils import (
+    LARGE_FILE_LIMIT,
+    MULTIPART_UPLOAD_THRESHOLD,
+    blob_iter,
+    blob_upload_file,
+    get_multipart_part_length,
+)
 from ._utils.deprecation import deprecation_warning, renamed_parameter
 from ._utils.grpc_utils import retry_transient_errors
-from ._utils.hash_utils import get_sha256_hex
+from ._utils.hash_utils import get_upload_hashes
 from ._utils.name_utils import check_object_name
 from .client import _Client
 from .exception import InvalidError
@@ -240,23 +246,27 @@ class _NetworkFileSystem(_Object, type_prefix="sv"):
         """
         progress_cb = progress_cb or (lambda *_, **__: None)
 
-        sha_hash = get_sha256_hex(fp)
         fp.seek(0, os.SEEK_END)
         data_size = fp.tell()
         fp.seek(0)
         if data_size > LARGE_FILE_LIMIT:
+            # All hashes needed for the upload are computed in a single pass over the file
+            part_length = get_multipart_part_length(data_size) if data_size > MULTIPART_UPLOAD_THRESHOLD else 0
+            hashes = get_upload_hashes(fp, part_length=part_length)
             progress_task_id = progress_cb(name=remote_path, size=data_size)
             blob_id = await blob_upload_file(
                 fp,
                 self._client.stub,
                 progress_report_cb=functools.partial(progress_cb, progress_task_id),
-                sha256_hex=sha_hash,
+                sha256_hex=hashes.sha256_hex(),
+                md5_hex=hashes.md5_hex(),
+                part_md5s_hex=hashes.part_md5s_hex,
             )
             req = api_pb2.SharedVolumePutFileRequest(
                 shared_volume_id=self.object_id,
                 path=remote_path,
                 data_blob_id=blob_id,
-                sha256_hex=sha_hash,
+                sha256_hex=hashes.sha256_hex(),
                 resumable=True,
             )
         else:
@@ -287,7 +297,7 @@ class _NetworkFileSystem(_Object, type_prefix="sv"):
             yield response.data
         else:
             async for data in blob_iter(response.data_blob_id, self._client.stub):
-                yield data
+                yield bytes(data)  # the ranges are downloaded into mutable buffers
 
     @live_method_gen
     async def iterdir(self, path: str) -> AsyncIterator[FileEntry]:
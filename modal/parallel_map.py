@@ -1,5 +1,7 @@
 # Copyright Modal Labs 2024
 import asyncio
+import concurrent.futures
+import tempfile
 import time
 import typing
 from dataclasses import dataclass
@@ -8,19 +10,21 @@ from typing import Any, Callable, Optional
 from grpclib import GRPCError, Status
 
 from modal._runtime.execution_context import current_input_id
+from modal._serialization import SUPPORTED_OUTPUT_FORMATS, pre_serialize
 from modal._utils.async_utils import (
     AsyncOrSyncIterable,
+    TaskContext,
     aclosing,
     async_map_ordered,
     async_merge,
     async_zip,
-    queue_batch_iterator,
     sync_or_async_iter,
     synchronize_api,
     synchronizer,
     warn_if_generator_is_not_consumed,
 )
 from modal._utils.blob_utils import BLOB_MAX_PARALLELISM
+from modal._utils.compression_utils import supported_compressions
 from modal._utils.function_utils import (
     ATTEMPT_TIMEOUT_GRACE_PERIOD,
     OUTPUTS_TIMEOUT,
@@ -28,7 +32,7 @@ from modal._utils.function_utils import (
     _process_result,
 )
 from modal._utils.grpc_utils import retry_transient_errors
-from modal.config import logger
+from modal.config import config, logger
 from modal_proto import api_pb2
 
 if typing.TYPE_CHECKING:
@@ -62,7 +66,195 @@ class _OutputValue:
     value: Any
 
 
-MAP_INVOCATION_CHUNK_SIZE = 49
+MAP_INVOCATION_CHUNK_SIZE = 49  # max number of inputs in a single FunctionPutInputs request
+MAP_INVOCATION_MAX_BATCH_BYTES = 16 * 1024 * 1024  # max serialized size of a single FunctionPutInputs request
+MAP_INVOCATION_MAX_INFLIGHT_REQUESTS = 8
+MAP_INVOCATION_TARGET_LATENCY = 0.5  # seconds per FunctionPutInputs request before we start backing off
+MAP_INVOCATION_DEBOUNCE_TIME = 0.015  # seconds
+
+
+class _InputPumpController:
+    """mdmd:hidden
+    Flow control for pushing map inputs to the server.
+
+    Keeps a congestion window of inputs that may be in flight across concurrent `FunctionPutInputs`
+    requests, and adjusts it AIMD-style (additive increase, multiplicative decrease): the window grows
+    by about one batch per round trip while requests are fast, and shrinks when request latency exceeds
+    the target or the server pushes back with `RESOURCE_EXHAUSTED`. Batches are further capped by
+    serialized size, so large payloads are sent in fewer items per request.
+    """
+
+    def __init__(
+        self,
+        max_batch_size: int = MAP_INVOCATION_CHUNK_SIZE,
+        max_batch_bytes: int = MAP_INVOCATION_MAX_BATCH_BYTES,
+        max_inflight_requests: int = MAP_INVOCATION_MAX_INFLIGHT_REQUESTS,
+        target_latency: float = MAP_INVOCATION_TARGET_LATENCY,
+        base_backoff: float = 0.1,
+        max_backoff: float = 15.0,
+    ):
+        self.max_batch_size = max_batch_size
+        self.max_batch_bytes = max_batch_bytes
+        self.max_window = float(max_batch_size * max_inflight_requests)
+        self.target_latency = target_latency
+        self.base_backoff = base_backoff
+        self.max_backoff = max_backoff
+
+        # Start out with a single full batch in flight, which is equivalent to a fixed-size sender.
+        self.window = float(max_batch_size)
+        self.backoff = base_backoff
+        self.latency: Optional[float] = None  # exponentially weighted moving average, in seconds
+
+        self.n_requests = 0
+        self.n_inputs = 0
+        self.n_bytes = 0
+        self.n_backpressure = 0
+
+        self._inflight = 0
+        self._cond = asyncio.Condition()
+
+    @property
+    def batch_size(self) -> int:
+        return max(1, min(self.max_batch_size, int(self.window)))
+
+    @property
+    def inflight(self) -> int:
+        return self._inflight
+
+    async def acquire(self, n_inputs: int):
+        """Wait until there is room in the window for `n_inputs` more inputs.
+
+        A batch is always allowed through when nothing is in flight, so a window smaller
+        than the batch can never stall the pump.
+        """
+        async with self._cond:
+            await self._cond.wait_for(lambda: self._inflight == 0 or self._inflight + n_inputs <= self.window)
+            self._inflight += n_inputs
+
+    async def release(self, n_inputs: int):
+        async with self._cond:
+            self._inflight -= n_inputs
+            self._cond.notify_all()
+
+    def on_success(self, n_inputs: int, n_bytes: int, latency: float):
+        self.n_requests += 1
+        self.n_inputs += n_inputs
+        self.n_bytes += n_bytes
+        self.backoff = self.base_backoff
+        self.latency = latency if self.latency is None else 0.8 * self.latency + 0.2 * latency
+        if latency > self.target_latency:
+            self.window = max(1.0, self.window * 0.75)
+        else:
+            # Grows by roughly one full batch per window's worth of acknowledged inputs.
+            self.window = min(self.max_window, self.window + n_inputs * self.max_batch_size / self.window)
+
+    def on_backpressure(self) -> float:
+        """Shrink the window after a `RESOURCE_EXHAUSTED` response and return how long to wait before retrying."""
+        self.n_backpressure += 1
+        self.window = max(1.0, self.window / 2)
+        delay = self.backoff
+        self.backoff = min(self.max_backoff, self.backoff * 2)
+        return delay
+
+    async def batches(
+        self, q: asyncio.Queue, debounce_time: float = MAP_INVOCATION_DEBOUNCE_TIME
+    ) -> typing.AsyncGenerator[tuple[list[api_pb2.FunctionPutInputsItem], int], None]:
+        """Read inputs from a queue into batches sized by the current window and serialized byte volume.
+
+        Like `queue_batch_iterator`, treats a None value as the end of the queue.
+        """
+        items: list[api_pb2.FunctionPutInputsItem] = []
+        n_bytes = 0
+
+        while True:
+            if q.empty() and items:
+                yield items, n_bytes
+                items, n_bytes = [], 0
+                await asyncio.sleep(debounce_time)
+
+            item = await q.get()
+            if item is None:
+                if items:
+                    yield items, n_bytes
+                break
+
+            item_bytes = item.ByteSize()
+            if items and (len(items) >= self.batch_size or n_bytes + item_bytes > self.max_batch_bytes):
+                yield items, n_bytes
+                items, n_bytes = [], 0
+            items.append(item)
+            n_bytes += item_bytes
+
+
+class _OutputReorderBuffer:
+    """mdmd:hidden
+    Holds map outputs that arrived before the next output in order can be yielded.
+
+    Outputs are kept as undecoded `FunctionGetOutputsItem` messages, so results are only downloaded and
+    deserialized once they can be yielded. Once more than `max_memory_bytes` are held in memory,
+    further outputs are spilled to a temporary file until the straggler they are waiting on arrives.
+    """
+
+    def __init__(self, max_memory_bytes: int):
+        self.max_memory_bytes = max_memory_bytes
+        self.next_idx = 0
+        self.memory_bytes = 0
+        self.n_spilled = 0  # total number of outputs ever spilled to disk
+
+        self._in_memory: dict[int, api_pb2.FunctionGetOutputsItem] = {}
+        self._spilled: dict[int, tuple[int, int]] = {}  # idx -> (offset, length) in the spill file
+        self._spill_file: Optional[typing.IO[bytes]] = None
+        self._spill_file_size = 0
+
+    def __len__(self) -> int:
+        return len(self._in_memory) + len(self._spilled)
+
+    def __contains__(self, idx: int) -> bool:
+        return idx in self._in_memory or idx in self._spilled
+
+    def put(self, item: api_pb2.FunctionGetOutputsItem):
+        if item.idx < self.next_idx or item.idx in self:
+            return  # duplicate output
+
+        item_bytes = item.ByteSize()
+        if self.memory_bytes + item_bytes <= self.max_memory_bytes or item.idx == self.next_idx:
+            self._in_memory[item.idx] = item
+            self.memory_bytes += item_bytes
+            return
+
+        if self._spill_file is None:
+            self._spill_file = tempfile.TemporaryFile(prefix="modal-map-")
+        data = item.SerializeToString()
+        self._spill_file.seek(self._spill_file_size)
+        self._spill_file.write(data)
+        self._spilled[item.idx] = (self._spill_file_size, len(data))
+        self._spill_file_size += len(data)
+        self.n_spilled += 1
+
+    def pop_ready(self) -> typing.Iterator[api_pb2.FunctionGetOutputsItem]:
+        """Yield all outputs that are next in order, in order."""
+        while self.next_idx in self:
+            if self.next_idx in self._in_memory:
+                item = self._in_memory.pop(self.next_idx)
+                self.memory_bytes -= item.ByteSize()
+            else:
+                assert self._spill_file is not None
+                offset, length = self._spilled.pop(self.next_idx)
+                self._spill_file.seek(offset)
+                item = api_pb2.FunctionGetOutputsItem()
+                item.ParseFromString(self._spill_file.read(length))
+                if not self._spilled:
+                    # Everything spilled has been read back, so we can reuse the file from the start
+                    self._spill_file.truncate(0)
+                    self._spill_file_size = 0
+            self.next_idx += 1
+            yield item
+
+    def close(self):
+        if self._spill_file is not None:
+            self._spill_file.close()
+            self._spill_file = None
+
 
 if typing.TYPE_CHECKING:
     import modal.functions
@@ -75,6 +267,7 @@ async def _map_invocation(
     order_outputs: bool,
     return_exceptions: bool,
     count_update_callback: Optional[Callable[[int, int], None]],
+    raw: bool = False,
 ):
     assert client.stub
     request = api_pb2.FunctionMapRequest(
@@ -99,13 +292,47 @@ async def _map_invocation(
     completed_outputs: set[str] = set()  # Set of input_ids whose outputs are complete (expecting no more values)
 
     input_queue: asyncio.Queue = asyncio.Queue()
+    controller = _InputPumpController()
+    # Input submission is paused while too many outputs are waiting to be reordered
+    max_reorder_window: int = config["map_reorder_window"]
+    output_window_open = asyncio.Event()
+    output_window_open.set()
+    last_backpressure_warning: Optional[float] = None
+
+    serializer: Optional[concurrent.futures.ThreadPoolExecutor] = None
+    if (serialization_threads := config["map_serialization_threads"]) > 0:
+        serializer = concurrent.futures.ThreadPoolExecutor(
+            serialization_threads, thread_name_prefix="modal-map-serializer"
+        )
+
+    input_data_format = function._get_input_data_format()
+
+    # The same kwargs are passed with every input, so they are only pickled once per map call. Containers that
+    # accept DATA_FORMAT_PICKLE_OOB are recent enough to decode them once as well.
+    share_kwargs = input_data_format == api_pb2.DATA_FORMAT_PICKLE_OOB
+    shared_kwargs: Optional[tuple[dict[str, Any], Any]] = None  # (kwargs, pre-serialized kwargs)
 
     async def create_input(argskwargs):
-        nonlocal num_inputs
+        nonlocal num_inputs, shared_kwargs
         idx = num_inputs
         num_inputs += 1
         (args, kwargs) = argskwargs
-        return await _create_input(args, kwargs, client, idx=idx, method_name=function._use_method_name)
+        if kwargs and share_kwargs:
+            if shared_kwargs is None or shared_kwargs[0] is not kwargs:
+                shared_kwargs = (kwargs, pre_serialize(kwargs) or kwargs)
+            kwargs = shared_kwargs[1]
+        return await _create_input(
+            args,
+            kwargs,
+            client,
+            idx=idx,
+            method_name=function._use_method_name,
+            executor=serializer,
+            data_format=input_data_format,
+            output_formats=() if raw else SUPPORTED_OUTPUT_FORMATS,  # raw outputs are always pickled
+            compressions=function._supported_input_compressions,
+            output_compressions=supported_compressions(),
+        )
 
     async def input_iter():
         while 1:
@@ -126,43 +353,69 @@ async def _map_invocation(
         await input_queue.put(None)
         yield
 
-    async def pump_inputs():
+    async def push_inputs(items: list[api_pb2.FunctionPutInputsItem], n_bytes: int):
         assert client.stub
-        nonlocal have_all_inputs, num_inputs
-        async for items in queue_batch_iterator(input_queue, MAP_INVOCATION_CHUNK_SIZE):
-            request = api_pb2.FunctionPutInputsRequest(
-                function_id=function.object_id, inputs=items, function_call_id=function_call_id
-            )
-            logger.debug(
-                f"Pushing {len(items)} inputs to server. Num queued inputs awaiting push is {input_queue.qsize()}."
-            )
-            while True:
-                try:
-                    resp = await retry_transient_errors(
-                        client.stub.FunctionPutInputs,
-                        request,
-                        # with 8 retries we log the warning below about every 30 secondswhich isn't too spammy.
-                        max_retries=8,
-                        max_delay=15,
-                        additional_status_codes=[Status.RESOURCE_EXHAUSTED],
-                    )
-                    break
-                except GRPCError as err:
-                    if err.status != Status.RESOURCE_EXHAUSTED:
-                        raise err
+        request = api_pb2.FunctionPutInputsRequest(
+            function_id=function.object_id, inputs=items, function_call_id=function_call_id
+        )
+        nonlocal last_backpressure_warning
+        while True:
+            t0 = time.monotonic()
+            try:
+                resp = await retry_transient_errors(client.stub.FunctionPutInputs, request, max_retries=8, max_delay=15)
+                break
+            except GRPCError as err:
+                if err.status != Status.RESOURCE_EXHAUSTED:
+                    raise err
+                delay = controller.on_backpressure()
+                # only warn about every 30 seconds, to avoid being spammy
+                if last_backpressure_warning is None or time.monotonic() - last_backpressure_warning > 30:
+                    last_backpressure_warning = time.monotonic()
                     logger.warning(
                         f"Warning: map progress for function {function._function_name} is limited."
                         " Common bottlenecks include slow iteration over results, or function backlogs."
                     )
+                await asyncio.sleep(delay)
 
-            count_update()
-            for item in resp.inputs:
-                pending_outputs.setdefault(item.input_id, 0)
-            logger.debug(
-                f"Successfully pushed {len(items)} inputs to server. "
-                f"Num queued inputs awaiting push is {input_queue.qsize()}."
-            )
+        controller.on_success(len(items), n_bytes, time.monotonic() - t0)
+        count_update()
+        for item in resp.inputs:
+            pending_outputs.setdefault(item.input_id, 0)
+        logger.debug(
+            f"Successfully pushed {len(items)} inputs ({n_bytes} bytes) to server. "
+            f"Num queued inputs awaiting push is {input_queue.qsize()}, window is {controller.window:.1f} inputs."
+        )
 
+    async def pump_inputs():
+        nonlocal have_all_inputs
+        async with TaskContext() as tc:
+            push_tasks: set[asyncio.Task] = set()
+
+            async def push_and_release(items, n_bytes):
+                try:
+                    await push_inputs(items, n_bytes)
+                finally:
+                    await controller.release(len(items))
+
+            async for items, n_bytes in controller.batches(input_queue):
+                await output_window_open.wait()
+                await controller.acquire(len(items))
+                for task in [t for t in push_tasks if t.done()]:
+                    push_tasks.discard(task)
+                    task.result()  # propagate errors from earlier requests
+                logger.debug(
+                    f"Pushing {len(items)} inputs to server ({controller.inflight} in flight). "
+                    f"Num queued inputs awaiting push is {input_queue.qsize()}."
+                )
+                push_tasks.add(tc.create_task(push_and_release(items, n_bytes)))
+
+            if push_tasks:
+                await asyncio.gather(*push_tasks)
+
+        logger.debug(
+            f"Pushed {controller.n_inputs} inputs ({controller.n_bytes} bytes) in {controller.n_requests} requests, "
+            f"backpressure events: {controller.n_backpressure}"
+        )
         have_all_inputs = True
         yield
 
@@ -218,7 +471,7 @@ async def _map_invocation(
 
     async def fetch_output(item: api_pb2.FunctionGetOutputsItem) -> tuple[int, Any]:
         try:
-            output = await _process_result(item.result, item.data_format, client.stub, client)
+            output = await _process_result(item.result, item.data_format, client.stub, client, raw=raw)
         except Exception as e:
             if return_exceptions:
                 output = e
@@ -226,32 +479,42 @@ async def _map_invocation(
                 raise e
         return (item.idx, output)
 
-    async def poll_outputs():
-        # map to store out-of-order outputs received
-        received_outputs = {}
-        output_idx = 0
+    async def get_all_outputs_in_order():
+        # hold on to outputs for function maps, so we can reorder them correctly.
+        reorder_buffer = _OutputReorderBuffer(config["map_reorder_buffer_size"])
+        try:
+            async with aclosing(get_all_outputs_and_clean_up()) as output_items:
+                async for item in output_items:
+                    reorder_buffer.put(item)
+                    if len(reorder_buffer) >= max_reorder_window:
+                        output_window_open.clear()
+                    for ready_item in reorder_buffer.pop_ready():
+                        yield ready_item
+                    if len(reorder_buffer) < max_reorder_window:
+                        output_window_open.set()
+            assert len(reorder_buffer) == 0
+        finally:
+            if reorder_buffer.n_spilled:
+                logger.debug(f"Spilled {reorder_buffer.n_spilled} out-of-order outputs to disk")
+            reorder_buffer.close()
 
+    async def poll_outputs():
+        output_items = get_all_outputs_in_order() if order_outputs else get_all_outputs_and_clean_up()
         async with aclosing(
-            async_map_ordered(get_all_outputs_and_clean_up(), fetch_output, concurrency=BLOB_MAX_PARALLELISM)
+            async_map_ordered(output_items, fetch_output, concurrency=BLOB_MAX_PARALLELISM)
         ) as streamer:
-            async for idx, output in streamer:
+            async for _, output in streamer:
                 count_update()
-                if not order_outputs:
-                    yield _OutputValue(output)
-                else:
-                    # hold on to outputs for function maps, so we can reorder them correctly.
-                    received_outputs[idx] = output
-                    while output_idx in received_outputs:
-                        output = received_outputs.pop(output_idx)
-                        yield _OutputValue(output)
-                        output_idx += 1
+                yield _OutputValue(output)
 
-        assert len(received_outputs) == 0
-
-    async with aclosing(async_merge(drain_input_generator(), pump_inputs(), poll_outputs())) as streamer:
-        async for response in streamer:
-            if response is not None:
-                yield response.value
+    try:
+        async with aclosing(async_merge(drain_input_generator(), pump_inputs(), poll_outputs())) as streamer:
+            async for response in streamer:
+                if response is not None:
+                    yield response.value
+    finally:
+        if serializer is not None:
+            serializer.shutdown(wait=False)
 
 
 @warn_if_generator_is_not_consumed(function_name="Function.map")
@@ -261,6 +524,7 @@ def _map_sync(
     kwargs={},  # any extra keyword arguments for the function
     order_outputs: bool = True,  # return outputs in order
     return_exceptions: bool = False,  # propagate exceptions (False) or aggregate them in the results list (True)
+    raw: bool = False,  # return serialized outputs as bytes without deserializing them
 ) -> AsyncOrSyncIterable:
     """Parallel map over a set of inputs.
 
@@ -297,11 +561,26 @@ def _map_sync(
         # [0, 1, UserCodeException(Exception('ohno'))]
         print(list(my_func.map(range(3), return_exceptions=True)))
     ```
+
+    Set `raw=True` to get each result as serialized `bytes` instead, skipping deserialization. This
+    is useful for pipelines that pass results on, e.g. to storage, without inspecting them.
+
+    Inputs are serialized and uploaded in the background while the iterators are consumed, and large
+    buffers such as numpy arrays are uploaded straight from their memory. Objects that the iterators
+    yield shouldn't be modified or reused afterwards, or the function may receive the changed values.
+
+    `kwargs` are decoded once per container, and the same objects are passed to every input that
+    runs there, so they shouldn't be modified by the function.
     """
 
     return AsyncOrSyncIterable(
         _map_async(
-            self, *input_iterators, kwargs=kwargs, order_outputs=order_outputs, return_exceptions=return_exceptions
+            self,
+            *input_iterators,
+            kwargs=kwargs,
+            order_outputs=order_outputs,
+            return_exceptions=return_exceptions,
+            raw=raw,
         ),
         nested_async_message=(
             "You can't iter(Function.map()) or Function.for_each() from an async function. "
@@ -319,6 +598,7 @@ async def _map_async(
     kwargs={},  # any extra keyword arguments for the function
     order_outputs: bool = True,  # return outputs in order
     return_exceptions: bool = False,  # propagate exceptions (False) or aggregate them in the results list (True)
+    raw: bool = False,  # return serialized outputs as bytes without deserializing them
 ) -> typing.AsyncGenerator[Any, None]:
     """mdmd:hidden
     This runs in an event loop on the main thread
@@ -347,7 +627,7 @@ async def _map_async(
         # they accept executable code in the form of
         # iterators that we don't want to run inside the synchronicity thread.
         # Instead, we delegate to `._map()` with a safer Queue as input
-        async with aclosing(self._map.aio(raw_input_queue, order_outputs, return_exceptions)) as map_output_stream:
+        async with aclosing(self._map.aio(raw_input_queue, order_outputs, return_exceptions, raw)) as map_output_stream:
             async for output in map_output_stream:
                 yield output
     finally:
@@ -380,6 +660,7 @@ async def _starmap_async(
     kwargs={},
     order_outputs: bool = True,
     return_exceptions: bool = False,
+    raw: bool = False,
 ) -> typing.AsyncIterable[Any]:
     raw_input_queue: Any = SynchronizedQueue()  # type: ignore
     raw_input_queue.init()
@@ -393,7 +674,7 @@ async def _starmap_async(
 
     feed_input_task = asyncio.create_task(feed_queue())
     try:
-        async for output in self._map.aio(raw_input_queue, order_outputs, return_exceptions):  # type: ignore[reportFunctionMemberAccess]
+        async for output in self._map.aio(raw_input_queue, order_outputs, return_exceptions, raw):  # type: ignore[reportFunctionMemberAccess]
             yield output
     finally:
         feed_input_task.cancel()  # should only be needed in case of exceptions
@@ -406,6 +687,7 @@ def _starmap_sync(
     kwargs={},
     order_outputs: bool = True,
     return_exceptions: bool = False,
+    raw: bool = False,
 ) -> AsyncOrSyncIterable:
     """Like `map`, but spreads arguments over multiple function arguments.
 
@@ -425,7 +707,12 @@ def _starmap_sync(
     """
     return AsyncOrSyncIterable(
         _starmap_async(
-            self, input_iterator, kwargs=kwargs, order_outputs=order_outputs, return_exceptions=return_exceptions
+            self,
+            input_iterator,
+            kwargs=kwargs,
+            order_outputs=order_outputs,
+            return_exceptions=return_exceptions,
+            raw=raw,
         ),
         nested_async_message=(
             "You can't run Function.map() or Function.for_each() from an async function. "
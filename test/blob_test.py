@@ -1,13 +1,30 @@
 # Copyright Modal Labs 2022
 
+import asyncio
+import hashlib
+import mmap
+import os
 import pytest
 import random
+from pathlib import PurePosixPath
+from types import SimpleNamespace
 
-from modal._utils.async_utils import synchronize_api
+from grpclib import GRPCError, Status
+
+from modal._utils import blob_utils
+from modal._utils.async_utils import TaskContext, synchronize_api, synchronizer
 from modal._utils.blob_utils import (
+    BufferListReader,
+    MountFileExistenceChecker,
+    MountFilePacker,
+    UploadedBlobCache,
+    _PartScheduler,
     blob_download as _blob_download,
+    blob_download_view as _blob_download_view,
+    blob_iter as _blob_iter,
     blob_upload as _blob_upload,
     blob_upload_file as _blob_upload_file,
+    get_file_upload_spec_from_path,
 )
 from modal.exception import ExecutionError
 
@@ -15,6 +32,8 @@ from .supports.skip import skip_old_py
 
 blob_upload = synchronize_api(_blob_upload)
 blob_download = synchronize_api(_blob_download)
+blob_download_view = synchronize_api(_blob_download_view)
+blob_iter = synchronize_api(_blob_iter)
 blob_upload_file = synchronize_api(_blob_upload_file)
 
 
@@ -40,6 +59,89 @@ async def test_blob_get_failure(servicer, blob_server, client):
         await blob_download.aio("bl-failure", client.stub)
 
 
+@pytest.mark.asyncio
+async def test_blob_upload_cache(servicer, blob_server, client):
+    _, blobs = blob_server
+    cache = synchronizer._translate_in(client)._blob_cache
+
+    blob_ids = await asyncio.gather(*[blob_upload.aio(b"Hello, world", client.stub, cache) for _ in range(5)])
+    assert len(set(blob_ids)) == 1
+    assert len(blobs) == 1
+    assert (cache.hits, cache.misses, cache.bytes_saved) == (4, 1, 48)
+
+    assert await blob_upload.aio(b"Hello, world", client.stub, cache) == blob_ids[0]
+    await blob_upload.aio(b"Goodbye, world", client.stub, cache)
+    assert len(blobs) == 2
+    assert (cache.hits, cache.misses) == (5, 2)
+
+    # Failed uploads aren't cached
+    with pytest.raises(ExecutionError):
+        await blob_upload.aio(b"FAILURE", client.stub, cache)
+    assert len(cache) == 2
+
+
+@pytest.mark.asyncio
+async def test_blob_upload_cache_cancelled_upload():
+    cache = UploadedBlobCache()
+    started = asyncio.Event()
+    n_uploads = 0
+
+    async def upload():
+        nonlocal n_uploads
+        n_uploads += 1
+        started.set()
+        if n_uploads == 1:
+            await asyncio.Event().wait()  # until it's cancelled
+        return f"bl-{n_uploads}"
+
+    first = asyncio.create_task(cache.get_or_upload("abc", 10, upload))
+    await started.wait()
+    waiters = [asyncio.create_task(cache.get_or_upload("abc", 10, upload)) for _ in range(3)]
+    await asyncio.sleep(0)
+    first.cancel()
+
+    # The waiters don't fail with the cancelled caller: one of them uploads the content again
+    assert await asyncio.gather(*waiters) == ["bl-2"] * 3
+    assert first.cancelled()
+    assert n_uploads == 2
+    assert (cache.hits, cache.misses) == (2, 2)
+
+
+@pytest.mark.asyncio
+async def test_blob_upload_cache_max_age(monkeypatch):
+    cache = UploadedBlobCache(max_age=60)
+    n_uploads = 0
+    now = 1000.0
+    monkeypatch.setattr(blob_utils, "time", SimpleNamespace(monotonic=lambda: now))
+
+    async def upload():
+        nonlocal n_uploads
+        n_uploads += 1
+        return f"bl-{n_uploads}"
+
+    assert await cache.get_or_upload("abc", 10, upload) == "bl-1"
+    now += 59
+    assert await cache.get_or_upload("abc", 10, upload) == "bl-1"
+    # Blob ids older than the max age are uploaded again
+    now += 1
+    assert await cache.get_or_upload("abc", 10, upload) == "bl-2"
+    assert (cache.hits, cache.misses, len(cache)) == (1, 2, 1)
+
+
+@pytest.mark.asyncio
+async def test_blob_upload_buffers(servicer, blob_server, client):
+    buffers = [b"Hello", memoryview(bytearray(b", ")), memoryview(b"world")]
+    blob_id = await blob_upload.aio(buffers, client.stub)
+    assert await blob_download.aio(blob_id, client.stub) == b"Hello, world"
+
+    reader = BufferListReader(buffers)
+    reader.seek(3)
+    assert reader.read(4) == b"lo, "
+    assert reader.read() == b"world"
+    reader.seek(-2, os.SEEK_END)
+    assert reader.read(100) == b"ld"
+
+
 @pytest.mark.asyncio
 async def test_blob_large(servicer, blob_server, client):
     data = b"*" * 10_000_000
@@ -47,6 +149,55 @@ async def test_blob_large(servicer, blob_server, client):
     assert await blob_download.aio(blob_id, client.stub) == data
 
 
+@pytest.mark.asyncio
+@pytest.mark.parametrize("mmap_threshold", [2**30, 1000])
+async def test_blob_download_view(servicer, blob_server, client, monkeypatch, mmap_threshold):
+    monkeypatch.setattr("modal._utils.blob_utils.BLOB_DOWNLOAD_MMAP_THRESHOLD", mmap_threshold)
+    data = os.urandom(3_000_000)
+    blob_id = await blob_upload.aio(data, client.stub)
+
+    view = await blob_download_view.aio(blob_id, client.stub)
+    assert view == data
+    assert not view.readonly  # downloaded into a buffer the size of the blob
+    assert isinstance(view.obj, bytearray if mmap_threshold > len(data) else mmap.mmap)
+
+    with pytest.raises(ExecutionError):
+        await blob_download_view.aio("bl-failure", client.stub)
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("fail_every", [0, 3])
+async def test_blob_ranged_download(servicer, blob_server, client, monkeypatch, fail_every):
+    monkeypatch.setattr("modal._utils.blob_utils.DOWNLOAD_RANGE_SIZE", 100_000)
+    servicer.blob_download_fail_every = fail_every
+    data = os.urandom(1_050_000)
+    blob_id = await blob_upload.aio(data, client.stub)
+
+    # Ranges are downloaded concurrently, and failed ones are retried on their own
+    n_ranges = 0
+    original_download_range = blob_utils._download_range
+
+    async def download_range(*args):
+        nonlocal n_ranges
+        n_ranges += 1
+        return await original_download_range(*args)
+
+    monkeypatch.setattr(blob_utils, "_download_range", download_range)
+    assert await blob_download.aio(blob_id, client.stub) == data
+    assert n_ranges == 10  # the first range is fetched with the request that gets the size
+
+    chunks = [chunk async for chunk in blob_iter.aio(blob_id, client.stub)]
+    assert [len(chunk) for chunk in chunks] == [100_000] * 10 + [50_000]
+    assert all(type(chunk) is bytearray for chunk in chunks)  # yielded without being copied to bytes
+    assert b"".join(chunks) == data
+
+    # Empty blobs and blobs that fit in a single range
+    for data in [b"", b"small"]:
+        blob_id = await blob_upload.aio(data, client.stub)
+        assert await blob_download.aio(blob_id, client.stub) == data
+        assert b"".join([chunk async for chunk in blob_iter.aio(blob_id, client.stub)]) == data
+
+
 @skip_old_py("random.randbytes() was introduced in python 3.9", (3, 9))
 @pytest.mark.asyncio
 async def test_blob_multipart(servicer, blob_server, client, monkeypatch, tmp_path):
@@ -68,6 +219,207 @@ async def test_blob_multipart(servicer, blob_server, client, monkeypatch, tmp_pa
     assert await blob_download.aio(blob_id, client.stub) == data
 
 
+@pytest.mark.asyncio
+async def test_part_scheduler():
+    scheduler = _PartScheduler(max_parallelism=2, max_inflight_bytes=100)
+    order = []
+    release = asyncio.Event()
+
+    async def upload_part(blob, part, n_bytes=10):
+        async with scheduler.slot(blob, n_bytes):
+            order.append((blob, part))
+            assert scheduler.inflight <= 2 and scheduler.inflight_bytes <= 100
+            await release.wait()
+
+    # Blob "a" queues up all its parts first, but blobs take turns once they have to wait
+    tasks = [asyncio.create_task(upload_part("a", i)) for i in range(4)]
+    tasks += [asyncio.create_task(upload_part("b", i)) for i in range(2)]
+    await asyncio.sleep(0.01)
+    assert order == [("a", 0), ("a", 1)]
+    release.set()
+    await asyncio.gather(*tasks)
+    assert order == [("a", 0), ("a", 1), ("a", 2), ("b", 0), ("a", 3), ("b", 1)]
+    assert scheduler.inflight == 0 and scheduler.inflight_bytes == 0
+
+    # Parts wait for memory as well, and a part that's larger than the budget runs on its own
+    release.clear()
+    tasks = [asyncio.create_task(upload_part("c", i, n_bytes)) for i, n_bytes in enumerate([60, 60, 200])]
+    await asyncio.sleep(0.01)
+    assert scheduler.inflight == 1
+    # A waiting part can be cancelled
+    tasks[1].cancel()
+    release.set()
+    await asyncio.gather(*tasks, return_exceptions=True)
+    assert scheduler.inflight == 0 and scheduler.peak_inflight_bytes == 200
+    assert not scheduler._waiters
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("granted_first", [False, True])
+async def test_part_scheduler_cancel_after_grant(granted_first):
+    scheduler = _PartScheduler(max_parallelism=1, max_inflight_bytes=100)
+    ran = []
+
+    async def upload_part(part):
+        async with scheduler.slot("a", 10):
+            ran.append(part)
+
+    scheduler._take(10)  # an upload that's already running
+    tasks = [asyncio.create_task(upload_part(i)) for i in range(2)]
+    await asyncio.sleep(0)
+    assert len(scheduler._waiters["a"]) == 2
+
+    # The first waiting part is cancelled right as its slot frees up, before it gets to run
+    if granted_first:
+        scheduler._release(10)
+        tasks[0].cancel()
+    else:
+        tasks[0].cancel()
+        scheduler._release(10)
+    await asyncio.gather(*tasks, return_exceptions=True)
+
+    assert tasks[0].cancelled()
+    assert ran == [1]
+    assert scheduler.inflight == 0 and scheduler.inflight_bytes == 0
+    assert not scheduler._waiters
+
+
+@pytest.mark.asyncio
+async def test_blob_multipart_concurrent(servicer, blob_server, client, monkeypatch):
+    monkeypatch.setattr("modal._utils.blob_utils.DEFAULT_SEGMENT_CHUNK_SIZE", 10_000)
+    servicer.blob_multipart_threshold = 100_000
+    scheduler = _PartScheduler(max_parallelism=4, max_inflight_bytes=25_000)
+    monkeypatch.setattr(blob_utils, "get_part_scheduler", lambda: scheduler)
+
+    # Payloads made of several buffers are uploaded in parts as well
+    payloads = [[os.urandom(500_000), os.urandom(555_555)] for _ in range(5)]
+    blob_ids = await asyncio.gather(*[blob_upload.aio(payload, client.stub) for payload in payloads])
+    for blob_id, payload in zip(blob_ids, payloads):
+        assert await blob_download.aio(blob_id, client.stub) == b"".join(payload)
+    assert scheduler.peak_inflight_bytes == 20_000  # two parts, with a 10 kB buffer each
+
+
+@pytest.mark.asyncio
+async def test_blob_multipart_precomputed_md5s(servicer, blob_server, client, monkeypatch, tmp_path):
+    monkeypatch.setattr("modal._utils.blob_utils.LARGE_FILE_LIMIT", 1000)
+    monkeypatch.setattr("modal._utils.blob_utils.MULTIPART_UPLOAD_THRESHOLD", 10_000)
+    monkeypatch.setattr("modal._utils.blob_utils.MULTIPART_PART_LENGTH", 30_000)
+    servicer.blob_multipart_threshold = 10_000
+    data = os.urandom(100_000)
+    data_filepath = tmp_path / "temp.bin"
+    data_filepath.write_bytes(data)
+
+    # Part md5s are computed while hashing the file ...
+    spec = get_file_upload_spec_from_path(data_filepath, PurePosixPath("/temp.bin"))
+    assert spec.part_md5s_hex == [hashlib.md5(data[i : i + 30_000]).hexdigest() for i in range(0, 100_000, 30_000)]
+
+    # ... and not again while uploading, if the server uses the requested part length
+    n_md5_updates = 0
+
+    class CountingMD5:
+        def __init__(self):
+            self._md5 = hashlib.md5()
+
+        def update(self, data):
+            nonlocal n_md5_updates
+            n_md5_updates += 1
+            self._md5.update(data)
+
+        def hexdigest(self):
+            return self._md5.hexdigest()
+
+    monkeypatch.setattr("modal._utils.bytes_io_segment_payload.hashlib", SimpleNamespace(md5=CountingMD5))
+    with data_filepath.open("rb") as fp:
+        blob_id = await blob_upload_file.aio(
+            fp, client.stub, sha256_hex=spec.sha256_hex, md5_hex=spec.md5_hex, part_md5s_hex=spec.part_md5s_hex
+        )
+    assert await blob_download.aio(blob_id, client.stub) == data
+    assert n_md5_updates == 0
+
+    # Without them (or if the server picks its own part length), they are computed during the upload
+    with data_filepath.open("rb") as fp:
+        blob_id = await blob_upload_file.aio(fp, client.stub, sha256_hex=spec.sha256_hex, md5_hex=spec.md5_hex)
+    assert await blob_download.aio(blob_id, client.stub) == data
+    assert n_md5_updates > 0
+
+
 def test_sync(blob_server, client):
     # just tests that tests running blocking calls that upload to blob storage don't deadlock
     blob_upload(b"adsfadsf", client.stub)
+
+
+async def _put_files(stub, files: list[tuple[str, bytes]], **kwargs) -> tuple[list[bool], int, int]:
+    async with TaskContext() as tc:
+        packer = MountFilePacker(stub, tc, **kwargs)
+        results = list(
+            await asyncio.gather(*[packer.put(sha, len(content), lambda c=content: c) for sha, content in files])
+        )
+        # Contents that were already packed aren't packed again
+        results += [await packer.put(sha, len(content), lambda c=content: c) for sha, content in files]
+    return results, packer.n_packs, packer.peak_inflight_bytes
+
+
+put_files = synchronize_api(_put_files)
+
+
+@pytest.mark.asyncio
+async def test_mount_file_packer_dedup(servicer, client):
+    contents = [f"file {i}".encode() for i in range(3)]
+    files = [(hashlib.sha256(content).hexdigest(), content) for content in contents]
+    with servicer.intercept() as ctx:
+        results, n_packs, _ = await put_files.aio(client.stub, files, max_pack_files=2)
+
+    assert results == [True] * 6
+    assert n_packs == 2
+    packed = [file.sha256_hex for req in ctx.get_requests("MountPutPackedFiles") for file in req.files]
+    assert sorted(packed) == sorted(sha for sha, _ in files)
+
+
+@pytest.mark.asyncio
+async def test_mount_file_packer_inflight_bytes(servicer, client):
+    contents = [f"file {i:02}".encode() * 10 for i in range(10)]  # 70 bytes each
+    files = [(hashlib.sha256(content).hexdigest(), content) for content in contents]
+    results, n_packs, peak_inflight_bytes = await put_files.aio(
+        client.stub, files, max_pack_files=1, max_inflight_bytes=150
+    )
+
+    # Contents are only read once the packs being uploaded leave room for them
+    assert results == [True] * 20
+    assert n_packs == 10
+    assert peak_inflight_bytes == 140
+
+
+async def _check_exists_and_exit(stub) -> bool:
+    async with TaskContext() as tc:
+        checker = MountFileExistenceChecker(stub, tc, debounce_time=0)
+        check = asyncio.create_task(checker.exists("a" * 64))
+        await asyncio.sleep(0.1)  # the batch is being checked
+    await asyncio.wait([check])
+    return check.cancelled()
+
+
+check_exists_and_exit = synchronize_api(_check_exists_and_exit)
+
+
+@pytest.mark.asyncio
+async def test_mount_file_existence_checker_cancelled(servicer, client):
+    async def hang(servicer, stream):
+        await stream.recv_message()
+        await asyncio.sleep(10)
+
+    # Batches that are still being checked are cancelled along with the upload
+    with servicer.intercept() as ctx:
+        ctx.set_responder("MountFilesExist", hang)
+        assert await check_exists_and_exit.aio(client.stub)
+
+
+@pytest.mark.asyncio
+async def test_mount_file_packer_failure(servicer, client):
+    async def fail(servicer, stream):
+        await stream.recv_message()
+        raise GRPCError(Status.INVALID_ARGUMENT, "bad pack")
+
+    with servicer.intercept() as ctx:
+        ctx.set_responder("MountPutPackedFiles", fail)
+        with pytest.raises(GRPCError, match="bad pack"):
+            await put_files.aio(client.stub, [("a" * 64, b"a"), ("b" * 64, b"b")])
@@ -0,0 +1,55 @@
+# Copyright Modal Labs 2024
+import os
+import pytest
+
+from modal._utils import compression_utils
+from modal._utils.compression_utils import COMPRESSION_MIN_SIZE, compress, compression_stats, decompress
+from modal.exception import InvalidError
+from modal_proto import api_pb2
+
+ZLIB = api_pb2.PAYLOAD_COMPRESSION_ZLIB
+ZSTD = api_pb2.PAYLOAD_COMPRESSION_ZSTD
+
+
+def test_compress_roundtrip():
+    data = b"abcdefgh" * COMPRESSION_MIN_SIZE
+    n_compressed, bytes_saved = compression_stats.n_compressed, compression_stats.bytes_saved
+
+    compression, compressed = compress(data, [ZLIB])
+    assert compression == ZLIB
+    assert len(compressed) < len(data) // 10
+    assert decompress(compressed, compression) == data
+    assert compression_stats.n_compressed == n_compressed + 1
+    assert compression_stats.bytes_saved > bytes_saved
+
+    # A list of buffers is compressed as if it were concatenated
+    compression, compressed = compress([data[:100], memoryview(data)[100:]], [ZLIB])
+    assert decompress(compressed, compression) == data
+
+
+def test_compress_skips():
+    small = b"a" * (COMPRESSION_MIN_SIZE - 1)
+    assert compress(small, [ZLIB]) == (api_pb2.PAYLOAD_COMPRESSION_UNSPECIFIED, small)
+
+    # The receiver doesn't accept any compression
+    data = b"a" * COMPRESSION_MIN_SIZE
+    assert compress(data, []) == (api_pb2.PAYLOAD_COMPRESSION_UNSPECIFIED, data)
+
+    # Random data doesn't compress, which is detected from a sample
+    n_skipped = compression_stats.n_skipped
+    random_data = os.urandom(4 * COMPRESSION_MIN_SIZE)
+    assert compress(random_data, [ZLIB]) == (api_pb2.PAYLOAD_COMPRESSION_UNSPECIFIED, random_data)
+    assert compression_stats.n_skipped == n_skipped + 1
+
+
+def test_compress_zstd():
+    data = b"abcdefgh" * COMPRESSION_MIN_SIZE
+    if compression_utils.zstandard is None:
+        # Falls back to the next codec the receiver accepts
+        assert compress(data, [ZSTD, ZLIB])[0] == ZLIB
+        with pytest.raises(InvalidError, match="zstandard"):
+            decompress(b"", ZSTD)
+    else:
+        compression, compressed = compress(data, [ZSTD, ZLIB])
+        assert compression == ZSTD
+        assert decompress(compressed, compression) == data
@@ -37,8 +37,9 @@ import modal._serialization
 from modal import __version__, config
 from modal._functions import _Function
 from modal._runtime.container_io_manager import _ContainerIOManager
-from modal._serialization import serialize_data_format
+from modal._serialization import serialize_data_format, serialize_negotiated
 from modal._utils.async_utils import asyncify, synchronize_api
+from modal._utils.compression_utils import compress, decompress
 from modal._utils.grpc_testing import patch_mock_servicer
 from modal._utils.grpc_utils import find_free_port
 from modal._utils.http_utils import run_temporary_http_server
@@ -60,8 +61,9 @@ class VolumeFile:
 
 # TODO: Isolate all test config from the host
 @pytest.fixture(scope="function", autouse=True)
-def set_env(monkeypatch):
+def set_env(monkeypatch, tmp_path_factory):
     monkeypatch.setenv("MODAL_ENVIRONMENT", "main")
+    monkeypatch.setenv("MODAL_HASH_CACHE_PATH", str(tmp_path_factory.mktemp("hash-cache") / "hash-cache.sqlite3"))
 
 
 @pytest.fixture(scope="function", autouse=True)
@@ -156,6 +158,10 @@ class MockClientServicer(api_grpc.ModalClientBase):
         self.fail_get_inputs = False
         self.failure_status = api_pb2.GenericResult.GENERIC_STATUS_FAILURE
         self.slow_put_inputs = False
+        self.put_inputs_resource_exhausted = 0  # number of FunctionPutInputs calls to reject with backpressure
+        self.output_formats: dict[str, list[int]] = {}  # input_id -> output formats accepted by the caller
+        self.output_compressions: dict[str, list[int]] = {}  # input_id -> output compressions accepted by the caller
+        self.input_compressions: list[int] = []  # compression of each input received
         self.container_inputs = []
         self.container_outputs = []
         self.fail_get_data_out = []
@@ -186,6 +192,8 @@ class MockClientServicer(api_grpc.ModalClientBase):
         self.n_vol_heartbeats = 0
         self.n_mounts = 0
         self.n_mount_files = 0
+        self.n_mount_file_packs = 0
+        self.volume_get_file_ranges: list[tuple[str, int, int]] = []
         self.mount_contents = {self.default_published_client_mount: {"/pkg/modal_client.py": "0x1337"}}
         self.files_name2sha = {}
         self.files_sha2data = {}
@@ -212,6 +220,7 @@ class MockClientServicer(api_grpc.ModalClientBase):
         self.fail_blob_create = []
         self.blob_create_metadata = None
         self.blob_multipart_threshold = 10_000_000
+        self.blob_download_fail_every = 0  # fail every n-th request to download a blob
 
         self.precreated_functions = set()
 
@@ -381,9 +390,13 @@ class MockClientServicer(api_grpc.ModalClientBase):
                     web_url=method_definition.web_url,
                     is_method=True,
                     use_method_name=method_name,
+                    supported_input_formats=definition.supported_input_formats,
+                    supported_input_compressions=definition.supported_input_compressions,
                 )
                 for method_name, method_definition in definition.method_definitions.items()
             },
+            supported_input_formats=definition.supported_input_formats,
+            supported_input_compressions=definition.supported_input_compressions,
         )
 
     def get_object_metadata(self, object_id) -> api_pb2.Object:
@@ -630,7 +643,8 @@ class MockClientServicer(api_grpc.ModalClientBase):
             raise GRPCError(status_code, "foobar")
         elif req.content_length > self.blob_multipart_threshold:
             blob_id = await self.next_blob_id()
-            num_parts = (req.content_length + self.blob_multipart_threshold - 1) // self.blob_multipart_threshold
+            part_length = req.part_length or self.blob_multipart_threshold
+            num_parts = (req.content_length + part_length - 1) // part_length
             upload_urls = []
             for part_number in range(num_parts):
                 upload_url = f"{self.blob_host}/upload?blob_id={blob_id}&part_number={part_number}"
@@ -640,7 +654,7 @@ class MockClientServicer(api_grpc.ModalClientBase):
                 api_pb2.BlobCreateResponse(
                     blob_id=blob_id,
                     multipart=api_pb2.MultiPartUpload(
-                        part_length=self.blob_multipart_threshold,
+                        part_length=part_length,
                         upload_urls=upload_urls,
                         completion_url=f"{self.blob_host}/complete_multipart?blob_id={blob_id}",
                     ),
@@ -659,6 +673,8 @@ class MockClientServicer(api_grpc.ModalClientBase):
     async def BlobGet(self, stream):
         request: api_pb2.BlobGetRequest = await stream.recv_message()
         download_url = f"{self.blob_host}/download?blob_id={request.blob_id}"
+        if self.blob_download_fail_every:
+            download_url += f"&fail_every={self.blob_download_fail_every}"
         await stream.send_message(api_pb2.BlobGetResponse(download_url=download_url))
 
     ### Class
@@ -888,6 +904,8 @@ class MockClientServicer(api_grpc.ModalClientBase):
                     web_url=base_function.web_url,
                     use_function_id=function_id,
                     use_method_name="",
+                    supported_input_formats=base_function.supported_input_formats,
+                    supported_input_compressions=base_function.supported_input_compressions,
                 ),
             )
         )
@@ -1017,9 +1035,13 @@ class MockClientServicer(api_grpc.ModalClientBase):
                             web_url=method_definition.web_url,
                             is_method=True,
                             use_method_name=method_name,
+                            supported_input_formats=function_defn.supported_input_formats,
+                            supported_input_compressions=function_defn.supported_input_compressions,
                         )
                         for method_name, method_definition in function_defn.method_definitions.items()
                     },
+                    supported_input_formats=function_defn.supported_input_formats,
+                    supported_input_compressions=function_defn.supported_input_compressions,
                 ),
             )
         )
@@ -1059,9 +1081,13 @@ class MockClientServicer(api_grpc.ModalClientBase):
         function_call_inputs = self.client_calls.setdefault(function_call_id, [])
         for item in request.inputs:
             if item.input.WhichOneof("args_oneof") == "args":
-                args, kwargs = modal._serialization.deserialize(item.input.args, None)
+                args_data = item.input.args
             else:
-                args, kwargs = modal._serialization.deserialize(self.blobs[item.input.args_blob_id], None)
+                args_data = self.blobs[item.input.args_blob_id]
+            args, kwargs = modal._serialization.deserialize(
+                decompress(args_data, item.input.args_compression), None, data_format=item.input.data_format
+            )
+            self.input_compressions.append(item.input.args_compression)
             self.n_inputs += 1
             idx, input_id, function_call_id = decode_input_jwt(item.input_jwt)
             function_call_inputs.append(((idx, input_id), (args, kwargs)))
@@ -1069,16 +1095,25 @@ class MockClientServicer(api_grpc.ModalClientBase):
 
     async def FunctionPutInputs(self, stream):
         request: api_pb2.FunctionPutInputsRequest = await stream.recv_message()
+        if self.put_inputs_resource_exhausted > 0:
+            self.put_inputs_resource_exhausted -= 1
+            raise GRPCError(Status.RESOURCE_EXHAUSTED, "Too many inputs")
         response_items = []
         function_call_inputs = self.client_calls.setdefault(request.function_call_id, [])
         for item in request.inputs:
             if item.input.WhichOneof("args_oneof") == "args":
-                args, kwargs = modal._serialization.deserialize(item.input.args, None)
+                args_data = item.input.args
             else:
-                args, kwargs = modal._serialization.deserialize(self.blobs[item.input.args_blob_id], None)
+                args_data = self.blobs[item.input.args_blob_id]
+            args, kwargs = modal._serialization.deserialize(
+                decompress(args_data, item.input.args_compression), None, data_format=item.input.data_format
+            )
+            self.input_compressions.append(item.input.args_compression)
 
             input_id = f"in-{self.n_inputs}"
             self.n_inputs += 1
+            self.output_formats[input_id] = list(item.input.supported_output_formats)
+            self.output_compressions[input_id] = list(item.input.supported_output_compressions)
             response_items.append(
                 api_pb2.FunctionPutInputsResponseItem(
                     input_id=input_id,
@@ -1138,7 +1173,14 @@ class MockClientServicer(api_grpc.ModalClientBase):
             if output_exc:
                 output = output_exc
             else:
-                serialized_data = serialize_data_format(result, result_data_format)
+                if result_data_format == api_pb2.DATA_FORMAT_PICKLE:
+                    result_data_format, parts = serialize_negotiated(result, self.output_formats.get(input_id, []))
+                    serialized_data = b"".join(parts)
+                else:
+                    serialized_data = serialize_data_format(result, result_data_format)
+                data_compression, serialized_data = compress(
+                    serialized_data, self.output_compressions.get(input_id, [])
+                )
                 if self.use_blob_outputs:
                     blob_id = await self.next_blob_id()
                     self.blobs[blob_id] = serialized_data
@@ -1150,7 +1192,11 @@ class MockClientServicer(api_grpc.ModalClientBase):
                 output = api_pb2.FunctionGetOutputsItem(
                     input_id=input_id,
                     idx=idx,
-                    result=api_pb2.GenericResult(status=api_pb2.GenericResult.GENERIC_STATUS_SUCCESS, **data_kwargs),
+                    result=api_pb2.GenericResult(
+                        status=api_pb2.GenericResult.GENERIC_STATUS_SUCCESS,
+                        data_compression=data_compression,
+                        **data_kwargs,
+                    ),
                     data_format=result_data_format,
                 )
 
@@ -1252,6 +1298,23 @@ class MockClientServicer(api_grpc.ModalClientBase):
         else:
             await stream.send_message(api_pb2.MountPutFileResponse(exists=False))
 
+    async def MountFilesExist(self, stream):
+        request: api_pb2.MountFilesExistRequest = await stream.recv_message()
+        exists = [sha256_hex in self.files_sha2data for sha256_hex in request.sha256_hexes]
+        await stream.send_message(api_pb2.MountFilesExistResponse(exists=exists))
+
+    async def MountPutPackedFiles(self, stream):
+        request: api_pb2.MountPutPackedFilesRequest = await stream.recv_message()
+        data = self.blobs[request.data_blob_id] if request.data_blob_id else request.data
+        for file in request.files:
+            content = data[file.offset : file.offset + file.length]
+            if hashlib.sha256(content).hexdigest() != file.sha256_hex:
+                raise GRPCError(Status.INVALID_ARGUMENT, f"Hash mismatch for packed file {file.sha256_hex}")
+            self.files_sha2data[file.sha256_hex] = {"data": content, "data_blob_id": ""}
+            self.n_mount_files += 1
+        self.n_mount_file_packs += 1
+        await stream.send_message(Empty())
+
     async def MountGetOrCreate(self, stream):
         request: api_pb2.MountGetOrCreateRequest = await stream.recv_message()
         k = (request.deployment_name, request.namespace)
@@ -1280,6 +1343,11 @@ class MockClientServicer(api_grpc.ModalClientBase):
         else:
             raise Exception("unsupported creation type")
 
+        # Like the server, reject file lists that refer to content that was never uploaded
+        missing = [file.filename for file in request.files if file.sha256_hex not in self.files_sha2data]
+        if missing:
+            raise GRPCError(Status.NOT_FOUND, f"Mount files not found: {missing}")
+
         mount_content = self.mount_contents[mount_id] = {}
         for file in request.files:
             mount_content[file.filename] = self.files_name2sha[file.filename] = file.sha256_hex
@@ -1749,18 +1817,18 @@ class MockClientServicer(api_grpc.ModalClientBase):
         if req.path not in self.volume_files[req.volume_id]:
             raise GRPCError(Status.NOT_FOUND, "File not found")
         vol_file = self.volume_files[req.volume_id][req.path]
-        if vol_file.data_blob_id:
+        self.volume_get_file_ranges.append((req.path, req.start, req.len))
+        if req.start or req.len:
+            # Ranges are served as data, also for files that are stored as blobs
+            data = self.blobs[vol_file.data_blob_id] if vol_file.data_blob_id else vol_file.data
+            size = len(data)
+            start = req.start
+            len_ = req.len or size
+            await stream.send_message(api_pb2.VolumeGetFileResponse(data=data[start : start + len_], size=size))
+        elif vol_file.data_blob_id:
             await stream.send_message(api_pb2.VolumeGetFileResponse(data_blob_id=vol_file.data_blob_id))
         else:
-            size = len(vol_file.data)
-            if req.start or req.len:
-                start = req.start
-                len_ = req.len or len(vol_file.data)
-                await stream.send_message(
-                    api_pb2.VolumeGetFileResponse(data=vol_file.data[start : start + len_], size=size)
-                )
-            else:
-                await stream.send_message(api_pb2.VolumeGetFileResponse(data=vol_file.data, size=size))
+            await stream.send_message(api_pb2.VolumeGetFileResponse(data=vol_file.data, size=len(vol_file.data)))
 
     async def VolumeRemoveFile(self, stream):
         req = await stream.recv_message()
@@ -1838,6 +1906,7 @@ class MockClientServicer(api_grpc.ModalClientBase):
 def blob_server():
     blobs = {}
     blob_parts: dict[str, dict[int, bytes]] = defaultdict(dict)
+    download_counts: dict[str, int] = defaultdict(int)
 
     async def upload(request):
         blob_id = request.query["blob_id"]
@@ -1872,7 +1941,19 @@ def blob_server():
         blob_id = request.query["blob_id"]
         if blob_id == "bl-failure":
             return aiohttp.web.Response(status=500)
-        return aiohttp.web.Response(body=blobs[blob_id])
+        download_counts[blob_id] += 1
+        fail_every = int(request.query.get("fail_every", 0))
+        if fail_every and download_counts[blob_id] % fail_every == 0:
+            return aiohttp.web.Response(status=500)
+        content = blobs[blob_id]
+        if "Range" in request.headers:
+            start, end = (int(x) for x in request.headers["Range"].removeprefix("bytes=").split("-"))
+            if start >= len(content):
+                return aiohttp.web.Response(status=416)
+            end = min(end, len(content) - 1)
+            headers = {"Content-Range": f"bytes {start}-{end}/{len(content)}"}
+            return aiohttp.web.Response(status=206, body=content[start : end + 1], headers=headers)
+        return aiohttp.web.Response(body=content)
 
     app = aiohttp.web.Application()
     app.add_routes([aiohttp.web.put("/upload", upload)])
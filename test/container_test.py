@@ -13,9 +13,10 @@ import signal
 import subprocess
 import sys
 import tempfile
+import threading
 import time
 import uuid
-from typing import Any, Optional
+from typing import Any, Callable, Optional
 from unittest import mock
 from unittest.mock import MagicMock
 
@@ -24,27 +25,34 @@ from grpclib.exceptions import GRPCError
 
 import modal
 from modal import Client, Queue, Volume, is_local
-from modal._container_entrypoint import UserException, main
+from modal._container_entrypoint import InputThreadPool, UserException, main
 from modal._runtime import asgi
 from modal._runtime.container_io_manager import (
+    RTT_S,
     ContainerIOManager,
     InputSlots,
     IOContext,
+    OutputBatcher,
+    _ContainerIOManager,
 )
 from modal._runtime.user_code_imports import FinalizedFunction
 from modal._serialization import (
     deserialize,
     deserialize_data_format,
+    pre_serialize,
     serialize,
     serialize_data_format,
+    serialize_oob,
 )
 from modal._utils import async_utils
-from modal._utils.async_utils import synchronize_api
+from modal._utils.async_utils import synchronize_api, synchronizer
 from modal._utils.blob_utils import (
     MAX_OBJECT_SIZE_BYTES,
     blob_download as _blob_download,
+    blob_download_view,
     blob_upload as _blob_upload,
 )
+from modal._utils.compression_utils import compress, decompress
 from modal.app import _App
 from modal.exception import InvalidError
 from modal.partial_function import enter, method
@@ -445,6 +453,73 @@ def test_success(servicer):
     assert _unwrap_scalar(ret) == 42**2
 
 
+@skip_github_non_linux
+def test_shared_kwargs_are_decoded_once(servicer):
+    kwargs = pre_serialize({"shared": [1, 2, 3]})
+    inputs = _get_inputs(((42,), kwargs), n=3)
+    ret = _run_container(servicer, "test.supports.functions", "kwarg_id", inputs=inputs)
+    # the same decoded kwargs are passed to every input of the function call
+    ids = _unwrap_batch_scalar(ret, 3)
+    assert len(set(ids)) == 1
+
+
+@skip_github_non_linux
+def test_oob_pickle_input(servicer):
+    args = ((pickle.PickleBuffer(bytearray(200_000)),), {})
+    input_pb = api_pb2.FunctionInput(args=b"".join(serialize_oob(args)), data_format=api_pb2.DATA_FORMAT_PICKLE_OOB)
+    inputs = [
+        api_pb2.FunctionGetInputsResponse(inputs=[api_pb2.FunctionGetInputsItem(input_id="in-xyz0", input=input_pb)]),
+        api_pb2.FunctionGetInputsResponse(inputs=[api_pb2.FunctionGetInputsItem(kill_switch=True)]),
+    ]
+    ret = _run_container(servicer, "test.supports.functions", "buffer_info", inputs=inputs)
+    assert _unwrap_scalar(ret) == (200_000, False)
+
+
+@skip_github_non_linux
+@pytest.mark.parametrize(
+    "arg,output_formats,expected_format",
+    [
+        (b"abc", [], api_pb2.DATA_FORMAT_PICKLE),
+        (b"abc", [api_pb2.DATA_FORMAT_RAW_BYTES, api_pb2.DATA_FORMAT_PICKLE_OOB], api_pb2.DATA_FORMAT_RAW_BYTES),
+        ("abc", [api_pb2.DATA_FORMAT_RAW_BYTES, api_pb2.DATA_FORMAT_PICKLE_OOB], api_pb2.DATA_FORMAT_PICKLE_OOB),
+        ("abc", [999, api_pb2.DATA_FORMAT_RAW_BYTES], api_pb2.DATA_FORMAT_PICKLE),
+    ],
+)
+def test_negotiated_output_format(servicer, arg, output_formats, expected_format):
+    input_pb = api_pb2.FunctionInput(
+        args=serialize(((arg,), {})), data_format=api_pb2.DATA_FORMAT_PICKLE, supported_output_formats=output_formats
+    )
+    inputs = [
+        api_pb2.FunctionGetInputsResponse(inputs=[api_pb2.FunctionGetInputsItem(input_id="in-xyz0", input=input_pb)]),
+        api_pb2.FunctionGetInputsResponse(inputs=[api_pb2.FunctionGetInputsItem(kill_switch=True)]),
+    ]
+    ret = _run_container(servicer, "test.supports.functions", "ident", inputs=inputs)
+    (item,) = ret.items
+    assert item.data_format == expected_format
+    assert deserialize_data_format(item.result.data, item.data_format, None) == arg
+
+
+def test_compressed_input_and_output(servicer):
+    arg = "abc" * 100_000
+    compression, args = compress(serialize(((arg,), {})), [api_pb2.PAYLOAD_COMPRESSION_ZLIB])
+    assert compression == api_pb2.PAYLOAD_COMPRESSION_ZLIB
+    input_pb = api_pb2.FunctionInput(
+        args=args,
+        args_compression=compression,
+        data_format=api_pb2.DATA_FORMAT_PICKLE,
+        supported_output_compressions=[api_pb2.PAYLOAD_COMPRESSION_ZLIB],
+    )
+    inputs = [
+        api_pb2.FunctionGetInputsResponse(inputs=[api_pb2.FunctionGetInputsItem(input_id="in-xyz0", input=input_pb)]),
+        api_pb2.FunctionGetInputsResponse(inputs=[api_pb2.FunctionGetInputsItem(kill_switch=True)]),
+    ]
+    ret = _run_container(servicer, "test.supports.functions", "ident", inputs=inputs)
+    (item,) = ret.items
+    assert item.result.data_compression == api_pb2.PAYLOAD_COMPRESSION_ZLIB
+    assert len(item.result.data) < len(arg)
+    assert deserialize(decompress(item.result.data, item.result.data_compression), None) == arg
+
+
 @skip_github_non_linux
 def test_generator_success(servicer, event_loop):
     ret = _run_container(
@@ -1368,6 +1443,105 @@ def test_concurrent_inputs_async_function(servicer):
         assert function_call_id and function_call_id == outputs[i - 1][2]
 
 
+@skip_github_non_linux
+def test_concurrent_inputs_output_batching(servicer, monkeypatch):
+    # Lingers for longer than the inputs take, so outputs are only sent once no other inputs are running
+    monkeypatch.setenv("MODAL_OUTPUT_BATCH_LINGER_MS", "10000")
+    n_inputs = 30
+
+    ret = _run_container(
+        servicer,
+        "test.supports.functions",
+        "delay_async",
+        inputs=_get_inputs(((1.0,), {}), n=n_inputs),
+        allow_concurrent_inputs=n_inputs,
+    )
+
+    # Outputs of inputs that finish at about the same time are sent together
+    assert sorted(item.input_id for item in ret.items) == sorted(f"in-xyz{i}" for i in range(n_inputs))
+    assert all(item.result.status == api_pb2.GenericResult.GENERIC_STATUS_SUCCESS for item in ret.items)
+    assert len(servicer.container_outputs) == 1
+    stats = _ContainerIOManager._singleton._output_batcher.stats
+    assert (stats.n_batches, stats.n_outputs, stats.max_batch_size) == (1, n_inputs, n_inputs)
+
+
+@skip_github_non_linux
+def test_input_prefetch(servicer, monkeypatch):
+    monkeypatch.setenv("MODAL_INPUT_PREFETCH", "4")
+    n_inputs = 10
+
+    with servicer.intercept() as ctx:
+        ret = _run_container(servicer, "test.supports.functions", "square", inputs=_get_inputs(((3,), {}), n=n_inputs))
+
+    assert [item.input_id for item in ret.items] == [f"in-xyz{i}" for i in range(n_inputs)]
+    assert all(deserialize(item.result.data, ret.client) == 9 for item in ret.items)
+    # Buffered inputs don't count as concurrency, which the server and autoscaler see
+    assert all(req.input_concurrency == 1 for req in ctx.get_requests("FunctionGetInputs"))
+
+
+@skip_github_non_linux
+def test_input_prefetch_rtt_ignores_long_polls(servicer, monkeypatch):
+    monkeypatch.setenv("MODAL_INPUT_PREFETCH", "4")
+    monkeypatch.setattr("modal._runtime.container_io_manager.INPUT_RTT_SAMPLE_MAX_S", 0)
+
+    ret = _run_container(servicer, "test.supports.functions", "square", inputs=_get_inputs(((3,), {}), n=5))
+    assert len(ret.items) == 5
+    # Every call counts as having waited for inputs, so none of them change the RTT estimate
+    assert _ContainerIOManager._singleton._get_inputs_rtt == RTT_S
+
+
+@skip_github_non_linux
+@pytest.mark.usefixtures("server_url_env")
+def test_input_prefetch_cancellation(servicer, tmp_path):
+    with servicer.input_lockstep() as input_lock:
+        container_process = _run_container_process(
+            servicer,
+            tmp_path,
+            "test.supports.functions",
+            "delay",
+            inputs=[("", (arg,), {}) for arg in [2, 20, 0.01]],
+            env={"MODAL_INPUT_PREFETCH": "4"},
+        )
+        for _ in range(3):
+            input_lock.wait()
+    time.sleep(0.1)  # the first input is running, and the others are buffered
+
+    servicer.container_heartbeat_return_now(
+        api_pb2.ContainerHeartbeatResponse(cancel_input_event=api_pb2.CancelInputEvent(input_ids=["in-001"]))
+    )
+    stdout, stderr = container_process.communicate(timeout=10)
+    assert "Traceback" not in stderr.decode()
+    assert container_process.returncode == 0
+
+    # The buffered input is terminated without running
+    items = {item.input_id: item.result for item in _flatten_outputs(servicer.container_outputs)}
+    assert items["in-001"].status == api_pb2.GenericResult.GENERIC_STATUS_TERMINATED
+    assert deserialize(items["in-000"].data, client=None) == 2
+    assert deserialize(items["in-002"].data, client=None) == 0.01
+
+
+def test_output_batcher(servicer, client):
+    outputs = [api_pb2.FunctionPutOutputsItem(input_id=f"in-{i}") for i in range(10)]
+
+    @synchronizer.create_blocking
+    async def put_outputs():
+        # Runs on the client's event loop
+        batcher = OutputBatcher(synchronizer._translate_in(client), linger_time=0.05, max_batch_size=4)
+        await asyncio.gather(*(batcher.put([output]) for output in outputs[:6]))
+        assert [len(req.outputs) for req in servicer.container_outputs] == [4, 2]
+
+        # Outputs are sent right away when flushed
+        t0 = time.monotonic()
+        await batcher.put(outputs[6:], flush=True)
+        assert time.monotonic() - t0 < 0.05
+        assert batcher.n_unacknowledged == 0
+        return batcher.stats
+
+    stats = put_outputs()
+    assert [len(req.outputs) for req in servicer.container_outputs] == [4, 2, 4]
+    assert (stats.n_batches, stats.n_outputs, stats.max_batch_size) == (3, 10, 4)
+
+
 def _batch_function_test_helper(batch_func, servicer, args_list, expected_outputs, expected_status="success"):
     batch_max_size = 4
     batch_wait_ms = 500
@@ -1920,6 +2094,41 @@ def test_inputs_outputs_with_blob_id(servicer, client, monkeypatch):
     assert _unwrap_blob_scalar(ret, client) == 42
 
 
+@skip_github_non_linux
+def test_input_downloads_overlap_execution(servicer, client, monkeypatch):
+    monkeypatch.setenv("MODAL_INPUT_PREFETCH", "4")
+
+    async def slow_blob_download_view(*args, **kwargs):
+        await asyncio.sleep(0.2)
+        return await blob_download_view(*args, **kwargs)
+
+    monkeypatch.setattr("modal._runtime.container_io_manager.blob_download_view", slow_blob_download_view)
+    n_inputs = 4
+    inputs = _get_inputs(((0.2,), {}), n=n_inputs, upload_to_blob=True, client=client)
+
+    t0 = time.monotonic()
+    ret = _run_container(servicer, "test.supports.functions", "delay", inputs=inputs)
+    elapsed = time.monotonic() - t0
+
+    assert [deserialize(item.result.data, ret.client) for item in ret.items] == [0.2] * n_inputs
+    # Each input's arguments are downloaded while the previous input runs
+    assert elapsed < n_inputs * 0.4
+    timings = _ContainerIOManager._singleton.stage_timings
+    assert timings.download == pytest.approx(n_inputs * 0.2, abs=0.2)
+    assert timings.execute == pytest.approx(n_inputs * 0.2, abs=0.2)
+
+
+@skip_github_non_linux
+@pytest.mark.parametrize("concurrency,thread_name", [(1, "MainThread"), (2, "modal-input-worker-0")])
+def test_sync_function_outputs_serialized_on_its_thread(servicer, concurrency, thread_name):
+    ret = _run_container(
+        servicer, "test.supports.functions", "returns_thread_name_on_pickle", allow_concurrent_inputs=concurrency
+    )
+    # The output is pickled by the thread that ran the function, before it could be changed by other inputs,
+    # and only compressed and sent in the background
+    assert _unwrap_scalar(ret) == thread_name
+
+
 @skip_github_non_linux
 @pytest.mark.usefixtures("server_url_env")
 def test_lifecycle_full(servicer, tmp_path):
@@ -2356,6 +2565,79 @@ async def test_input_slots():
     assert slots.value == 10
 
 
+@skip_github_non_linux
+def test_async_function_returns_modal_object(servicer, credentials):
+    deploy_app_externally(servicer, credentials, "test.supports.functions", "app", capture_output=False)
+    app_layout = servicer.app_get_layout("ap-1")
+    ret = _run_container(
+        servicer, "test.supports.functions", "get_square_async", inputs=_get_inputs(((), {})), app_layout=app_layout
+    )
+    # Outputs aren't translated, so callers get the public type of the object
+    result = _unwrap_scalar(ret)
+    assert isinstance(result, modal.Function)
+    assert result.object_id
+
+
+def _wait_for(predicate: Callable[[], bool], timeout: float = 10) -> None:
+    deadline = time.monotonic() + timeout
+    while not predicate():
+        assert time.monotonic() < deadline, "timed out"
+        time.sleep(0.001)
+
+
+def test_input_thread_pool():
+    thread_names: list[str] = []
+    started = threading.Semaphore(0)
+    release = threading.Event()
+
+    def run(block: bool):
+        thread_names.append(threading.current_thread().name)
+        if block:
+            started.release()
+            release.wait()
+
+    with InputThreadPool(max_threads=2) as pool:
+        # Inputs that arrive one at a time reuse the same thread
+        for _ in range(3):
+            pool.submit(run, False)
+            _wait_for(lambda: bool(pool._idle) and pool._n_unfinished == 0)
+        assert thread_names == ["modal-input-worker-0"] * 3
+
+        # The pool grows with concurrency, and queues inputs beyond its size
+        pool.set_max_threads(4)
+        thread_names.clear()
+        for _ in range(6):
+            pool.submit(run, True)
+        for _ in range(4):
+            assert started.acquire(timeout=10)
+        assert (pool._n_workers, len(pool._queued)) == (4, 2)
+
+        # Threads retire when concurrency shrinks, once they've run the queued inputs
+        pool.set_max_threads(1)
+        release.set()
+        _wait_for(lambda: pool._n_unfinished == 0 and pool._n_workers == 1)
+        assert len(thread_names) == 6
+
+    stats = pool.worker_stats()
+    assert [s.name for s in stats] == [f"modal-input-worker-{i}" for i in range(4)]
+    assert sum(s.n_inputs for s in stats) == 9
+    assert all(s.busy > 0 and s.idle > 0 for s in stats)
+
+
+def test_input_thread_pool_follows_input_concurrency():
+    input_slots = InputSlots(2)
+    container_io_manager = mock.Mock(
+        add_input_concurrency_listener=input_slots.listeners.append,
+        remove_input_concurrency_listener=input_slots.listeners.remove,
+    )
+    with InputThreadPool(max_threads=2) as pool:
+        pool.follow_input_concurrency(container_io_manager)
+        input_slots.set_value(5)
+        assert pool.max_threads == 5
+    # The pool stops following the input concurrency once it exits
+    assert input_slots.listeners == []
+
+
 @skip_github_non_linux
 def test_max_concurrency(servicer):
     n_inputs = 5
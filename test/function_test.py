@@ -2,7 +2,9 @@
 import asyncio
 import inspect
 import os
+import pickle
 import pytest
+import struct
 import time
 import typing
 from contextlib import contextmanager
@@ -12,7 +14,8 @@ from synchronicity.exceptions import UserCodeException
 
 import modal
 from modal import App, Image, NetworkFileSystem, Proxy, asgi_app, batched, web_endpoint
-from modal._utils.async_utils import synchronize_api
+from modal._serialization import SUPPORTED_OUTPUT_FORMATS, deserialize
+from modal._utils.async_utils import synchronize_api, synchronizer
 from modal._vendor import cloudpickle
 from modal.exception import DeprecationError, ExecutionError, InvalidError
 from modal.functions import Function, FunctionCall, gather
@@ -76,6 +79,17 @@ def test_map(client, servicer, slow_put_inputs):
         assert len(servicer.cleared_function_calls) == 2
 
 
+def test_map_raw(client, servicer):
+    app = App()
+    dummy_modal = app.function()(dummy)
+
+    with app.run(client=client):
+        outputs = list(dummy_modal.map([5, 2], [4, 3], raw=True))
+        assert all(isinstance(output, bytes) for output in outputs)
+        assert [deserialize(output, client) for output in outputs] == [41, 13]
+        assert [deserialize(output, client) for output in dummy_modal.starmap([(1, 2)], raw=True)] == [5]
+
+
 @pytest.mark.asyncio
 async def test_map_async_generator(client):
     app = App()
@@ -945,6 +959,81 @@ async def test_map_large_inputs(client, servicer, monkeypatch, blob_server):
     assert len(blobs) == 200  # inputs + outputs
 
 
+@pytest.mark.asyncio
+async def test_map_large_shared_inputs(client, servicer, monkeypatch, blob_server):
+    monkeypatch.setattr("modal._utils.function_utils.MAX_OBJECT_SIZE_BYTES", 1)
+    app = App()
+    dummy_modal = app.function()(dummy)
+
+    _, blobs = blob_server
+    async with app.run.aio(client=client):
+        assert [a async for a in dummy_modal.map.aio([3] * 50, kwargs={"q": 4})] == [25] * 50
+
+    assert len(blobs) == 1  # identical inputs are only uploaded once
+    assert synchronizer._translate_in(client)._blob_cache.hits == 49
+
+
+class _ZeroCopyBytes:
+    """Pickles like a numpy array: through a PickleBuffer with protocol 5 and by copy before that."""
+
+    def __init__(self, data: bytearray):
+        self.data = data
+
+    def __reduce_ex__(self, protocol):
+        if protocol >= 5:
+            return bytearray, (pickle.PickleBuffer(self.data),)
+        return bytearray, (bytes(self.data),)
+
+
+def test_map_oob_buffers(client, servicer, blob_server):
+    servicer.function_body(len)
+    app = App()
+    dummy_modal = app.function()(dummy)
+    buffer = _ZeroCopyBytes(bytearray(b"x" * (3 * 1024 * 1024)))
+
+    _, blobs = blob_server
+    with app.run(client=client):
+        assert list(dummy_modal.map([buffer, b"small"])) == [3 * 1024 * 1024, 5]
+        # The large buffer is uploaded out-of-band, after a header that lists it
+        (payload,) = blobs.values()
+        assert struct.unpack_from("<I", payload) == (1,)
+
+        # Functions that don't advertise support for it get plain pickles
+        synchronizer._translate_in(dummy_modal)._supported_input_formats = []
+        blobs.clear()
+        assert list(dummy_modal.map([buffer])) == [3 * 1024 * 1024]
+        (payload,) = blobs.values()
+        assert payload.startswith(b"\x80\x04")
+
+
+def test_oob_buffers_uploaded_before_spawn_returns(client, servicer, blob_server):
+    servicer.function_body(lambda b: bytes(b[:1]))
+    app = App()
+    dummy_modal = app.function()(dummy)
+    data = bytearray(b"x" * (3 * 1024 * 1024))
+
+    with app.run(client=client):
+        function_call = dummy_modal.spawn(_ZeroCopyBytes(data))
+        # The arguments were uploaded straight from `data`, but it can be reused once the call has returned
+        data[:] = b"y" * len(data)
+        assert function_call.get() == b"x"
+
+
+def test_map_negotiated_output_format(client, servicer):
+    servicer.function_body(lambda n: b"x" * n)
+    app = App()
+    dummy_modal = app.function()(dummy)
+    with app.run(client=client):
+        assert list(dummy_modal.map([1, 2])) == [b"x", b"xx"]
+        assert dummy_modal.remote(3) == b"xxx"
+        assert all(formats == SUPPORTED_OUTPUT_FORMATS for formats in servicer.output_formats.values())
+
+        # Raw outputs are always pickles
+        servicer.output_formats.clear()
+        assert [deserialize(b, client) for b in dummy_modal.map([1], raw=True)] == [b"x"]
+        assert list(servicer.output_formats.values()) == [[]]
+
+
 @pytest.mark.asyncio
 async def test_non_aio_map_in_async_caller_error(client):
     dummy_function = app.function()(dummy)
@@ -0,0 +1,93 @@
+# Copyright Modal Labs 2024
+import os
+import pytest
+import time
+from pathlib import PurePosixPath
+
+from modal._utils import hash_cache
+from modal._utils.blob_utils import get_file_upload_spec_from_path
+from modal._utils.hash_cache import FileHashCache
+from modal._utils.hash_utils import get_upload_hashes
+from modal.exception import ExecutionError
+
+
+def _write(path, content: bytes, age: float = 60.0):
+    path.write_bytes(content)
+    # Files modified very recently aren't cached, so these are backdated
+    t = time.time() - age
+    os.utime(path, (t, t))
+    return os.stat(path)
+
+
+def test_hash_cache_hit_and_invalidation(tmp_path):
+    cache = FileHashCache(str(tmp_path / "cache.sqlite3"), max_entries=100)
+    path = tmp_path / "a.txt"
+    stat = _write(path, b"hello")
+    hashes = get_upload_hashes(b"hello")
+
+    assert cache.get(str(path), stat) is None
+    cache.put(str(path), stat, hashes)
+    assert cache.get(str(path), stat) == hashes
+    assert (cache.hits, cache.misses) == (1, 1)
+
+    # Any change to the file's size, mtime or inode invalidates its entry
+    new_stat = _write(path, b"hello!")
+    assert cache.get(str(path), new_stat) is None
+    new_stat = _write(path, b"howdy", age=120)
+    assert cache.get(str(path), new_stat) is None
+
+    # Entries are persisted
+    cache.close()
+    assert FileHashCache(str(tmp_path / "cache.sqlite3"), max_entries=100).get(str(path), stat) == hashes
+
+
+def test_hash_cache_skips_racy_files(tmp_path):
+    cache = FileHashCache(str(tmp_path / "cache.sqlite3"), max_entries=100)
+    path = tmp_path / "a.txt"
+    stat = _write(path, b"hello", age=0)
+    cache.put(str(path), stat, get_upload_hashes(b"hello"))
+    assert cache.get(str(path), stat) is None
+
+
+def test_hash_cache_eviction(tmp_path, monkeypatch):
+    monkeypatch.setattr(hash_cache, "EVICTION_BATCH_SIZE", 5)
+    cache = FileHashCache(str(tmp_path / "cache.sqlite3"), max_entries=10)
+    stats = []
+    for i in range(20):
+        path = tmp_path / f"{i}.txt"
+        stats.append((path, _write(path, b"x")))
+        cache.put(str(path), stats[-1][1], get_upload_hashes(b"x"))
+        if i == 12:
+            # Recently used entries are kept
+            time.sleep(0.01)
+            assert cache.get(str(stats[0][0]), stats[0][1]) is not None
+    assert len(cache) == 10
+    assert cache.get(str(stats[0][0]), stats[0][1]) is not None
+    assert cache.get(str(stats[1][0]), stats[1][1]) is None
+
+
+def test_hash_cache_errors_disable_it(tmp_path):
+    # The cache location is a directory, so the database can't be opened
+    cache = FileHashCache(str(tmp_path), max_entries=10)
+    path = tmp_path / "a.txt"
+    stat = _write(path, b"hello")
+    cache.put(str(path), stat, get_upload_hashes(b"hello"))
+    assert cache.get(str(path), stat) is None
+
+
+def test_file_upload_spec_uses_hash_cache(tmp_path):
+    path = tmp_path / "a.txt"
+    _write(path, b"hello")
+    spec = get_file_upload_spec_from_path(path, PurePosixPath("/a.txt"))
+    assert spec.content == b"hello"
+
+    # Hashes come from the cache, and the content is only read when it's needed
+    cached_spec = get_file_upload_spec_from_path(path, PurePosixPath("/a.txt"))
+    assert cached_spec.content is None
+    assert (cached_spec.sha256_hex, cached_spec.md5_hex, cached_spec.size) == (spec.sha256_hex, spec.md5_hex, 5)
+    assert cached_spec.read_content() == b"hello"
+
+    # Content that changed after it was hashed isn't uploaded
+    path.write_bytes(b"jello")
+    with pytest.raises(ExecutionError, match="modified"):
+        cached_spec.read_content()
@@ -1,11 +1,16 @@
 # Copyright Modal Labs 2022
+import functools
 import hashlib
 import os
 import platform
 import pytest
+import time
 from pathlib import Path, PurePosixPath
 
+from grpclib import GRPCError, Status
+
 from modal import App, FilePatternMatcher
+from modal._utils import blob_utils
 from modal._utils.blob_utils import LARGE_FILE_LIMIT
 from modal.mount import Mount, module_mount_condition, module_mount_ignore_condition
 
@@ -168,3 +173,106 @@ def test_mount_from_local_dir_ignore(test_dir, tmp_path_with_content):
 
     file_names = [file.mount_filename for file in Mount._get_files(entries=mount.entries)]
     assert set(file_names) == expected
+
+
+def test_mount_batched_existence_checks(servicer, client, tmp_path, monkeypatch):
+    n_files = 300
+    for i in range(n_files):
+        (tmp_path / f"{i}.txt").write_text(f"file {i}")
+    # Batches are only sent once they're full, so the number of checks doesn't depend on timing
+    checker = functools.partial(blob_utils.MountFileExistenceChecker, max_batch_size=100, debounce_time=60)
+    monkeypatch.setattr("modal.mount.MountFileExistenceChecker", checker)
+
+    with servicer.intercept() as ctx:
+        Mount._from_local_dir(tmp_path, remote_path="/foo")._deploy("my-mount", client=client)
+    # Files that don't exist yet are uploaded in packs
+    assert [len(req.sha256_hexes) for req in ctx.get_requests("MountFilesExist")] == [100] * 3
+    assert sum(len(req.files) for req in ctx.get_requests("MountPutPackedFiles")) == n_files
+    assert len(ctx.get_requests("MountPutFile")) == 0
+
+    # Files that already exist only cost the batched checks
+    with servicer.intercept() as ctx:
+        Mount._from_local_dir(tmp_path, remote_path="/bar")._deploy("my-mount-2", client=client)
+    assert len(ctx.get_requests("MountPutFile")) == len(ctx.get_requests("MountPutPackedFiles")) == 0
+    assert [len(req.sha256_hexes) for req in ctx.get_requests("MountFilesExist")] == [100] * 3
+
+
+def test_mount_existence_checks_fallback(servicer, client, tmp_path):
+    for i in range(10):
+        (tmp_path / f"{i}.txt").write_text(f"file {i}")
+
+    async def unimplemented(self, stream):
+        await stream.recv_message()
+        raise GRPCError(Status.UNIMPLEMENTED, "Not implemented")
+
+    # Older servers are asked about each file with MountPutFile, and get each file with MountPutFile
+    with servicer.intercept() as ctx:
+        ctx.set_responder("MountFilesExist", unimplemented)
+        ctx.set_responder("MountPutPackedFiles", unimplemented)
+        Mount._from_local_dir(tmp_path, remote_path="/foo")._deploy("my-mount", client=client)
+    assert len(ctx.get_requests("MountPutFile")) == 20
+    assert {f"/foo/{i}.txt" for i in range(10)} <= servicer.files_name2sha.keys()
+
+
+def test_mount_manifest_cache(servicer, client, tmp_path):
+    for i in range(10):
+        path = tmp_path / f"{i}.py"
+        path.write_text(f"x = {i}")
+        os.utime(path, (time.time() - 60, time.time() - 60))  # recently modified files aren't cached
+
+    def deploy(name):
+        with servicer.intercept() as ctx:
+            Mount._from_local_dir(tmp_path, remote_path="/src")._deploy(name, client=client)
+        return ctx
+
+    ctx = deploy("mount-1")
+    assert len(ctx.get_requests("MountFilesExist")) > 0
+
+    # The file list of an unchanged mount is reused without checking any files
+    ctx = deploy("mount-2")
+    assert len(ctx.get_requests("MountFilesExist")) == len(ctx.get_requests("MountPutFile")) == 0
+    (req,) = ctx.get_requests("MountGetOrCreate")
+    assert {f.filename for f in req.files} == {f"/src/{i}.py" for i in range(10)}
+
+    # Changed files are picked up
+    (tmp_path / "0.py").write_text("x = 100")
+    ctx = deploy("mount-3")
+    assert len(ctx.get_requests("MountPutFile")) == 0
+    assert len(ctx.get_requests("MountPutPackedFiles")) == 1
+    assert servicer.files_sha2data[hashlib.sha256(b"x = 100").hexdigest()]["data"] == b"x = 100"
+
+
+def test_mount_manifest_cache_fallback(servicer, client, tmp_path):
+    path = tmp_path / "a.py"
+    path.write_text("x = 1")
+    os.utime(path, (time.time() - 60, time.time() - 60))
+    Mount._from_local_dir(tmp_path, remote_path="/src")._deploy("mount-1", client=client)
+
+    # If the server rejects the cached file list (here, because it no longer has the file), the files are
+    # checked and uploaded as usual
+    servicer.files_sha2data.clear()
+    with servicer.intercept() as ctx:
+        Mount._from_local_dir(tmp_path, remote_path="/src")._deploy("mount-2", client=client)
+    assert len(ctx.get_requests("MountGetOrCreate")) == 2
+    assert len(ctx.get_requests("MountFilesExist")) == 1
+    assert servicer.files_sha2data[hashlib.sha256(b"x = 1").hexdigest()]["data"] == b"x = 1"
+
+
+def test_mount_manifest_cache_changed_file(servicer, client, tmp_path):
+    path = tmp_path / "a.py"
+    path.write_text("x = 1")
+    mtime = time.time() - 60
+    os.utime(path, (mtime, mtime))
+    Mount._from_local_dir(tmp_path, remote_path="/src")._deploy("mount-1", client=client)
+
+    # A file that changed on disk isn't taken from the cached file list, even with the same size and mtime
+    path.write_text("x = 2")
+    os.utime(path, (mtime, mtime))
+    with servicer.intercept() as ctx:
+        Mount._from_local_dir(tmp_path, remote_path="/src")._deploy("mount-2", client=client)
+    assert len(ctx.get_requests("MountGetOrCreate")) == 1
+    assert len(ctx.get_requests("MountPutPackedFiles")) == 1
+    sha256_hex = hashlib.sha256(b"x = 2").hexdigest()
+    assert servicer.files_sha2data[sha256_hex]["data"] == b"x = 2"
+    mount_id = next(mount_id for (name, _), mount_id in servicer.deployed_mounts.items() if name == "mount-2")
+    assert servicer.mount_contents[mount_id] == {"/src/a.py": sha256_hex}
@@ -88,6 +88,11 @@ async def test_network_file_system_handle_big_file(client, tmp_path, servicer, b
             await nfs.add_local_file.aio(local_file_path)
             object_id = nfs.object_id
 
+            # Files stored as blobs are read back as bytes
+            chunks = [chunk async for chunk in nfs.read_file.aio("/bigfile")]
+            assert b"".join(chunks) == b"hello world, this is a lot of text"
+            assert all(type(chunk) is bytes for chunk in chunks)
+
         assert servicer.nfs_files[object_id].keys() == {"/bigfile"}
         assert servicer.nfs_files[object_id]["/bigfile"].data == b""
         assert servicer.nfs_files[object_id]["/bigfile"].data_blob_id == "bl-1"
@@ -0,0 +1,190 @@
+# Copyright Modal Labs 2024
+import asyncio
+import pickle
+import pytest
+import threading
+
+from modal import App
+from modal._utils import function_utils
+from modal.parallel_map import _InputPumpController, _OutputReorderBuffer
+from modal_proto import api_pb2
+
+
+def dummy():
+    pass  # not actually used in test (servicer returns sum of square of all args)
+
+
+def _input_item(n_bytes: int) -> api_pb2.FunctionPutInputsItem:
+    return api_pb2.FunctionPutInputsItem(input=api_pb2.FunctionInput(args=b"x" * n_bytes))
+
+
+def test_input_pump_controller_aimd():
+    controller = _InputPumpController(max_batch_size=10, max_inflight_requests=4, target_latency=1.0)
+    assert controller.window == 10
+
+    # Fast requests grow the window by about one batch per window's worth of inputs
+    controller.on_success(10, 100, latency=0.01)
+    assert controller.window == 20
+    controller.on_success(10, 100, latency=0.01)
+    controller.on_success(10, 100, latency=0.01)
+    assert 20 < controller.window < 30
+
+    # ... up to the max number of in-flight requests
+    for _ in range(100):
+        controller.on_success(10, 100, latency=0.01)
+    assert controller.window == 40
+    assert controller.batch_size == 10
+
+    # Slow requests shrink it a little, backpressure shrinks it a lot
+    controller.on_success(10, 100, latency=2.0)
+    assert controller.window == 30
+    assert controller.on_backpressure() == pytest.approx(0.1)
+    assert controller.on_backpressure() == pytest.approx(0.2)
+    assert controller.window == 7.5
+    assert controller.batch_size == 7
+    for _ in range(10):
+        controller.on_backpressure()
+    assert controller.window == 1
+    assert controller.batch_size == 1
+    assert controller.backoff == controller.max_backoff
+
+    # A successful request resets the backoff delay
+    controller.on_success(1, 100, latency=0.01)
+    assert controller.backoff == controller.base_backoff
+    assert controller.n_backpressure == 12
+    assert controller.n_requests == 105
+
+
+@pytest.mark.asyncio
+async def test_input_pump_controller_batches():
+    controller = _InputPumpController(max_batch_size=3, max_batch_bytes=1000)
+    q: asyncio.Queue = asyncio.Queue()
+    for n_bytes in [10, 10, 10, 10, 600, 600, 10]:
+        q.put_nowait(_input_item(n_bytes))
+    q.put_nowait(None)
+
+    batches = [[item.ByteSize() for item in items] async for items, _ in controller.batches(q)]
+    # Split by item count first, then by byte size
+    assert [len(b) for b in batches] == [3, 2, 2]
+    assert sum(batches[1]) < 1000 and sum(batches[2]) < 1000
+
+
+@pytest.mark.asyncio
+async def test_input_pump_controller_window():
+    controller = _InputPumpController(max_batch_size=4)
+    controller.window = 5
+
+    await controller.acquire(4)
+    acquire_task = asyncio.create_task(controller.acquire(4))
+    await asyncio.sleep(0.01)
+    assert not acquire_task.done()  # would exceed the window
+    await controller.release(4)
+    await asyncio.wait_for(acquire_task, timeout=1)
+    assert controller.inflight == 4
+    await controller.release(4)
+
+    # A batch larger than the window is still let through when nothing else is in flight
+    controller.window = 1
+    await asyncio.wait_for(controller.acquire(4), timeout=1)
+    await controller.release(4)
+
+
+def test_map_resource_exhausted(client, servicer):
+    servicer.put_inputs_resource_exhausted = 3
+
+    app = App()
+    dummy_modal = app.function()(dummy)
+    with app.run(client=client):
+        assert list(dummy_modal.map(range(100))) == [i**2 for i in range(100)]
+    assert servicer.put_inputs_resource_exhausted == 0
+
+
+def _output_item(idx: int, n_bytes: int = 100) -> api_pb2.FunctionGetOutputsItem:
+    return api_pb2.FunctionGetOutputsItem(
+        idx=idx, input_id=f"in-{idx}", result=api_pb2.GenericResult(data=b"x" * n_bytes)
+    )
+
+
+def test_output_reorder_buffer_spills_to_disk():
+    buffer = _OutputReorderBuffer(max_memory_bytes=500)
+
+    for idx in range(1, 20):
+        buffer.put(_output_item(idx))
+        assert list(buffer.pop_ready()) == []
+    assert len(buffer) == 19
+    assert buffer.memory_bytes <= 500
+    assert buffer.n_spilled > 0
+
+    buffer.put(_output_item(0))
+    assert [item.idx for item in buffer.pop_ready()] == list(range(20))
+    assert [item.input_id for item in buffer.pop_ready()] == []
+    assert len(buffer) == 0 and buffer.memory_bytes == 0
+
+    # The spill file is reused from the start once it has been drained
+    n_spilled = buffer.n_spilled
+    for idx in [22, 21, 20]:
+        buffer.put(_output_item(idx, n_bytes=1000))
+    assert buffer.n_spilled == n_spilled + 2
+    assert [item.result.data for item in buffer.pop_ready()] == [b"x" * 1000] * 3
+    buffer.close()
+
+
+def test_output_reorder_buffer_ignores_duplicates():
+    buffer = _OutputReorderBuffer(max_memory_bytes=1000)
+    buffer.put(_output_item(1))
+    buffer.put(_output_item(1))
+    buffer.put(_output_item(0))
+    assert [item.idx for item in buffer.pop_ready()] == [0, 1]
+    buffer.put(_output_item(0))
+    assert len(buffer) == 0
+
+
+def test_map_bounded_reorder_buffer(client, servicer, monkeypatch):
+    monkeypatch.setenv("MODAL_MAP_REORDER_BUFFER_SIZE", "200")
+    monkeypatch.setenv("MODAL_MAP_REORDER_WINDOW", "3")
+
+    app = App()
+    dummy_modal = app.function()(dummy)
+    with app.run(client=client):
+        assert list(dummy_modal.map(range(200))) == [i**2 for i in range(200)]
+
+
+@pytest.mark.parametrize("serialization_threads", [0, 2])
+def test_map_serialization_threads(client, servicer, monkeypatch, serialization_threads):
+    monkeypatch.setenv("MODAL_MAP_SERIALIZATION_THREADS", str(serialization_threads))
+    serializer_threads = set()
+    original_serialize = function_utils.serialize_oob
+
+    def serialize_oob(obj):
+        serializer_threads.add(threading.current_thread().name)
+        return original_serialize(obj)
+
+    monkeypatch.setattr(function_utils, "serialize_oob", serialize_oob)
+
+    app = App()
+    dummy_modal = app.function()(dummy)
+    with app.run(client=client):
+        assert list(dummy_modal.map(range(50))) == [i**2 for i in range(50)]
+    # With no serialization threads, inputs are serialized on the event loop
+    assert {name.startswith("modal-map-serializer") for name in serializer_threads} == {serialization_threads > 0}
+
+
+@pytest.mark.parametrize("payload_compression", ["0", "1"])
+def test_map_payload_compression(client, servicer, monkeypatch, payload_compression):
+    monkeypatch.setenv("MODAL_PAYLOAD_COMPRESSION", payload_compression)
+    servicer.function_body(len)
+    arg = "abc" * 100_000
+    buffer = bytearray(b"abc" * 100_000)
+
+    app = App()
+    dummy_modal = app.function()(dummy)
+    with app.run(client=client):
+        results = list(dummy_modal.map([arg, "x", pickle.PickleBuffer(buffer)]))
+        assert results == [len(arg), 1, len(buffer)]
+    if payload_compression == "1":
+        # Only the large input is compressed, with a codec that every container has. Large buffers are sent
+        # out-of-band without being compressed, to avoid copying them.
+        expected = [api_pb2.PAYLOAD_COMPRESSION_UNSPECIFIED] * 2 + [api_pb2.PAYLOAD_COMPRESSION_ZLIB]
+        assert sorted(servicer.input_compressions) == expected
+    else:
+        assert servicer.input_compressions == [api_pb2.PAYLOAD_COMPRESSION_UNSPECIFIED] * 3
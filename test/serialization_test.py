@@ -1,18 +1,25 @@
 # Copyright Modal Labs 2022
+import collections
+import pickle
 import pytest
 import random
 
 from modal import Queue
 from modal._serialization import (
+    PickleCache,
+    _is_plain_data,
     deserialize,
     deserialize_data_format,
     deserialize_proto_params,
+    pre_serialize,
     serialize,
     serialize_data_format,
+    serialize_negotiated,
+    serialize_oob,
     serialize_proto_params,
 )
 from modal._utils.rand_pb_testing import rand_pb
-from modal.exception import DeserializationError
+from modal.exception import DeserializationError, InvalidError
 from modal_proto import api_pb2
 
 from .supports.skip import skip_old_py
@@ -36,6 +43,108 @@ async def test_roundtrip(servicer, client):
         assert q.object_id == q_roundtrip.object_id
 
 
+@pytest.mark.asyncio
+async def test_pre_serialize(servicer, client):
+    kwargs = {"config": {"layers": list(range(100))}}
+    shared = pre_serialize(kwargs)
+    assert shared is not None
+    payloads = [serialize(((i,), shared)) for i in range(3)]
+
+    # Readable with plain pickle, without Modal's Unpickler
+    assert pickle.loads(payloads[0]) == ((0,), kwargs)
+
+    # With a cache, the embedded object is decoded once and shared
+    cache = PickleCache()
+    decoded = [deserialize(payload, client, cache) for payload in payloads]
+    assert [args for args, _ in decoded] == [(0,), (1,), (2,)]
+    assert decoded[0][1] == kwargs
+    assert decoded[0][1] is decoded[1][1] is decoded[2][1]
+    assert len(cache) == 1
+
+    # Other pickles that happen to embed `pickle.loads` aren't cached
+    other = ((0,), pickle.loads, pickle.dumps([1]))
+    assert deserialize(serialize(other), client, cache) == other
+    assert len(cache) == 1
+
+    # Past its size limit, the cache decodes objects without keeping them
+    cache = PickleCache(max_bytes=len(shared.data) - 1)
+    first, second = [deserialize(payload, client, cache)[1] for payload in payloads[:2]]
+    assert first == second and first is not second
+    assert len(cache) == 0
+
+    # Without one, every payload gets its own copy
+    first, second = [deserialize(payload, client)[1] for payload in payloads[:2]]
+    assert first == second and first is not second
+
+    # Modal objects need our Unpickler, so they can't be pre-serialized
+    async with Queue.ephemeral(client=client) as q:
+        assert pre_serialize({"q": q}) is None
+
+
+def test_serialize_oob():
+    large = bytearray(b"x" * 100_000)
+    small = bytearray(b"y" * 10)
+    parts = serialize_oob({"large": pickle.PickleBuffer(large), "small": pickle.PickleBuffer(small)})
+
+    # The large buffer is kept out of the pickle stream and still points to the original memory
+    assert len(parts) == 4  # header, pickle stream, padding, buffer
+    assert parts[-1].obj is large
+    assert len(parts[1]) < 1000
+
+    payload = bytearray(b"".join(parts))
+    obj = deserialize(payload, None, data_format=api_pb2.DATA_FORMAT_PICKLE_OOB)
+    assert bytes(obj["large"]) == bytes(large)
+    assert bytes(obj["small"]) == bytes(small)
+    # Out-of-band buffers are views into a writable payload ...
+    assert obj["large"].obj is payload
+    # ... and copies of an immutable one, so they are always writable
+    obj = deserialize_data_format(bytes(payload), api_pb2.DATA_FORMAT_PICKLE_OOB, None)
+    assert bytes(obj["large"]) == bytes(large) and not obj["large"].readonly
+
+    assert deserialize_data_format(
+        serialize_data_format([1, 2], api_pb2.DATA_FORMAT_PICKLE_OOB), api_pb2.DATA_FORMAT_PICKLE_OOB, None
+    ) == [1, 2]
+
+
+def test_deserialize_from_buffer():
+    obj = {"a": [1, 2, 3], "b": b"x" * 1_000_000, "c": "text\nwith newline"}
+    payload = serialize(obj)
+    for buffer in [bytearray(payload), memoryview(payload), memoryview(bytearray(payload))[:]]:
+        assert deserialize(buffer, None) == obj
+    assert deserialize_data_format(memoryview(b"raw"), api_pb2.DATA_FORMAT_RAW_BYTES, None) == b"raw"
+
+
+def test_is_plain_data():
+    cyclic: list = [1]
+    cyclic.append(cyclic)
+    assert _is_plain_data(((1, 2.5, "a", b"b", None), {"k": [{1, 2}, frozenset(), cyclic]}))
+    assert not _is_plain_data({"f": lambda: None})
+    assert not _is_plain_data([Exception()])
+    assert not _is_plain_data(collections.OrderedDict())  # subclasses go through cloudpickle, so they keep their type
+
+    # The fast path produces regular pickles
+    obj = ((list(range(10)),), {"key": {"a": (1.0, None)}})
+    assert pickle.loads(serialize(obj)) == obj
+    assert deserialize(b"".join(serialize_oob(obj)), None, data_format=api_pb2.DATA_FORMAT_PICKLE_OOB) == obj
+
+
+def test_serialize_negotiated():
+    raw_and_oob = [api_pb2.DATA_FORMAT_RAW_BYTES, api_pb2.DATA_FORMAT_PICKLE_OOB]
+    assert serialize_negotiated(b"abc", raw_and_oob) == (api_pb2.DATA_FORMAT_RAW_BYTES, [b"abc"])
+
+    data_format, parts = serialize_negotiated("abc", raw_and_oob)
+    assert data_format == api_pb2.DATA_FORMAT_PICKLE_OOB
+    assert deserialize_data_format(b"".join(parts), data_format, None) == "abc"
+
+    # Formats this client doesn't know about, or that aren't negotiable, are skipped
+    data_format, parts = serialize_negotiated(b"abc", [999, api_pb2.DATA_FORMAT_ASGI])
+    assert data_format == api_pb2.DATA_FORMAT_PICKLE
+    assert deserialize_data_format(parts[0], data_format, None) == b"abc"
+
+    with pytest.raises(InvalidError, match="Unknown data format"):
+        deserialize_data_format(b"", 999, None)
+
+
 @skip_old_py("random.randbytes() was introduced in python 3.9", (3, 9))
 @pytest.mark.asyncio
 async def test_asgi_roundtrip():
@@ -46,6 +46,16 @@ def delay(t):
     return t
 
 
+class ThreadNameOnPickle:
+    def __reduce__(self):
+        return (str, (threading.current_thread().name,))
+
+
+@app.function()
+def returns_thread_name_on_pickle(x):
+    return ThreadNameOnPickle()
+
+
 @app.function()
 async def delay_async(t):
     await asyncio.sleep(t)
@@ -66,6 +76,11 @@ async def square_async(x):
     return x * x
 
 
+@app.function()
+async def get_square_async():
+    return square
+
+
 @app.function()
 def raises(x):
     raise Exception("Failure!")
@@ -750,3 +765,14 @@ class CustomException(Exception):
 @app.function()
 def raises_custom_exception(x):
     raise CustomException("Failure!")
+
+
+@app.function()
+def kwarg_id(x, shared):
+    return id(shared)
+
+
+@app.function()
+def buffer_info(buf):
+    view = memoryview(buf)
+    return view.nbytes, view.readonly
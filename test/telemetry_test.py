@@ -15,10 +15,13 @@ import uuid
 from pathlib import Path
 from struct import unpack
 
+from modal._runtime import telemetry
 from modal._runtime.telemetry import (
+    INPUT_WORKER_STATS,
     MESSAGE_HEADER_FORMAT,
     MESSAGE_HEADER_LEN,
     ImportInterceptor,
+    emit_event,
     instrument_imports,
     supported_platform,
 )
@@ -121,6 +124,24 @@ def test_import_tracing(monkeypatch):
                 assert m["attributes"]["latency"] >= 0
 
 
+def test_emit_event(monkeypatch):
+    if not supported_platform():
+        pytest.skip(f"unsupported platform: {sys.platform}")
+
+    # Events are dropped when the container has no telemetry socket
+    emit_event(INPUT_WORKER_STATS, {"name": "modal-input-worker-0"})
+
+    with TelemetryConsumer() as consumer:
+        interceptor = ImportInterceptor.connect(consumer.socket_filename.absolute().as_posix())
+        monkeypatch.setattr(telemetry, "_interceptor", interceptor)
+        emit_event(INPUT_WORKER_STATS, {"name": "modal-input-worker-0", "busy": 1.5})
+
+        m = consumer.events.get(timeout=30)
+        assert m["event"] == INPUT_WORKER_STATS
+        assert m["attributes"] == {"name": "modal-input-worker-0", "busy": 1.5}
+        assert uuid.UUID(m["span_id"])
+
+
 # For manual testing
 def generate_import_telemetry(telemetry_socket):
     instrument_imports(telemetry_socket)
@@ -1,5 +1,6 @@
 # Copyright Modal Labs 2023
 import asyncio
+import functools
 import io
 import os
 import platform
@@ -11,6 +12,7 @@ from pathlib import Path
 from unittest import mock
 
 import modal
+from modal._utils import blob_utils
 from modal.exception import InvalidError, NotFoundError, VolumeUploadTimeoutError
 from modal.volume import _open_files_error_annotation
 from modal_proto import api_pb2
@@ -99,6 +101,133 @@ async def test_volume_get(servicer, client, tmp_path):
             ...
 
 
+@pytest.mark.asyncio
+async def test_volume_read_ranges(servicer, client, tmp_path, monkeypatch):
+    monkeypatch.setattr("modal.volume.VOLUME_READ_RANGE_SIZE", 1000)
+    file_contents = os.urandom(10_500)
+    local_file_path = tmp_path / "data.bin"
+    local_file_path.write_bytes(file_contents)
+
+    async with modal.Volume.ephemeral(client=client) as vol:
+        async with vol.batch_upload() as batch:
+            batch.put_file(local_file_path, "/data.bin")
+
+        # Ranges are read concurrently, and yielded in order
+        servicer.volume_get_file_ranges.clear()
+        assert b"".join([chunk async for chunk in vol.read_file.aio("/data.bin")]) == file_contents
+        assert sorted(start for _, start, _ in servicer.volume_get_file_ranges) == list(range(0, 10_500, 1000))
+
+        output = io.BytesIO()
+        assert await vol.read_file_into_fileobj.aio("/data.bin", output, concurrency=3) == len(file_contents)
+        assert output.getvalue() == file_contents
+
+        # Interrupted downloads can be resumed
+        output = io.BytesIO(file_contents[:4321])
+        servicer.volume_get_file_ranges.clear()
+        await vol.read_file_into_fileobj.aio("/data.bin", output, resume=True)
+        assert output.getvalue() == file_contents
+        assert min(start for _, start, _ in servicer.volume_get_file_ranges) == 4321
+
+        output = io.BytesIO(file_contents + b"extra")
+        with pytest.raises(ValueError, match="resume"):
+            await vol.read_file_into_fileobj.aio("/data.bin", output, resume=True)
+
+
+@pytest.mark.asyncio
+async def test_volume_download_dir(servicer, client, tmp_path, monkeypatch):
+    monkeypatch.setattr("modal.volume.VOLUME_READ_RANGE_SIZE", 1000)
+    files = {"a.txt": b"hello", "sub/b.bin": os.urandom(5000), "sub/deeper/c.txt": b"world"}
+    upload_dir = tmp_path / "upload"
+    for name, content in files.items():
+        (upload_dir / name).parent.mkdir(parents=True, exist_ok=True)
+        (upload_dir / name).write_bytes(content)
+
+    async with modal.Volume.ephemeral(client=client) as vol:
+        async with vol.batch_upload() as batch:
+            batch.put_directory(upload_dir, "data")
+
+        local_dir = tmp_path / "download"
+        stats = await vol.download_dir.aio("/data", local_dir, concurrency=2)
+        assert {name: (local_dir / name).read_bytes() for name in files} == files
+        assert (stats.n_files, stats.n_skipped, stats.n_bytes) == (3, 0, 5010)
+
+        # Files that were already downloaded are skipped
+        servicer.volume_get_file_ranges.clear()
+        stats = await vol.download_dir.aio("/data", local_dir)
+        assert (stats.n_files, stats.n_skipped) == (0, 3)
+        assert servicer.volume_get_file_ranges == []
+
+        # Partial downloads are continued, and only show up once they're complete
+        (local_dir / "sub/b.bin").unlink()
+        (local_dir / "sub/.b.bin.5000-0.partial").write_bytes(files["sub/b.bin"][:2500])
+        stats = await vol.download_dir.aio("/data", local_dir)
+        assert (stats.n_files, stats.n_skipped, stats.n_bytes) == (1, 2, 2500)
+        assert min(start for _, start, _ in servicer.volume_get_file_ranges) == 2500
+        assert (local_dir / "sub/b.bin").read_bytes() == files["sub/b.bin"]
+        assert sorted(p.name for p in (local_dir / "sub").iterdir()) == ["b.bin", "deeper"]
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("concurrency", [1, 4])
+async def test_volume_read_concurrency(servicer, client, monkeypatch, concurrency):
+    monkeypatch.setattr("modal.volume.VOLUME_READ_RANGE_SIZE", 64 * 1024)
+    file_contents = os.urandom(16 * 64 * 1024)
+    inflight = peak_inflight = 0
+
+    async def volume_get_file(self, stream):
+        nonlocal inflight, peak_inflight
+        req = await stream.recv_message()
+        inflight += 1
+        peak_inflight = max(peak_inflight, inflight)
+        await asyncio.sleep(0.05)
+        inflight -= 1
+        data = file_contents[req.start : req.start + req.len]
+        await stream.send_message(api_pb2.VolumeGetFileResponse(data=data, size=len(file_contents)))
+
+    async with modal.Volume.ephemeral(client=client) as vol:
+        with servicer.intercept() as ctx:
+            ctx.set_responder("VolumeGetFile", volume_get_file)
+            output = io.BytesIO()
+            await vol.read_file_into_fileobj.aio("/data.bin", output, concurrency=concurrency)
+    assert output.getvalue() == file_contents
+    assert peak_inflight == concurrency
+
+
+@pytest.mark.asyncio
+async def test_volume_read_cancels_pending_ranges(servicer, client, tmp_path, monkeypatch):
+    monkeypatch.setattr("modal.volume.VOLUME_READ_RANGE_SIZE", 1000)
+    local_file_path = tmp_path / "data.bin"
+    local_file_path.write_bytes(os.urandom(10_000))
+    original_get_file_range = modal.volume._Volume._get_file_range
+    n_cancelled = 0
+
+    async def get_file_range(self, path, start):
+        nonlocal n_cancelled
+        if start >= 2000:
+            try:
+                await asyncio.sleep(10)  # still being read when writing the output fails
+            except asyncio.CancelledError:
+                await asyncio.sleep(0.1)  # slow cleanup
+                n_cancelled += 1
+                raise
+        return await original_get_file_range(self, path, start)
+
+    class FailingWriter(io.BytesIO):
+        def write(self, data):
+            if self.tell() > 0:
+                raise OSError("disk full")
+            return super().write(data)
+
+    monkeypatch.setattr(modal.volume._Volume, "_get_file_range", get_file_range)
+    async with modal.Volume.ephemeral(client=client) as vol:
+        async with vol.batch_upload() as batch:
+            batch.put_file(local_file_path, "/data.bin")
+        with pytest.raises(OSError, match="disk full"):
+            await vol.read_file_into_fileobj.aio("/data.bin", FailingWriter(), concurrency=4)
+        # The ranges that were still being read were cancelled, and waited for
+        assert n_cancelled == 3
+
+
 def test_volume_reload(client, servicer):
     with modal.Volume.ephemeral(client=client) as vol:
         # Note that in practice this will not work unless run in a task.
@@ -148,6 +277,99 @@ async def test_volume_batch_upload(servicer, client, tmp_path):
     assert servicer.volume_files[object_id]["/filelike2"].mode == 0o644
 
 
+@pytest.mark.asyncio
+async def test_volume_batch_upload_existing_files(servicer, client, tmp_path, monkeypatch):
+    for i in range(100):
+        (tmp_path / f"{i}.txt").write_text(f"file {i}")
+    # Batches are only sent once they're full, so the number of checks doesn't depend on timing
+    checker = functools.partial(blob_utils.MountFileExistenceChecker, max_batch_size=25, debounce_time=60)
+    monkeypatch.setattr("modal.volume.MountFileExistenceChecker", checker)
+
+    async with modal.Volume.ephemeral(client=client) as vol:
+        with servicer.intercept() as ctx:
+            async with vol.batch_upload() as batch:
+                batch.put_directory(tmp_path, "/a")
+        assert len(ctx.get_requests("MountPutFile")) == 0
+        assert sum(len(req.files) for req in ctx.get_requests("MountPutPackedFiles")) == 100
+        assert [len(req.sha256_hexes) for req in ctx.get_requests("MountFilesExist")] == [25] * 4
+
+        # Existence is checked in batches, and files that already exist aren't uploaded again
+        with servicer.intercept() as ctx:
+            async with vol.batch_upload() as batch:
+                batch.put_directory(tmp_path, "/b")
+        assert len(ctx.get_requests("MountPutFile")) == 0
+        assert [len(req.sha256_hexes) for req in ctx.get_requests("MountFilesExist")] == [25] * 4
+        assert len(ctx.get_requests("MountPutPackedFiles")) == 0
+        object_id = vol.object_id
+
+    assert servicer.volume_files[object_id]["/b/7.txt"].data == b"file 7"
+
+
+@pytest.mark.asyncio
+@pytest.mark.timeout(60)
+async def test_volume_batch_upload_streaming(servicer, client, tmp_path, monkeypatch):
+    monkeypatch.setenv("MODAL_SMALL_FILE_PACKING", "0")  # so each file is uploaded on its own
+    n_files = 4000
+    for i in range(n_files):
+        subdir = tmp_path / "data" / str(i % 10)
+        subdir.mkdir(parents=True, exist_ok=True)
+        (subdir / f"{i}.txt").write_text(f"file {i}")
+    (tmp_path / "data" / "link").symlink_to(tmp_path / "data" / "0")  # symlinked directories aren't followed
+
+    n_hashed = 0
+    n_hashed_at_first_upload = None
+
+    def get_file_upload_spec_from_path(*args, **kwargs):
+        nonlocal n_hashed
+        n_hashed += 1
+        return blob_utils.get_file_upload_spec_from_path(*args, **kwargs)
+
+    async def mount_put_file(self, stream):
+        nonlocal n_hashed_at_first_upload
+        request = await stream.recv_message()
+        if n_hashed_at_first_upload is None:
+            n_hashed_at_first_upload = n_hashed
+        self.files_sha2data[request.sha256_hex] = {"data": request.data, "data_blob_id": request.data_blob_id}
+        await stream.send_message(api_pb2.MountPutFileResponse(exists=True))
+
+    with mock.patch("modal.volume.get_file_upload_spec_from_path", get_file_upload_spec_from_path):
+        async with modal.Volume.ephemeral(client=client) as vol:
+            with servicer.intercept() as ctx:
+                ctx.set_responder("MountPutFile", mount_put_file)
+                async with vol.batch_upload() as batch:
+                    batch.put_directory(tmp_path / "data", "/data")
+            object_id = vol.object_id
+
+    # Files are listed and hashed as they're uploaded, rather than all up front
+    assert n_hashed == n_files
+    assert n_hashed_at_first_upload is not None and n_hashed_at_first_upload < n_files
+    assert len(servicer.volume_files[object_id]) == n_files
+    assert servicer.volume_files[object_id]["/data/7/17.txt"].data == b"file 17"
+
+
+@pytest.mark.asyncio
+async def test_volume_batch_upload_packing(servicer, client, tmp_path):
+    for i in range(50):
+        (tmp_path / f"{i}.txt").write_text(f"file {i}")
+    (tmp_path / "dupe.txt").write_text("file 0")
+
+    async with modal.Volume.ephemeral(client=client) as vol:
+        with servicer.intercept() as ctx:
+            with mock.patch("modal._utils.blob_utils.LARGE_FILE_LIMIT", 100):
+                async with vol.batch_upload() as batch:
+                    batch.put_directory(tmp_path, "/")
+        object_id = vol.object_id
+
+    # Small files are uploaded in packs, once per distinct content, and packs that are large enough as blobs
+    pack_requests = ctx.get_requests("MountPutPackedFiles")
+    assert any(req.data_blob_id for req in pack_requests)
+    packed_files = [file for req in pack_requests for file in req.files]
+    assert len(packed_files) == len({file.sha256_hex for file in packed_files}) == 50
+    assert len(ctx.get_requests("MountPutFile")) == 0
+    assert servicer.volume_files[object_id]["/dupe.txt"].data == b"file 0"
+    assert servicer.volume_files[object_id]["/42.txt"].data == b"file 42"
+
+
 @pytest.mark.asyncio
 async def test_volume_batch_upload_force(servicer, client, tmp_path):
     local_file_path = tmp_path / "some_file"